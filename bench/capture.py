@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2017 Binder News
+# This software is licensed under the MIT License. See LICENSE for details.
+#
+# Benchmark for `piterm capture`, no Raspberry Pi needed.
+# A thread writes lines of fake kernel log into one end of a pseudo-terminal at --rate
+# bytes per second (a few times what the Pi's UART can do at 3000000 baud) while piterm's
+# Capture saves the other end to a log file, once as it is and once with timestamps.
+# The log must hold exactly what was sent, less the timestamps. Prints the rate each
+# run managed and exits with 1 if anything was lost.
+#
+
+from __future__ import print_function
+
+import argparse
+import os
+import os.path
+import re
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+import piterm
+import pisim
+
+STAMP = re.compile(br'^\[ *[0-9.]+\] ', re.M)
+
+def make_log(size):
+    """ Lines of varying length that look a bit like a kernel's log. """
+    lines = []
+    total = 0
+    i = 0
+    while total < size:
+        line = '[{:6d}] irq {} handled, counter={:#010x} {}\r\n'.format(i, i % 7, i * 2654435761 & 0xFFFFFFFF,
+            'x' * (i % 53)).encode('ascii')
+        lines.append(line)
+        total += len(line)
+        i += 1
+    return b''.join(lines)[:size]
+
+def feed(fd, data, rate):
+    """ Write data into fd, at about rate bytes per second if rate is set. """
+    start = time.time()
+    pos = 0
+    while pos < len(data):
+        piece = data[pos:pos + 4096]
+        if rate:
+            delay = start + (pos + len(piece)) / float(rate) - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        pos += os.write(fd, piece)
+
+def run_one(data, timestamps, rate, workdir):
+    serial = piterm.import_serial()
+    master, slave, name = pisim.open_pty()
+    log_name = os.path.join(workdir, 'capture.log')
+    try:
+        serial_port = serial.Serial(name, piterm.BASE_BAUD, timeout=0.05)
+        with open(log_name, 'wb') as log_file:
+            capture = piterm.Capture(serial_port, log_file, timestamps=timestamps)
+            capture.start()
+            start = time.time()
+            feed(master, data, rate)
+            # Give the last of it time to come through
+            while capture.received < len(data) and time.time() - start < 60:
+                time.sleep(0.01)
+            elapsed = time.time() - start
+            capture.stop()
+        serial_port.close()
+    finally:
+        os.close(master)
+        os.close(slave)
+
+    with open(log_name, 'rb') as f:
+        logged = f.read()
+    if timestamps:
+        logged = STAMP.sub(b'', logged)
+    return capture.received, elapsed, logged == data, capture.ring.lost
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark piterm capture over a pseudo-terminal.')
+    parser.add_argument('--size', type=int, default=8, metavar='MB', help='how much log to send, default: %(default)s')
+    parser.add_argument('--rate', type=int, default=1000000, metavar='BYTES',
+        help='bytes per second to send, 0 for as fast as possible, default: %(default)s')
+    args = parser.parse_args(argv)
+
+    data = make_log(args.size * 1024 * 1024)
+    workdir = tempfile.mkdtemp(prefix='capture-bench-')
+    ok = True
+    try:
+        for timestamps in (False, True):
+            received, elapsed, intact, lost = run_one(data, timestamps, args.rate, workdir)
+            ok = ok and intact and not lost
+            print('{:15} {:9} bytes in {:6.2f}s, {:10.0f} bytes/s, {} lost, {}'.format(
+                'timestamps' if timestamps else 'raw', received, elapsed, received / elapsed, lost,
+                'ok' if intact else 'CORRUPT'))
+    finally:
+        for name in os.listdir(workdir):
+            os.remove(os.path.join(workdir, name))
+        os.rmdir(workdir)
+    return 0 if ok else 1
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
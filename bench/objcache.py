@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2017 Binder News
+# This software is licensed under the MIT License. See LICENSE for details.
+#
+# Benchmark for objcache.py that doesn't need an ARM toolchain.
+# A fake compiler (a Python script that sleeps like a real compile would) builds a
+# synthetic project three times through objcache.py: cold, warm after deleting
+# build/, and warm again after editing one file. The objects, dependency files and
+# listings from the cached builds must match the ones the compiler made.
+# Exits with 1 if they don't or the hit/miss counts are wrong.
+#
+
+from __future__ import print_function
+
+import argparse
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+OBJCACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'objcache.py')
+
+# Understands just enough of gcc's command line for objcache.py and the genninja rules
+FAKE_GCC = r'''
+import hashlib, os, sys, time
+args = sys.argv[1:]
+source = [a for a in args if a.endswith('.c')][0]
+with open(source) as f:
+    text = '# 1 "{}"\n'.format(source) + f.read()
+if '-E' in args:
+    sys.stdout.write(text)
+    sys.exit(0)
+time.sleep(float(os.environ['FAKE_GCC_DELAY']))
+out = args[args.index('-o') + 1]
+digest = hashlib.sha1((' '.join(args) + text).encode('utf-8')).hexdigest()
+with open(out, 'w') as f:
+    f.write('object ' + digest + '\n')
+if '-MD' in args:
+    with open(os.path.splitext(out)[0] + '.d', 'w') as f:
+        f.write('{}: {}\n'.format(out, source))
+if '-Wa,-adhln' in args:
+    sys.stdout.write('listing for ' + source + '\n')
+'''
+
+CFLAGS = ['-O2', '-I', 'include', '-MD', '-MP', '-Wall', '-Werror', '-Wa,-adhln']
+
+def build(project, compiler, sources):
+    """ Compiles every source through objcache.py, returns the elapsed time. """
+    build_dir = os.path.join(project, 'build')
+    if not os.path.isdir(build_dir):
+        os.makedirs(build_dir)
+    start = time.time()
+    for source in sources:
+        obj = os.path.join('build', os.path.splitext(os.path.basename(source))[0] + '.o')
+        with open(os.path.join(project, obj + '.lst'), 'wb') as lst:
+            subprocess.check_call([sys.executable, OBJCACHE, sys.executable, compiler] + CFLAGS
+                + ['-c', source, '-o', obj], cwd=project, stdout=lst)
+    return time.time() - start
+
+def snapshot(project):
+    result = {}
+    build_dir = os.path.join(project, 'build')
+    for name in sorted(os.listdir(build_dir)):
+        with open(os.path.join(build_dir, name), 'rb') as f:
+            result[name] = f.read()
+    return result
+
+def stats():
+    return subprocess.check_output([sys.executable, OBJCACHE, '--stats']).decode('utf-8')
+
+def count(report, what):
+    for line in report.splitlines():
+        if line.startswith(what + ':'):
+            return int(line.split()[-1])
+    return 0
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark objcache.py with a fake compiler.')
+    parser.add_argument('--files', type=int, default=20, help='number of source files, default: %(default)s')
+    parser.add_argument('--delay', type=float, default=0.2,
+        help='seconds the fake compiler takes per file, default: %(default)s')
+    args = parser.parse_args(argv)
+
+    base = tempfile.mkdtemp(prefix='objcache-bench-')
+    try:
+        os.environ['OBJCACHE_DIR'] = os.path.join(base, 'cache')
+        os.environ['FAKE_GCC_DELAY'] = str(args.delay)
+        compiler = os.path.join(base, 'fake-gcc.py')
+        with open(compiler, 'w') as f:
+            f.write(FAKE_GCC)
+        project = os.path.join(base, 'project')
+        sources = []
+        for i in range(args.files):
+            source = os.path.join('source', 'file{}.c'.format(i))
+            sources.append(source)
+            if not os.path.isdir(os.path.join(project, 'source')):
+                os.makedirs(os.path.join(project, 'source'))
+            with open(os.path.join(project, source), 'w') as f:
+                f.write('int f{0}(int x) {{ return x * {0}; }}\n'.format(i))
+
+        ok = True
+        cold = build(project, compiler, sources)
+        expected = snapshot(project)
+        shutil.rmtree(os.path.join(project, 'build'))
+        warm = build(project, compiler, sources)
+        ok = ok and snapshot(project) == expected
+        with open(os.path.join(project, sources[0]), 'a') as f:
+            f.write('int g(void) { return 1; }\n')
+        edited = build(project, compiler, sources)
+        report = stats()
+        ok = ok and count(report, 'Hits') == 2 * args.files - 1 and count(report, 'Misses') == args.files + 1
+
+        print('{} files, {:.0f} ms per compile'.format(args.files, args.delay * 1000))
+        print('cold:        {:7.3f} s'.format(cold))
+        print('warm:        {:7.3f} s'.format(warm))
+        print('one edited:  {:7.3f} s'.format(edited))
+        print(report.rstrip())
+        print('Outputs: ' + ('ok' if ok else 'FAILED'))
+        return 0 if ok else 1
+    finally:
+        shutil.rmtree(base)
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
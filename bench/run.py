@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2017 Binder News
+# This software is licensed under the MIT License. See LICENSE for details.
+#
+# Benchmark for `piterm run`, no Raspberry Pi needed.
+# Starts --boards copies of pisim.py with UART timing on, each of which "prints" a few
+# lines once its program is started, and tests them all at once from one event loop with
+# piterm.run_board(). Each board is reset with its own SIGUSR1. Then it checks that a
+# failing and a hanging program are reported as such. Prints each board's timing
+# breakdown and how the total compares with testing the boards one after another.
+# Exits with 1 if any result is wrong.
+#
+
+from __future__ import print_function
+
+import argparse
+import asyncio
+import os
+import os.path
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+import piterm
+
+PISIM = os.path.join(ROOT, 'pisim.py')
+OUTPUT = ['Booting test kernel', 'test gpio... ok', 'test timer... ok', 'PASS 2 tests']
+
+def start_sims(count):
+    """ Returns a list of (process, port) for count simulated boards. """
+    sims = []
+    for i in range(count):
+        args = [sys.executable, PISIM, '--uart-timing']
+        for line in OUTPUT:
+            args += ['--say', line]
+        sim = subprocess.Popen(args, stderr=subprocess.PIPE)
+        # '--- Simulated bootloader on /dev/pts/N ---'
+        sims.append((sim, sim.stderr.readline().decode('utf-8').split(' on ')[1].split(' ')[0]))
+    return sims
+
+async def run_all(sims, image_file, options, **test):
+    boards = [(port, image_file) for sim, port in sims]
+    resets = dict((port, 'kill -USR1 {}'.format(sim.pid)) for sim, port in sims)
+    return await asyncio.gather(*[piterm.run_board(port, filename, reset=resets[port], upload_options=options, **test)
+        for port, filename in boards])
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark piterm run against simulated boards.')
+    parser.add_argument('--boards', type=int, default=4, help='number of simulated boards, default: %(default)s')
+    parser.add_argument('--size', type=int, default=64, metavar='KB', help='image size, default: %(default)s')
+    parser.add_argument('--max-baud', type=int, default=921600,
+        help='baud rate to negotiate for uploads, default: %(default)s')
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='run-bench-')
+    image_file = os.path.join(workdir, 'kernel7.img')
+    with open(image_file, 'wb') as f:
+        f.write(os.urandom(args.size * 1024))
+    options = dict(protocol='binary', max_baud=args.max_baud)
+    sims = start_sims(args.boards)
+    ok = True
+    try:
+        start = time.time()
+        results = asyncio.run(run_all(sims, image_file, options, expect=['gpio.*ok', 'PASS'], fail=['FAIL']))
+        elapsed = time.time() - start
+        for result in results:
+            print('{:12} {}'.format(piterm.port_tag(result.port), result))
+            ok = ok and result.status == 'passed'
+        serial_time = sum(sum(result.timings.values()) for result in results)
+        print('{} boards in {:.2f}s, {:.2f}s one after another ({:.1f}x)'.format(
+            len(results), elapsed, serial_time, serial_time / elapsed))
+
+        failed, = asyncio.run(run_all(sims[:1], image_file, options, expect=['PASS'], fail=['timer']))
+        hung, = asyncio.run(run_all(sims[:1], image_file, options, expect=['never printed'], timeout=1.0))
+        print('{:12} {}'.format('failing', failed))
+        print('{:12} {}'.format('hanging', hung))
+        ok = ok and failed.exit_code == piterm.RUN_FAILED and hung.exit_code == piterm.RUN_TIMED_OUT
+    finally:
+        for sim, port in sims:
+            sim.kill()
+            sim.wait()
+        os.remove(image_file)
+        os.rmdir(workdir)
+    print('Results: ' + ('ok' if ok else 'WRONG'))
+    return 0 if ok else 1
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2017 Binder News
+# This software is licensed under the MIT License. See LICENSE for details.
+#
+# Startup time budget for the scripts people run all the time.
+# Runs each one with `python -X importtime` and adds up the time spent importing, less
+# what the interpreter imports by itself before running any script.
+# Exits with 1 if a script goes over its budget or imports something that should
+# only be imported once it's actually needed (pyserial, pip, the ninja writer, ...).
+#
+
+from __future__ import print_function
+
+import argparse
+import os
+import os.path
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# (script and arguments, import budget in milliseconds). The budgets leave room for a slower
+# machine, what they really catch is something slow being imported at the top again.
+SCRIPTS = [
+    (['piterm.py', '--help'], 50),
+    (['piterm.py', 'flash', '--help'], 50),
+    (['genninja.py', '--help'], 45),
+    (['genmake.py', '--help'], 45),
+]
+# Modules none of the above should need to import
+DEFERRED = ['serial', 'pip', 'ninja_syntax', 'urllib.request', 'concurrent.futures']
+
+def baseline(runs):
+    """ Import milliseconds for running nothing at all. """
+    return min(measure(['-c', 'pass'])[0] for _ in range(runs))
+
+def measure(args):
+    """ Returns (import milliseconds, wall milliseconds, names of modules imported) for one run. """
+    start = time.time()
+    proc = subprocess.Popen([sys.executable, '-X', 'importtime'] + args, cwd=ROOT,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    _, err = proc.communicate()
+    wall = (time.time() - start) * 1000
+    total = 0
+    modules = set()
+    for line in err.decode('utf-8', 'replace').splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        modules.add(name.strip())
+        # Only top level imports, nested ones are already counted in their parent's cumulative time
+        if not name.startswith('  '):
+            total += int(cumulative)
+    return total / 1000.0, wall, modules
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Check the startup time of the tools against a budget.')
+    parser.add_argument('--runs', type=int, default=5, help='runs per script, the fastest counts, default: %(default)s')
+    args = parser.parse_args(argv)
+
+    ok = True
+    base = baseline(args.runs)
+    print('interpreter alone: imports {:.1f} ms, not counted'.format(base))
+    for script, budget in SCRIPTS:
+        runs = [measure(script) for _ in range(args.runs)]
+        imports = min(r[0] for r in runs) - base
+        wall = min(r[1] for r in runs)
+        early = sorted(m for m in runs[0][2] for d in DEFERRED if m == d or m.startswith(d + '.'))
+        good = imports <= budget and not early
+        ok = ok and good
+        print('{:28} imports {:6.1f} ms (budget {:3} ms), wall {:6.1f} ms  {}'.format(
+            ' '.join(script), imports, budget, wall, 'ok' if good else 'OVER'))
+        if early:
+            print('    imported too early: ' + ', '.join(early))
+    return 0 if ok else 1
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
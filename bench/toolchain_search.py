@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2017 Binder News
+# This software is licensed under the MIT License. See LICENSE for details.
+#
+# Benchmark for the compiler search in toolchain.py.
+# Builds a synthetic set of home directories with lots of clutter, a few decoy
+# arm-*-gcc* binaries (gcc-ar, gcc-nm, versioned drivers) and one real toolchain,
+# then times a cold search with one thread and with the default pool. --latency adds
+# a delay to every directory listing to act like a network mounted home directory.
+# Exits with 1 if the wrong compiler is picked.
+#
+
+from __future__ import print_function
+
+import argparse
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import toolchain
+
+DECOYS = ['arm-none-eabi-gcc-ar', 'arm-none-eabi-gcc-nm', 'arm-none-eabi-gcc-ranlib', 'arm-none-eabi-gcc-7.2.1']
+
+def touch(path):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    open(path, 'w').close()
+
+def build_tree(base, roots, fanout, depth):
+    """ Creates the synthetic roots under base and returns (roots, expected compiler). """
+    paths = []
+    for r in range(roots):
+        root = os.path.join(base, 'home{}'.format(r))
+        paths.append(root)
+        # Clutter: fanout ** depth directories with a file in each
+        level = [root]
+        for d in range(depth):
+            next_level = []
+            for directory in level:
+                for i in range(fanout):
+                    child = os.path.join(directory, 'd{}'.format(i))
+                    touch(os.path.join(child, 'notes.txt'))
+                    next_level.append(child)
+            level = next_level
+        # Things the search should skip entirely
+        touch(os.path.join(root, 'node_modules', 'x', 'bin', 'arm-none-eabi-gcc'))
+        touch(os.path.join(root, '.cache', 'bin', 'arm-none-eabi-gcc'))
+    # The decoys sort before the real compiler, which is what valid[0] used to pick
+    for name in DECOYS:
+        touch(os.path.join(paths[0], 'a-tools', 'bin', name))
+    expected = os.path.join(paths[-1], 'opt', 'gcc-arm-none-eabi', 'bin', 'arm-none-eabi-gcc')
+    touch(expected)
+    for name in DECOYS:
+        touch(os.path.join(os.path.dirname(expected), name))
+    return paths, os.path.abspath(expected)
+
+def slow_scandir(latency):
+    scandir = os.scandir
+    def wrapper(path):
+        time.sleep(latency)
+        return scandir(path)
+    return wrapper
+
+def timed_search(roots, workers):
+    start = time.time()
+    compilers = toolchain.find_compilers(roots, workers=workers, stop_early=True)
+    return time.time() - start, compilers
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark the compiler search in toolchain.py.')
+    parser.add_argument('--roots', type=int, default=3, help='number of search roots, default: %(default)s')
+    parser.add_argument('--fanout', type=int, default=6, help='directories per directory, default: %(default)s')
+    parser.add_argument('--depth', type=int, default=4, help='depth of the clutter, default: %(default)s')
+    parser.add_argument('--latency', type=float, default=0.002,
+        help='seconds added to every directory listing, default: %(default)s')
+    args = parser.parse_args(argv)
+
+    base = tempfile.mkdtemp(prefix='toolchain-bench-')
+    try:
+        roots, expected = build_tree(base, args.roots, args.fanout, args.depth)
+        # Keep PATH and the usual install locations out of it
+        os.environ['PATH'] = ''
+        os.environ.pop(toolchain.TOOLCHAIN_PATH_VAR, None)
+        toolchain.WELL_KNOWN = []
+        toolchain.os.scandir = slow_scandir(args.latency)
+
+        dirs = sum(1 for _ in os.walk(base))
+        print('{} roots, {} directories, {:.1f} ms per listing'.format(len(roots), dirs, args.latency * 1000))
+        ok = True
+        for workers in [1, toolchain.WORKERS]:
+            elapsed, compilers = timed_search(roots, workers)
+            chosen = compilers[0] if compilers else None
+            print('{:3} threads: {:7.3f} s, chose {}'.format(workers, elapsed, os.path.relpath(chosen, base)))
+            ok = ok and chosen == expected
+        # The ranking must not depend on the order the roots are given in
+        _, compilers = timed_search(list(reversed(roots)), toolchain.WORKERS)
+        ok = ok and compilers[0] == expected
+        print('Ranking: ' + ('ok' if ok else 'FAILED, expected ' + os.path.relpath(expected, base)))
+        return 0 if ok else 1
+    finally:
+        shutil.rmtree(base)
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2017 Binder News
+# This software is licensed under the MIT License. See LICENSE for details.
+#
+# End to end upload benchmark, no Raspberry Pi needed.
+# For each image size and protocol it starts pisim.py with UART timing on, uploads a
+# synthetic kernel7.img with piterm's Flasher, sends 'g' and checks that what the
+# simulated bootloader loaded matches the image byte for byte.
+# Prints the results as JSON (or writes them to --output) so they can be compared
+# between versions. Exits with 1 if any image didn't arrive intact.
+#
+# With --compress, binary uploads are sent compressed when that's worth it and
+# wire_bytes shows how much was actually sent.
+#
+# --drop-last-ack has the simulator lose the ACK for the last chunk of a binary upload, so
+# piterm resends it after the bootloader already has the whole image. The image has to
+# arrive intact anyway and nothing in the resent chunk may be taken for a 'g'.
+#
+# The sizes stop just short of 1MB because the bootloader's ihex parser can't address past
+# 0x100000 and programs start at 0x8000. The binary protocol can go to about 2MB with
+# --protocols binary, past that the bootloader refuses the upload rather than overwrite
+# itself at 0x200000.
+#
+
+from __future__ import print_function
+
+import argparse
+import hashlib
+import json
+import os
+import os.path
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+import piterm
+
+PISIM = os.path.join(ROOT, 'pisim.py')
+DEFAULT_SIZES = [16, 64, 256, 992]
+
+def make_image(size):
+    """ A repeatable image that looks a bit like a kernel: code-like noise with runs of zeros. """
+    blocks = []
+    for i in range((size + 4095) // 4096):
+        if i % 3 == 2:
+            blocks.append(b'\0' * 4096)
+        else:
+            seed = hashlib.sha256(str(i).encode('ascii')).digest()
+            blocks.append(b''.join(hashlib.sha256(seed + bytes(bytearray([j]))).digest() for j in range(128)))
+    return b''.join(blocks)[:size]
+
+def cpu_seconds(who):
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+def run_one(size, protocol, args, workdir):
+    serial = piterm.import_serial()
+    image = make_image(size)
+    image_file = os.path.join(workdir, 'kernel7.img')
+    dump_file = os.path.join(workdir, 'loaded.img')
+    with open(image_file, 'wb') as f:
+        f.write(image)
+    if os.path.exists(dump_file):
+        os.remove(dump_file)
+
+    sim_args = [sys.executable, PISIM, '--once', '--dump', dump_file, '--fifo', str(args.fifo),
+        '--drop-rate', str(args.drop_rate)]
+    if args.uart_timing:
+        sim_args.append('--uart-timing')
+    if args.drop_last_ack:
+        sim_args.append('--drop-last-ack')
+    sim = subprocess.Popen(sim_args, stderr=subprocess.PIPE)
+    sim_cpu = cpu_seconds(resource.RUSAGE_CHILDREN)
+    try:
+        # '--- Simulated bootloader on /dev/pts/N ---'
+        device = sim.stderr.readline().decode('utf-8').split(' on ')[1].split(' ')[0]
+        serial_port = serial.Serial(device, piterm.BASE_BAUD, timeout=0.2)
+        try:
+            # Opening the port may or may not have thrown the banner away, wait until it's quiet either way
+            while serial_port.read(256):
+                pass
+            messages = []
+            flasher = piterm.Flasher(serial_port, protocol=protocol, max_baud=args.max_baud, verify=args.verify,
+                compress=args.compress and protocol == 'binary', log=messages.append)
+
+            host_cpu = cpu_seconds(resource.RUSAGE_SELF)
+            start = time.time()
+            with open(image_file, 'rb') as f:
+                stats = flasher.upload(f)
+            uploaded = time.time()
+            serial_port.write(b'g')
+            # pisim reports the start on stderr and exits, taking the pty with it
+            for line in iter(sim.stderr.readline, b''):
+                if b'Started program' in line:
+                    break
+            started = time.time()
+            host_cpu = cpu_seconds(resource.RUSAGE_SELF) - host_cpu
+        finally:
+            serial_port.close()
+        sim.wait()
+    finally:
+        if sim.poll() is None:
+            sim.kill()
+            sim.wait()
+    sim_cpu = cpu_seconds(resource.RUSAGE_CHILDREN) - sim_cpu
+
+    with open(dump_file, 'rb') as f:
+        loaded = f.read()
+    # ihex uploads are padded to whole words
+    intact = loaded[:len(image)] == image and not loaded[len(image):].strip(b'\0') and len(loaded) - len(image) < 4
+    return {
+        'size': size,
+        'protocol': protocol,
+        'max_baud': args.max_baud,
+        'uart_timing': args.uart_timing,
+        'fifo': args.fifo,
+        'verify': args.verify,
+        'drop_rate': args.drop_rate,
+        'drop_last_ack': args.drop_last_ack,
+        'compress': args.compress and protocol == 'binary',
+        'messages': messages,
+        'wire_bytes': stats.wire_size,
+        'upload_seconds': round(uploaded - start, 4),
+        'time_to_g_seconds': round(started - start, 4),
+        'throughput_bytes_per_second': round(size / (uploaded - start), 1),
+        'line_efficiency_percent': round(stats.efficiency, 1),
+        'host_cpu_seconds': round(host_cpu, 4),
+        'sim_cpu_seconds': round(sim_cpu, 4),
+        'intact': intact,
+    }
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark uploads to the simulated bootloader.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, metavar='KB',
+        help='image sizes in KB, default: %(default)s')
+    parser.add_argument('--protocols', nargs='+', choices=['ihex', 'binary'], default=['ihex', 'binary'],
+        help='protocols to try, default: %(default)s')
+    parser.add_argument('--max-baud', type=int, default=3000000,
+        help='baud rate piterm negotiates up to, default: %(default)s')
+    parser.add_argument('--fifo', type=int, default=16, help='simulated receive FIFO depth, default: %(default)s')
+    parser.add_argument('--no-uart-timing', dest='uart_timing', action='store_false',
+        help='let the simulator read as fast as it can instead of at the baud rate')
+    parser.add_argument('--verify', action='store_true',
+        help="check the bootloader's checksums after ihex uploads and resend bad segments")
+    parser.add_argument('--compress', action='store_true',
+        help='compress binary uploads when that makes them smaller')
+    parser.add_argument('--drop-rate', type=float, default=0.0, metavar='P',
+        help='chance of the simulator losing each byte, default: %(default)s')
+    parser.add_argument('--drop-last-ack', action='store_true',
+        help='have the simulator lose the ACK for the last chunk of each binary upload')
+    parser.add_argument('--output', default=None, help='write the JSON results to this file instead of stdout')
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='upload-bench-')
+    results = []
+    try:
+        for size in args.sizes:
+            for protocol in args.protocols:
+                result = run_one(size * 1024, protocol, args, workdir)
+                sys.stderr.write('{:5} KB {:6}: {:8.3f} s to g, {:9.0f} bytes/s, {}\n'.format(
+                    size, protocol, result['time_to_g_seconds'], result['throughput_bytes_per_second'],
+                    'ok' if result['intact'] else 'CORRUPT'))
+                results.append(result)
+    finally:
+        for name in os.listdir(workdir):
+            os.remove(os.path.join(workdir, name))
+        os.rmdir(workdir)
+
+    report = json.dumps({'python': sys.version.split()[0], 'results': results}, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print(report)
+    return 0 if all(r['intact'] for r in results) else 1
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -11,6 +11,9 @@
 
 static volatile uint32_t *uart = (uint32_t*)UART0_BASE_ADDR;
 
+/// The UART reference clock in Hz, see init_uart().
+#define UART_CLOCK 48000000
+
 // Register offsets.  These values are set to the offset from
 // UART0_BASE_ADDR.
 // To access these registers, use uart[REGISTER_NAME]
@@ -96,9 +99,23 @@ static volatile uint32_t *uart = (uint32_t*)UART0_BASE_ADDR;
 /// Puts GPIO pins XX and YY to alternative selection 5.
 extern void init_uart();
 
+/// Returns the baud rate divisor for baud in 64ths (IBRD << 6 | FBRD),
+/// or 0 if the UART can't get within 2% of that rate.
+extern uint32_t baud_divisor(uint32_t baud);
+
+/// Returns the divisor currently in use, in the same form as baud_divisor().
+extern uint32_t get_baud_divisor();
+
+/// Waits for the transmitter to finish and then switches to a new divisor.
+extern void set_baud_divisor(uint32_t divisor);
+
 /// Gets a single character from the UART port.
 extern char get_char();
 
+/// Gets a single character from the UART port, giving up after timeout_us microseconds.
+/// Returns the character or -1 if nothing arrived in time.
+extern int get_char_timeout(uint32_t timeout_us);
+
 /// Writes a single character to the uart port.
 extern void put_char(char c);
 
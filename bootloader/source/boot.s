@@ -20,6 +20,18 @@ PUT32:
     str r1,[r0]
     bx lr
 
+@ Used by the binary transfer code to store single bytes
+.globl PUT8
+PUT8:
+    strb r1,[r0]
+    bx lr
+
+@ Used by the decompressor to read single bytes
+.globl GET8
+GET8:
+    ldrb r0,[r0]
+    bx lr
+
 @ Unconditional branch to r0
 .globl BRANCHTO
 BRANCHTO:
@@ -2,11 +2,69 @@
 #include "uart.h"
 
 #define RPI_BOOT (0x8000)
+// The bootloader itself starts here (see boot.s), programs have to fit below it
+#define PROGRAM_END (0x00200000)
+
+// Telling the host which of the requests below are understood. A bootloader from before them
+// ignores HELLO_REQUEST, and their frames can hold a 'g' that it would take as "start the
+// program", so piterm asks first and sticks to ihex if there's no answer.
+// Reply:  BIN_ACK | PROTOCOL_VERSION
+#define HELLO_REQUEST (0x02)
+// 1: binary transfers (with LZ4), CRC_REQUEST and BAUD_REQUEST
+#define PROTOCOL_VERSION (1)
+
+// Framed binary transfer, see load_binary()
+#define BIN_START (0x01)
+#define BIN_ACK (0x06)
+#define BIN_NAK (0x15)
+#define BIN_MAX_CHUNK (4096)
+// Give up on a transfer after this long without receiving anything
+#define BIN_TIMEOUT_US (2000000)
+// After a bad frame, input is thrown away until the line has been quiet this long
+#define BIN_DRAIN_US (20000)
+// Once every chunk is in, the transfer only ends after the line has been quiet this long.
+// It has to be longer than the host waits for an ACK before resending (REPLY_TIMEOUT in piterm.py).
+#define BIN_QUIET_US (750000)
+
+// Compressed binary transfers, see decompress()
+#define BIN_FLAG_LZ4 (0x0001)
+// Compressed data is collected here, well clear of programs, the bootloader and its stack
+#define COMPRESSED_BUFFER (0x01000000)
+#define COMPRESSED_MAX (0x01000000)
+#define LZ4_MIN_MATCH (4)
+
+// Asking what is in memory, see report_crc()
+#define CRC_REQUEST (0x03)
+
+// Baud rate negotiation, see negotiate_baud()
+#define BAUD_REQUEST (0x05)
+// How long to wait for the host at the new rate before going back to the old one
+#define BAUD_TIMEOUT_US (500000)
+#define BAUD_PROBE_LENGTH (12)
+static const unsigned char baud_probe[BAUD_PROBE_LENGTH] = {
+    0x55, 0xAA, 0x00, 0xFF, 'P', 'I', 'T', 'E', 'R', 'M', 0x0F, 0xF0
+};
 
 extern void PUT32( unsigned int address, unsigned int value );
+extern void PUT8( unsigned int address, unsigned int value );
+extern unsigned int GET8( unsigned int address );
 extern void BRANCHTO( unsigned int );
 
 void load_program();
+void load_binary();
+void negotiate_baud();
+void report_sums();
+void report_crc();
+int decompress(unsigned int in, unsigned int in_end, unsigned int out, unsigned int out_end);
+
+// Holds one binary chunk until its CRC has been checked
+static unsigned char chunk_buffer[BIN_MAX_CHUNK];
+
+// ihex checksums, one per 64K segment. ihex can only address the first 1MB (plus a bit
+// past it with the last segment), see report_sums().
+#define SUM_SEGMENTS (17)
+static unsigned int segment_sums[SUM_SEGMENTS];
+static unsigned int segments_loaded;
 
 int boot_main()
 {
@@ -37,13 +95,17 @@ void load_program()
     //   [14 - 21]  parse the data field, if state == 21, store data into RAM at the correct address   
     //
     // State Transitions:
+    //   * > 0      when the host asks which requests are understood (ra == HELLO_REQUEST)
+    //   * > 0      when a binary transfer starts (ra == BIN_START), see load_binary()
+    //   * > 0      when the host asks for a new baud rate (ra == BAUD_REQUEST), see negotiate_baud()
+    //   * > 0      when the host asks what is in memory (ra == CRC_REQUEST), see report_crc()
     //   * > 1      when start code is received (ra == ':')
     //   * > 0      when a newline (\r or \n) is received
     //   * > 0      'g' or 'G' is received, also branches to main code
     //   1 ... 8    increment state as each char is parsed
     //   8 > 14     data record
     //   8 > 9      ESA record
-    //   8 > 0      End of File record (also prints a hex string for some reason)
+    //   8 > 0      End of File record (also reports the checksum of each segment, see report_sums())
     //   8 > 0      Any record other than 0, 1 2
     //   9 ... 13   increment as each char is parsed
     //   13 > 0     always
@@ -62,12 +124,10 @@ void load_program()
     unsigned int record_type;
     unsigned int segment;
     unsigned int data;
-    unsigned int sum;
     unsigned int ra;
 
     state=0;
     segment=0;
-    sum=0;
     data=0;
     record_type=0;
     address=0;
@@ -75,6 +135,33 @@ void load_program()
     while(1)
     {
         ra = get_char();
+        if(ra==HELLO_REQUEST)
+        {
+            put_char(BIN_ACK);
+            put_char(PROTOCOL_VERSION);
+            state=0;
+            continue;
+        }
+        if(ra==BIN_START)
+        {
+            // load_binary() only returns once the line has gone quiet, so the rest of a frame
+            // the host resent can't end up here, where a 'g' in it would start a half-loaded program
+            load_binary();
+            state=0;
+            continue;
+        }
+        if(ra==BAUD_REQUEST)
+        {
+            negotiate_baud();
+            state=0;
+            continue;
+        }
+        if(ra==CRC_REQUEST)
+        {
+            report_crc();
+            state=0;
+            continue;
+        }
         if(ra==':')
         {
             state=1;
@@ -145,7 +232,7 @@ void load_program()
                     }
                     case 0x01:
                     {
-                        // print_hex(sum);
+                        report_sums();
                         put_string("-- Press 'g' to start the program\r\n");
                         state=0;
                         break;
@@ -200,8 +287,11 @@ void load_program()
                     ra|=(data<<8)&0x00FF0000;
                     data=ra;
                     PUT32(address,data);
-                    sum+=address;
-                    sum+=data;
+                    if((address>>16)<SUM_SEGMENTS)
+                    {
+                        segment_sums[address>>16]+=address+data;
+                        segments_loaded|=1<<(address>>16);
+                    }
                     address+=4;
                     state=14;
                 }
@@ -214,6 +304,388 @@ void load_program()
         }
     }
 }
+
+/// Print the checksum of every segment loaded since the last report and start again.
+void report_sums()
+{
+    // One line per 64K segment that received data:  "-- Sum <segment address> <sum>"
+    // where sum adds up the address and value of every word stored in that segment.
+    // This is only printed once the End of File record has arrived, printing in the middle
+    // of a transfer would take long enough for the receive FIFO to overflow.
+    // piterm --verify compares these against its own and resends the segments that differ.
+
+    unsigned int i;
+
+    for(i=0;i<SUM_SEGMENTS;i++)
+    {
+        if(segments_loaded&(1<<i))
+        {
+            put_string("-- Sum ");
+            print_hex(i<<16);
+            put_char(' ');
+            print_hex(segment_sums[i]);
+            put_string("\r\n");
+        }
+        segment_sums[i]=0;
+    }
+    segments_loaded=0;
+}
+
+/// Add one byte to a running CRC32 (the same one zlib uses).
+/// Start with 0xFFFFFFFF and invert the result when done.
+static unsigned int crc32_byte(unsigned int crc, unsigned int c)
+{
+    unsigned int k;
+
+    crc^=c;
+    for(k=0;k<8;k++)
+    {
+        crc=(crc>>1)^(0xEDB88320&(0-(crc&1)));
+    }
+    return crc;
+}
+
+/// Read a little endian value that is size bytes long, adding each byte to crc.
+/// Returns 0 on timeout.
+static int read_le(unsigned int size, unsigned int* value, unsigned int* crc)
+{
+    unsigned int i;
+    int c;
+
+    *value=0;
+    for(i=0;i<size;i++)
+    {
+        c=get_char_timeout(BIN_TIMEOUT_US);
+        if(c<0) return 0;
+        *crc=crc32_byte(*crc,c);
+        *value|=((unsigned int)c)<<(i*8);
+    }
+    return 1;
+}
+
+/// Throw away input until the host stops sending.
+static void drain_input()
+{
+    while(get_char_timeout(BIN_DRAIN_US)>=0)
+    {
+        // NOOP
+    }
+}
+
+/// Throw away the rest of a bad frame, then tell the host to try again.
+static void reject_frame()
+{
+    drain_input();
+    put_char(BIN_NAK);
+}
+
+/// Read the rest of a chunk whose first byte is first, and ACK it or NAK it.
+/// Returns 1 if it was stored, with its sequence number in seq, 0 if it was refused and -1 on timeout.
+static int receive_chunk(unsigned int first, unsigned int target, unsigned int length, unsigned int chunk_size,
+    unsigned int* seq)
+{
+    unsigned int count;
+    unsigned int offset;
+    unsigned int high;
+    unsigned int crc;
+    unsigned int check;
+    unsigned int ignored;
+    unsigned int i;
+    int c;
+
+    crc=crc32_byte(0xFFFFFFFF,first);
+    if(!(read_le(1,&high,&crc) && read_le(2,&count,&crc)))
+    {
+        return -1;
+    }
+    *seq=first|(high<<8);
+    offset=*seq*chunk_size;
+    if((*seq>=(length+chunk_size-1)/chunk_size) || (count>chunk_size) || (offset+count>length))
+    {
+        reject_frame();
+        return 0;
+    }
+    for(i=0;i<count;i++)
+    {
+        c=get_char_timeout(BIN_TIMEOUT_US);
+        if(c<0) return -1;
+        chunk_buffer[i]=c;
+        crc=crc32_byte(crc,c);
+    }
+    if(!read_le(4,&check,&ignored))
+    {
+        return -1;
+    }
+    if((crc^0xFFFFFFFF)!=check)
+    {
+        reject_frame();
+        return 0;
+    }
+    for(i=0;i<count;i++)
+    {
+        PUT8(target+offset+i,chunk_buffer[i]);
+    }
+    put_char(BIN_ACK);
+    return 1;
+}
+
+/// Load a program sent with the framed binary protocol. BIN_START has already been read.
+void load_binary()
+{
+    // Raw bytes cost half as much on the wire as ihex, plus there's no per-line overhead.
+    // All values are little endian and each CRC32 covers every byte of the frame before it.
+    //
+    // Header:  address (4) | length (4) | chunk size (2) | flags (2) | CRC32 (4)
+    // Chunk:   sequence (2) | count (2) | payload (count) | CRC32 (4)
+    //
+    // Every header and chunk is answered with BIN_ACK or BIN_NAK. A header is refused if the
+    // program wouldn't fit between RPI_BOOT and PROGRAM_END, so it can't overwrite the
+    // bootloader or its stack. The host sends chunks
+    // in order and resends a chunk until it is ACKed, so a repeated chunk is harmless.
+    // Each chunk is checked before it is copied into place, so a corrupt sequence number
+    // can't damage data that was already accepted.
+    //
+    // The host resends the last chunk too if its ACK got lost, so once every chunk is in this
+    // keeps answering chunks until the line has been quiet for BIN_QUIET_US. Only then is the
+    // transfer finished with one more BIN_ACK. If the host stops part way, whatever it sent
+    // after the timeout is thrown away. Either way nothing it meant as part of a frame is
+    // left for load_program() to read as ihex or a 'g'.
+    //
+    // With BIN_FLAG_LZ4 the payload is the program's length (4) followed by the program
+    // compressed as an LZ4 block. It is collected at COMPRESSED_BUFFER and expanded to the
+    // address once the line is quiet, and the final reply is BIN_NAK instead if it didn't
+    // expand to exactly that length or that length doesn't fit before PROGRAM_END.
+
+    unsigned int address;
+    unsigned int length;
+    unsigned int chunk_size;
+    unsigned int flags;
+    unsigned int chunks;
+    unsigned int expected;
+    unsigned int seq;
+    unsigned int crc;
+    unsigned int check;
+    unsigned int ignored;
+    unsigned int target;
+    unsigned int size;
+    int c;
+    int result;
+
+    crc=0xFFFFFFFF;
+    if(!(read_le(4,&address,&crc) && read_le(4,&length,&crc) && read_le(2,&chunk_size,&crc)
+        && read_le(2,&flags,&crc) && read_le(4,&check,&ignored)))
+    {
+        drain_input();
+        put_string("-- Transfer timed out\r\n");
+        return;
+    }
+    if(((crc^0xFFFFFFFF)!=check) || (chunk_size==0) || (chunk_size>BIN_MAX_CHUNK) || (flags&~BIN_FLAG_LZ4)
+        || (address<RPI_BOOT) || (address>=PROGRAM_END)
+        || (!(flags&BIN_FLAG_LZ4) && (length>PROGRAM_END-address))
+        || ((flags&BIN_FLAG_LZ4) && ((length<4) || (length>COMPRESSED_MAX))))
+    {
+        reject_frame();
+        return;
+    }
+    put_char(BIN_ACK);
+    target=(flags&BIN_FLAG_LZ4)?COMPRESSED_BUFFER:address;
+
+    chunks=(length+chunk_size-1)/chunk_size;
+    expected=0;
+    while(1)
+    {
+        c=get_char_timeout((expected<chunks)?BIN_TIMEOUT_US:BIN_QUIET_US);
+        if(c<0) break;
+        result=receive_chunk(c,target,length,chunk_size,&seq);
+        if(result<0) break;
+        if((result>0) && (seq==expected)) expected++;
+    }
+    if(expected<chunks)
+    {
+        drain_input();
+        put_string("-- Transfer timed out\r\n");
+        return;
+    }
+    if(flags&BIN_FLAG_LZ4)
+    {
+        size=GET8(target)|(GET8(target+1)<<8)|(GET8(target+2)<<16)|(GET8(target+3)<<24);
+        // The header's address is already known to be in the program area, the program has to fit in it too
+        if((size>PROGRAM_END-address) || (decompress(target+4,target+length,address,address+size)!=(int)size))
+        {
+            put_char(BIN_NAK);
+            return;
+        }
+    }
+    put_char(BIN_ACK);
+    put_string("-- Press 'g' to start the program\r\n");
+}
+
+/// Expand the LZ4 block from in to in_end into memory starting at out.
+/// Returns the number of bytes written, or -1 if the block is corrupt or doesn't fit before out_end.
+int decompress(unsigned int in, unsigned int in_end, unsigned int out, unsigned int out_end)
+{
+    // The block is a list of sequences (https://github.com/lz4/lz4/blob/dev/doc/lz4_Block_format.md):
+    //   token (1) | more literal length | literals | match offset (2) | more match length
+    // The token's high 4 bits are the number of literals and the low 4 bits the match length
+    // less LZ4_MIN_MATCH. A 15 in either means the length carries on in the following bytes,
+    // each of them added on until one isn't 255. The match is copied from offset bytes back
+    // in what has been written so far, a byte at a time because it can overlap itself
+    // (offset 1 repeats the last byte). The last sequence stops after its literals.
+
+    unsigned int start;
+    unsigned int token;
+    unsigned int length;
+    unsigned int offset;
+    unsigned int c;
+
+    start=out;
+    while(in<in_end)
+    {
+        token=GET8(in++);
+        length=token>>4;
+        if(length==15)
+        {
+            do
+            {
+                if(in>=in_end) return -1;
+                c=GET8(in++);
+                length+=c;
+            } while(c==255);
+        }
+        if((length>in_end-in) || (length>out_end-out)) return -1;
+        while(length--)
+        {
+            PUT8(out++,GET8(in++));
+        }
+        if(in==in_end) break;
+
+        if(in_end-in<2) return -1;
+        offset=GET8(in)|(GET8(in+1)<<8);
+        in+=2;
+        if((offset==0) || (offset>out-start)) return -1;
+        length=token&0xF;
+        if(length==15)
+        {
+            do
+            {
+                if(in>=in_end) return -1;
+                c=GET8(in++);
+                length+=c;
+            } while(c==255);
+        }
+        length+=LZ4_MIN_MATCH;
+        if(length>out_end-out) return -1;
+        while(length--)
+        {
+            PUT8(out,GET8(out-offset));
+            out++;
+        }
+    }
+    return out-start;
+}
+
+/// Tell the host the CRC32 of part of the program area. CRC_REQUEST has already been read.
+void report_crc()
+{
+    // Request:  address (4) | length (4) | CRC32 (4)
+    // Reply:    BIN_ACK | CRC32 of the memory (4)   or BIN_NAK if it isn't all in the program area
+    //
+    // The program area is zeroed whenever the board resets, so piterm --delta asks for the
+    // CRC32 of the last image it sent before it sends only what changed. If the answer
+    // doesn't match, the board lost that image and has to get all of the new one.
+
+    unsigned int address;
+    unsigned int length;
+    unsigned int crc;
+    unsigned int check;
+    unsigned int ignored;
+    unsigned int i;
+
+    crc=0xFFFFFFFF;
+    if(!(read_le(4,&address,&crc) && read_le(4,&length,&crc) && read_le(4,&check,&ignored)))
+    {
+        return;
+    }
+    if(((crc^0xFFFFFFFF)!=check) || (address<RPI_BOOT) || (address>=PROGRAM_END)
+        || (length>PROGRAM_END-address))
+    {
+        reject_frame();
+        return;
+    }
+    crc=0xFFFFFFFF;
+    for(i=0;i<length;i++)
+    {
+        crc=crc32_byte(crc,GET8(address+i));
+    }
+    crc^=0xFFFFFFFF;
+    put_char(BIN_ACK);
+    for(i=0;i<4;i++)
+    {
+        put_char((crc>>(i*8))&0xFF);
+    }
+}
+
+/// Switch to the baud rate the host asked for. BAUD_REQUEST has already been read.
+void negotiate_baud()
+{
+    // Request:  baud (4) | CRC32 (4)
+    // Reply:    BIN_ACK | actual baud (4)   or BIN_NAK if the rate can't be reached
+    //
+    // After an ACK both ends switch. The host sends baud_probe, we echo it back and the
+    // host answers with BIN_ACK. If anything goes wrong or takes longer than
+    // BAUD_TIMEOUT_US we go back to the old rate, and so does the host.
+
+    unsigned int baud;
+    unsigned int crc;
+    unsigned int check;
+    unsigned int ignored;
+    unsigned int divisor;
+    unsigned int old_divisor;
+    unsigned int actual;
+    unsigned int i;
+    int c;
+
+    crc=0xFFFFFFFF;
+    if(!(read_le(4,&baud,&crc) && read_le(4,&check,&ignored)))
+    {
+        return;
+    }
+    divisor=baud_divisor(baud);
+    if(((crc^0xFFFFFFFF)!=check) || (divisor==0))
+    {
+        reject_frame();
+        return;
+    }
+    actual=4*UART_CLOCK/divisor;
+    put_char(BIN_ACK);
+    for(i=0;i<4;i++)
+    {
+        put_char((actual>>(i*8))&0xFF);
+    }
+
+    old_divisor=get_baud_divisor();
+    set_baud_divisor(divisor);
+    for(i=0;i<BAUD_PROBE_LENGTH;i++)
+    {
+        c=get_char_timeout(BAUD_TIMEOUT_US);
+        if(c!=baud_probe[i]) break;
+    }
+    if(i==BAUD_PROBE_LENGTH)
+    {
+        for(i=0;i<BAUD_PROBE_LENGTH;i++)
+        {
+            put_char(baud_probe[i]);
+        }
+        if(get_char_timeout(BAUD_TIMEOUT_US)==BIN_ACK)
+        {
+            return;
+        }
+    }
+    // Whatever is still coming in was sent at the wrong rate, so make sure none of it
+    // (like a stray 'g') reaches load_program().
+    set_baud_divisor(old_divisor);
+    drain_input();
+}
 //-------------------------------------------------------------------------
 //-------------------------------------------------------------------------
 
@@ -18,6 +18,11 @@
 // Tx FIFO empty
 #define TX_FIFO_EMPTY (1<< 7)
 
+// The system timer's free running counter, ticks once per microsecond.
+// RPI_PERI_BASE_ADDR is really the GPIO block which is 0x200000 past the start of the peripherals
+// and the timer's CLO register is at peripherals + 0x3004.
+#define SYSTIMER_CLO ((volatile uint32_t*)(RPI_PERI_BASE_ADDR - 0x200000 + 0x3004))
+
 // Wait for space in the Tx FIFO
 void wait_for_tx_slot()
 {
@@ -158,6 +163,55 @@ void init_uart()
 					(1 << 0);      // enable UART
 }
 
+/// Returns the baud rate divisor for baud in 64ths, or 0 if it's too far off.
+extern uint32_t baud_divisor(uint32_t baud)
+{
+    uint32_t divisor;
+    uint32_t actual;
+    uint32_t error;
+
+    if (baud == 0)
+    {
+        return 0;
+    }
+    // Same formula as in init_uart() but keeping the fraction:
+    // BAUDDIV * 64 = UART_CLOCK * 64 / (16 * baud) = UART_CLOCK * 4 / baud, rounded
+    divisor = (4 * UART_CLOCK + baud / 2) / baud;
+    if (((divisor >> 6) == 0) || ((divisor >> 6) > 0xFFFF))
+    {
+        return 0;
+    }
+    actual = 4 * UART_CLOCK / divisor;
+    error = (actual > baud) ? (actual - baud) : (baud - actual);
+    // Anything more than 2% off won't work reliably
+    if (error * 50 > baud)
+    {
+        return 0;
+    }
+    return divisor;
+}
+
+/// Returns the divisor currently in use.
+extern uint32_t get_baud_divisor()
+{
+    return (uart[UART0_IBRD] << 6) | (uart[UART0_FBRD] & 0x3F);
+}
+
+/// Switch the UART to a new divisor from baud_divisor().
+extern void set_baud_divisor(uint32_t divisor)
+{
+    uint32_t control = uart[UART0_CR];
+
+    // The divisors can only be changed while the UART is disabled
+    wait_for_uart_idle();
+    uart[UART0_CR] = 0;
+    uart[UART0_IBRD] = divisor >> 6;
+    uart[UART0_FBRD] = divisor & 0x3F;
+    // The new divisors only take effect once LCRH has been written
+    uart[UART0_LCRH] = uart[UART0_LCRH];
+    uart[UART0_CR] = control;
+}
+
 /// Gets a single character from the UART port.
 extern char get_char()
 {
@@ -171,6 +225,27 @@ extern char get_char()
     return (char)(uart[UART0_DR] & 0xff);
 }
 
+/// Gets a single character from the UART port, or -1 if none arrives within timeout_us.
+extern int get_char_timeout(uint32_t timeout_us)
+{
+    uint32_t start = *SYSTIMER_CLO;
+
+    // Same as wait_for_rx_has_char() but keep an eye on the clock
+    while (((volatile uint32_t)uart[UART0_FR]) & RX_FIFO_EMPTY)
+    {
+        // Unsigned subtraction handles the counter wrapping around
+        if ((*SYSTIMER_CLO - start) >= timeout_us)
+        {
+            return -1;
+        }
+    }
+
+	// Do not remove!!! The RPi UART is a bit... lazy... 
+    delay(150);
+
+    return (int)(uart[UART0_DR] & 0xff);
+}
+
 /// Writes a single character to the uart port.
 extern void put_char(char c)
 {
@@ -1,12 +1,14 @@
 #
 # This script generates a Makefile that will run the arm compiler on your system.
 # 1. Make sure you've downloaded AND EXTRACTED the compiler.
-# 2. Download this file, name it "genmake.py" and put it in your project directory.
+# 2. Download this file and toolchain.py, and put them both in your project directory.
 # 3. Open a command window (Powershell, Cygwin, Bash, Bash on Windows, etc.) and `cd` to your project directory.
 # 4. Run `python genmake.py <directory_of_compiler>`
 #    If you're having trouble try "~". That will search your home directory.
 #    Remember that to use the C:\ drive in Cygwin it's "/cygdrive/c/" and in Bash on Windows it's "/mnt/c".
 #    If all else fails you can just use "/" or "C:/" but that will take a while.
+#    The compiler that was found is remembered in .toolchain.json, so the next run doesn't have to search again.
+#    Use --list to see every compiler that was found and --rescan to search again anyway.
 # 5. genmake will generate your new makefile and name it "Makefile"
 # 6. Compile your code by running:
 #    `make all`
@@ -15,55 +17,104 @@
 from __future__ import print_function
 import sys
 import argparse
-import fnmatch
 import os
 import os.path
 import datetime
-if sys.version_info < (3, 2):
-    import urllib2 as liburl
-else:
-    import urllib.request as liburl
+import io
+import toolchain
 
 LN = '\n'
-GCC_PATTERN = 'arm-*-gcc*'
 TEMPLATE_FILENAME = 'Makefile-template'
 TEMPLATE_URL = 'https://raw.githubusercontent.com/Bindernews/baremetal-pi-tools/master/Makefile-template'
 TEMPLATE_STRING = '{{INSERT_CONFIGURATION_SETTINGS}}'
+# A downloaded template is kept here along with its ETag, so it's only downloaded again when it changes
+TEMPLATE_CACHE = os.path.join(toolchain.CACHE_DIR, TEMPLATE_FILENAME)
+TEMPLATE_ETAG = TEMPLATE_CACHE + '.etag'
+DATE_LINE = '# Generated on '
 
-def get_url_as_string(url):
-    with liburl.urlopen(url, cadefault=True) as response:
-        return str(response.read(), 'utf-8')
+def _read_file(path):
+    try:
+        with open(path, 'r') as fd:
+            return fd.read()
+    except (IOError, OSError):
+        return None
+
+def fetch_cached(url, cache_path, etag_path, revalidate=False):
+    """ Returns the text at url, from cache_path if it has been downloaded before.
+    With revalidate the server is asked whether it changed since, and only sends it again if it did.
+    """
+    cached = _read_file(cache_path)
+    if cached is not None and not revalidate:
+        return cached
+    import urllib.error
+    import urllib.request
+
+    headers = {}
+    etag = _read_file(etag_path)
+    if cached is not None and etag:
+        headers['If-None-Match'] = etag.strip()
+    print('Downloading Makefile template...' if cached is None else 'Checking for a newer Makefile template...')
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, headers=headers)) as response:
+            text = str(response.read(), 'utf-8')
+            etag = response.headers.get('ETag')
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            print('The cached Makefile template is up to date')
+            return cached
+        raise
+    except urllib.error.URLError as e:
+        if cached is None:
+            raise
+        print('Unable to check for a newer Makefile template ({}), using the cached one'.format(e.reason))
+        return cached
+    if toolchain.save_cache(cache_path, text):
+        toolchain.save_cache(etag_path, etag or '')
+    return text
+
+def write_if_changed(path, content):
+    """ Writes content to path unless it's already there, not counting the date it was generated.
+    Leaving an unchanged file alone means make doesn't see a new Makefile. Returns True if it was written.
+    """
+    def undated(text):
+        return [line for line in text.splitlines() if not line.startswith(DATE_LINE)]
+    old = _read_file(path)
+    if old is not None and undated(old) == undated(content):
+        return False
+    with open(path, 'w') as fd:
+        fd.write(content)
+    return True
 
 class MakefileGen:
-    def __init__(self, guess_dir, name=None, force_download=False):
+    def __init__(self, guess_dir, name=None, force_download=False, use_cache=False):
         self.guess_path = guess_dir
         self.name = name
         self.gcc_path = None
+        self.toolchain = None
         self.force_download = force_download
+        self.use_cache = use_cache
 
-    def locate(self):
+    def locate(self, use_index=True):
         """ Locate possible compilers. Returns True if found, False if not. """
-        for root, dirs, files in os.walk(self.guess_path):
-            valid = fnmatch.filter(files, GCC_PATTERN)
-            if len(valid) > 0:
-                self.gcc_path = os.path.abspath(os.path.join(root, valid[0]))
-                self._determine_settings()
-                return True
+        self.toolchain = toolchain.resolve(self.guess_path, use_index)
+        if self.toolchain:
+            self._determine_settings()
+            return True
         return False
 
     def _determine_settings(self):
-        # Do path parsing to get necessary information
-        bin_dir, gcc_file = os.path.split(self.gcc_path)
-        self.compiler_dir = bin_dir[:bin_dir.rfind(os.sep)]
-        self.arm_gnu = gcc_file[:gcc_file.rfind('eabi') + 4]
-        self.has_exe = gcc_file.find('.exe') != -1
-        self.is_cygwin = os.path.exists('/cygdrive/')
-        self.is_unix = (not self.has_exe) or self.is_cygwin
+        # Everything about the compiler comes from toolchain.py, so genninja.py sees it the same way
+        tc = self.toolchain
+        self.gcc_path = tc.gcc_path
+        self.compiler_dir = tc.compiler_dir
+        self.arm_gnu = tc.prefix
+        self.has_exe = tc.has_exe
+        self.is_cygwin = tc.is_cygwin
+        self.is_unix = tc.is_unix
 
         # Determine the name of the compiler
         if not self.name:
-            nameIdx1 = self.compiler_dir.rfind(os.sep) + 1
-            self.name = self.compiler_dir[nameIdx1:]
+            self.name = tc.name
 
     def _get_template(self):
         """ Try to find the template file, download it if necessary. """
@@ -75,9 +126,8 @@ class MakefileGen:
             if os.path.exists(template):
                 with open(template, 'r') as fd:
                     return fd.read()
-        # Otherwise download from GitHub
-        print('Downloading Makefile template...')
-        return get_url_as_string(TEMPLATE_URL)
+        # Otherwise use the copy downloaded from GitHub, checking it's the latest if we're forcing download
+        return fetch_cached(TEMPLATE_URL, TEMPLATE_CACHE, TEMPLATE_ETAG, revalidate=self.force_download)
 
     def _make_settings_string(self):
         s = ''
@@ -86,6 +136,9 @@ class MakefileGen:
         s += 'SUFFIX ?= ' + ('.exe' if self.has_exe else '') + LN
         # s += 'CYGWIN ?= ' + ('true' if self.is_cygwin else 'false') + LN
         s += 'UNIX ?= ' + ('true' if self.is_unix else 'false') + LN
+        if self.use_cache:
+            pydir = os.path.dirname(os.path.abspath(__file__))
+            s += 'CCACHE ?= "' + self.fix_slash(sys.executable) + '" "' + self.fix_slash(os.path.join(pydir, 'objcache.py')) + '"' + LN
         return s
     
     def generate_full(self, out):
@@ -97,7 +150,7 @@ class MakefileGen:
         s = ''
         s += ('#' * 60) + LN
         s += '# Makefile generated by genmake.py' + LN
-        s += '# Generated on ' + datetime.datetime.now().isoformat() + LN
+        s += DATE_LINE + datetime.datetime.now().isoformat() + LN
         s += ('#' * 60) + LN
         s += LN
         s += self._make_settings_string()
@@ -116,37 +169,50 @@ def downloadFile(url, dest):
 
 def main(argv):
     parser = argparse.ArgumentParser()
-    parser.add_argument('directory', help='The directory where Yagarto or Linaro is installed.')
+    parser.add_argument('directory', nargs='*', help='The directories where Yagarto or Linaro might be installed, more can be given in the ' + toolchain.TOOLCHAIN_PATH_VAR + ' environment variable.')
     parser.add_argument('--drive', metavar='makefile', type=str, default=None, help='The generated makefile will only contain settings and will invoke the given makefile to do the actual work (optional)')
     parser.add_argument('-o', metavar='output', type=str, default=None, help='The name of the generated makefile (optional)')
-    parser.add_argument('--download', action='store_true', help='forces downloading the most recent template from the internet')
+    parser.add_argument('--download', action='store_true', help='checks for a newer template on the internet, instead of using the local or cached one')
+    parser.add_argument('--cache', action='store_true', help='run compiles through objcache.py so unchanged sources are restored from a cache')
+    parser.add_argument('--list', action='store_true', help='list every compiler found and exit, the one that would be used is marked with *')
+    parser.add_argument('--rescan', action='store_true', help='search for the compiler again instead of using the one in ' + toolchain.CONFIG_FILE)
     args = parser.parse_args(argv)
 
     try:
         # Check args
         if args.download and args.drive:
             raise Exception('Cannot specify both --download and --drive')
-        # Normalize the guess directory and expand ~ if they're just guessing
-        guess_dir = os.path.normpath(os.path.expanduser(args.directory + os.sep))
-        print('Searching ' + guess_dir + ' for compiler')
-        # If they gave us a bad directory, they might be using Cygwin
-        if not os.path.exists(guess_dir):
-            raise Exception(guess_dir + ' not found. Are you trying to use Windows Python in Cygwin?')
+        if not args.directory and not os.environ.get(toolchain.TOOLCHAIN_PATH_VAR):
+            raise Exception('No directory given to search for the compiler')
+        # Normalize the guess directories and expand ~ if they're just guessing
+        guess_dirs = [os.path.normpath(os.path.expanduser(d + os.sep)) for d in args.directory]
+        for guess_dir in guess_dirs:
+            print('Searching ' + guess_dir + ' for compiler')
+            # If they gave us a bad directory, they might be using Cygwin
+            if not os.path.exists(guess_dir):
+                raise Exception(guess_dir + ' not found. Are you trying to use Windows Python in Cygwin?')
         # Now search for the compiler
-        gen = MakefileGen(args.directory, force_download=args.download)
-        if not gen.locate():
+        gen = MakefileGen(guess_dirs, force_download=args.download, use_cache=args.cache)
+        if args.list:
+            # Listed without running any of them, so one that doesn't work still shows up
+            toolchain.print_compilers(guess_dirs, toolchain.chosen_compiler(guess_dirs, not args.rescan))
+            return
+        found = gen.locate(use_index=not args.rescan)
+        if not found:
             raise Exception('Unable to locate compiler')
-        print('Detected compiler: ' + gen.name)
+        print('Detected compiler: {} ({} {})'.format(gen.name, gen.toolchain.machine, gen.toolchain.version))
         # Output the customized makefile.
+        output = io.StringIO()
         if args.drive:
             outfile = args.o or (gen.name + '.mk')
-            with open(outfile, 'w') as fd:
-                gen.generate_driver(fd, args.drive)            
+            gen.generate_driver(output, args.drive)
         else:          
             outfile = args.o or 'Makefile'
-            with open(outfile, 'w') as fd:
-                gen.generate_full(fd)
-        print('Success! Wrote to ' + outfile)
+            gen.generate_full(output)
+        if write_if_changed(outfile, output.getvalue()):
+            print('Success! Wrote to ' + outfile)
+        else:
+            print(outfile + ' is up to date')
     except BaseException as e:
         print('ERROR: ' + str(e))
         exit(1)
@@ -2,13 +2,31 @@
 
 from __future__ import print_function
 import argparse
-import fnmatch
+import io
+import json
 import os
 import os.path
+import re
 import sys
+import toolchain
+from collections import OrderedDict
 
-GCC_PATTERN = 'arm-*-gcc*'
 DEFAULT_FILE = 'build.ninja'
+# Source file extensions and the rule that builds each of them
+SOURCE_EXTENSIONS = {'.c': 'cc', '.cpp': 'cxx', '.s': 'as', '.S': 'cpp_as'}
+COMPILE_RULES = ('cc', 'cxx', 'as', 'cpp_as')
+
+# Build profiles. release is everything, dev leaves out the assembler listings (build/*.o.lst
+# and kernel7.lst) which are only there for reading, not for running.
+PROFILES = ['release', 'dev']
+DEFAULT_PROFILE = 'release'
+LISTING_FLAGS = '-Wa,-adhln > ${out}.lst'
+
+# ninja keeps the start and end time of every command it runs in $builddir/.ninja_log.
+# --report reads it, and remembers compile times per profile here to work out what listings cost.
+NINJA_LOG = '.ninja_log'
+PROFILE_HISTORY = '.genninja_profiles.json'
+REPORT_TOP = 10
 
 # These constants get added to the build file pretty much verbatim
 WARN_FLAGS = "-Wall -Wextra -Wshadow -Wcast-align -Wwrite-strings -Wredundant-decls -Winline -Wno-attributes \
@@ -20,78 +38,221 @@ WARN_FLAGS = "-Wall -Wextra -Wshadow -Wcast-align -Wwrite-strings -Wredundant-de
 INCLUDES = "-I include"
 DEPEND_FLAGS = "-MD -MP"
 BASE_FLAGS = "-pedantic -pedantic-errors -nostdlib -nostartfiles -ffreestanding -nodefaultlibs"
-PI2_FLAGS = "-O2 -mfpu=neon-vfpv4 -march=armv7-a -mtune=cortex-a7  -DPI2 -mfloat-abi=hard " + BASE_FLAGS
-PI3_FLAGS = "-O2 -mfpu=neon-vfpv4 -march=armv8-a -mtune=cortex-a53 -DPI2 -mfloat-abi=hard " + BASE_FLAGS
 
+# The build matrix. Every board is built at every optimization level asked for, each one into
+# its own build/<board>-<opt> and bin/<board>-<opt> so they can all be built at once and
+# switching between them doesn't rebuild anything. A single configuration builds straight into
+# build and bin.
+BOARD_FLAGS = OrderedDict([
+    ('pi2', "-mfpu=neon-vfpv4 -march=armv7-a -mtune=cortex-a7  -DPI2 -mfloat-abi=hard"),
+    ('pi3', "-mfpu=neon-vfpv4 -march=armv8-a -mtune=cortex-a53 -DPI2 -mfloat-abi=hard"),
+])
+OPT_FLAGS = OrderedDict([
+    ('release', "-O2"),
+    ('debug', "-Og -g"),
+])
+DEFAULT_BOARD = 'pi3'
+DEFAULT_OPT = 'release'
+
+def config_flags(board, opt):
+    """ Returns the compiler flags for one board at one optimization level. """
+    return ' '.join([OPT_FLAGS[opt], BOARD_FLAGS[board], BASE_FLAGS])
+
+def board_cpu(board):
+    """ Returns the CPU a board's flags tune for. """
+    return re.search(r'-mtune=(\S+)', BOARD_FLAGS[board]).group(1)
+
+PI2_FLAGS = config_flags('pi2', 'release')
+PI3_FLAGS = config_flags('pi3', 'release')
+
+
+def escape_path(word):
+    return word.replace('$ ', '$$ ').replace(' ', '$ ').replace(':', '$:')
+
+def as_list(value):
+    if value is None:
+        return []
+    if isinstance(value, list):
+        return value
+    return [value]
+
+class MiniWriter:
+    """ Enough of ninja_syntax.Writer for generate(), used when ninja_syntax isn't installed.
+    Same output except long lines aren't wrapped, which ninja doesn't mind.
+    """
+    def __init__(self, output):
+        self.output = output
+
+    def newline(self):
+        self.output.write('\n')
+
+    def comment(self, text):
+        self.output.write('# ' + text + '\n')
+
+    def variable(self, key, value, indent=0):
+        if value is None:
+            return
+        if isinstance(value, list):
+            value = ' '.join(filter(None, value))
+        self.output.write('  ' * indent + key + ' = ' + value + '\n')
 
-def install_package(package):
-    import pip, site
-    exitval = pip.main(['install', '--user', package])  # install package to user's site-packages
-    site.main() # Reload sys.path to include the user's site-packages
-    return exitval == 0
+    def rule(self, name, command, description=None, depfile=None, generator=False, pool=None,
+            restat=False, rspfile=None, rspfile_content=None, deps=None):
+        self.output.write('rule ' + name + '\n')
+        self.variable('command', command, indent=1)
+        self.variable('description', description, indent=1)
+        self.variable('depfile', depfile, indent=1)
+        if generator:
+            self.variable('generator', '1', indent=1)
+        self.variable('pool', pool, indent=1)
+        if restat:
+            self.variable('restat', '1', indent=1)
+        self.variable('rspfile', rspfile, indent=1)
+        self.variable('rspfile_content', rspfile_content, indent=1)
+        self.variable('deps', deps, indent=1)
 
-try:
-    import ninja_syntax
-except ImportError:
-    install_package('ninja_syntax')
-    import ninja_syntax
+    def build(self, outputs, rule, inputs=None, implicit=None, order_only=None, variables=None,
+            implicit_outputs=None, pool=None):
+        outputs = [escape_path(x) for x in as_list(outputs)]
+        all_inputs = [escape_path(x) for x in as_list(inputs)]
+        implicit = [escape_path(x) for x in as_list(implicit)]
+        order_only = [escape_path(x) for x in as_list(order_only)]
+        implicit_outputs = [escape_path(x) for x in as_list(implicit_outputs)]
+        if implicit:
+            all_inputs += ['|'] + implicit
+        if order_only:
+            all_inputs += ['||'] + order_only
+        if implicit_outputs:
+            outputs += ['|'] + implicit_outputs
+        self.output.write('build ' + ' '.join(outputs) + ': ' + ' '.join([rule] + all_inputs) + '\n')
+        if pool is not None:
+            self.variable('pool', pool, indent=1)
+        if variables:
+            for key, value in sorted(variables.items()):
+                self.variable(key, value, indent=1)
+        return outputs
+
+    def include(self, path):
+        self.output.write('include ' + path + '\n')
+
+    def default(self, paths):
+        self.output.write('default ' + ' '.join(as_list(paths)) + '\n')
+
+    def close(self):
+        self.output.close()
+
+def ninja_writer(output):
+    """ Returns a ninja_syntax.Writer for output, or a MiniWriter if ninja_syntax isn't installed. """
+    try:
+        import ninja_syntax
+    except ImportError:
+        return MiniWriter(output)
+    return ninja_syntax.Writer(output)
 
 class NinjaGen:
-    def __init__(self, guess_dir, include_file):
+    def __init__(self, guess_dir, include_file, use_cache=False, profile=DEFAULT_PROFILE, boards=None, opts=None):
         self.guess_path = guess_dir
         self.include_file = include_file
+        self.use_cache = use_cache
+        self.profile = profile
+        # Giving the same board twice shouldn't build it twice
+        self.boards = list(OrderedDict.fromkeys(boards or [DEFAULT_BOARD]))
+        self.opts = list(OrderedDict.fromkeys(opts or [DEFAULT_OPT]))
         self.gcc_path = None
+        self.toolchain = None
         self.build_dir = 'build'
         self.output_dir = 'bin'
         self.source_dir = 'source'
 
-    def locate(self):
+    def locate(self, use_index=True):
         """ Locate possible compilers. Returns True if found, False if not. """
-        for root, dirs, files in os.walk(self.guess_path):
-            valid = fnmatch.filter(files, GCC_PATTERN)
-            if len(valid) > 0:
-                self.gcc_path = os.path.abspath(os.path.join(root, valid[0]))
-                self._determine_settings()
-                return True
+        self.toolchain = toolchain.resolve(self.guess_path, use_index)
+        if self.toolchain:
+            self._determine_settings()
+            return True
         return False
 
     def _determine_settings(self):
-        # Do path parsing to get necessary information
-        self.bin_dir, gcc_file = os.path.split(self.gcc_path)
-        self.compiler_dir = self.bin_dir[:self.bin_dir.rfind(os.sep)]
-        self.arm_gnu = gcc_file[:gcc_file.rfind('eabi-') + 5]
-        self.has_exe = gcc_file.find('.exe') != -1
-        self.is_cygwin = os.path.exists('/cygdrive/')
-        self.is_unix = sys.platform != 'win32'
-        self.name = os.path.basename(self.compiler_dir)
+        # Everything about the compiler comes from toolchain.py, so genmake.py sees it the same way
+        tc = self.toolchain
+        self.gcc_path = tc.gcc_path
+        self.bin_dir = tc.bin_dir
+        self.compiler_dir = tc.compiler_dir
+        self.arm_gnu = tc.prefix + '-'
+        self.has_exe = tc.has_exe
+        self.is_cygwin = tc.is_cygwin
+        self.is_unix = tc.is_unix
+        self.name = tc.name
+
+    def check_boards(self):
+        """ Raises an Exception if the compiler can't tune for one of the boards. """
+        for board in self.boards:
+            cpu = board_cpu(board)
+            if not self.toolchain.supports_cpu(cpu):
+                raise Exception('{} {} can\'t build for {}, it doesn\'t know -mtune={}'.format(
+                    self.name, self.toolchain.version, board, cpu))
 
     def get_sources(self, directory):
-        """ Returns an array of .c and .s files in the given directory. """
-        results = []
-        for entry in os.listdir(directory):
-            path = os.path.join(directory, entry)
-            if os.path.isfile(path) and (path.endswith('.c') or path.endswith('.s')):
-                results.append(path)
-        return results
-
-    def to_obj(self, path):
-        fname = os.path.basename(path)
-        root, ext = os.path.splitext(fname)
-        return os.path.join(self.build_dir, root + '.o')
-    
+        """ Returns (sources, directories) for every source file below the given directory.
+        directories lists the directory itself and each one below it, so the build file can be
+        regenerated when a file is added to or removed from any of them.
+        """
+        sources = []
+        directories = []
+        for root, dirs, files in os.walk(directory):
+            # Sort so the same tree always gives the same build file
+            dirs.sort()
+            directories.append(root)
+            for entry in sorted(files):
+                if os.path.splitext(entry)[1] in SOURCE_EXTENSIONS:
+                    sources.append(os.path.join(root, entry))
+        return sources, directories
+
+    def configs(self):
+        """ Returns (name, board, opt) for every configuration in the build matrix. name is None
+        if there is only one, which then builds straight into build_dir and output_dir.
+        """
+        configs = [(board, opt) for board in self.boards for opt in self.opts]
+        if len(configs) == 1:
+            return [(None,) + configs[0]]
+        return [(board + '-' + opt, board, opt) for board, opt in configs]
+
+    def to_obj(self, path, build_dir=None):
+        """ Returns the object file for a source file, mirroring the source tree under build_dir. """
+        rel = os.path.relpath(path, self.source_dir)
+        root, ext = os.path.splitext(rel)
+        return os.path.join(build_dir or self.build_dir, root + '.o')
+
     def generate(self, outfile):
-        """ Writes an appropriate ninja build file to output. """
+        """ Writes an appropriate ninja build file to outfile.
+        The file is only written if it would change, so ninja doesn't see a new manifest (and
+        restat everything) after a regenerate that found nothing new. Returns True if it was written.
+        """
         # Collect the list of source files BEFORE we overwrite the build script in case something goes wrong.
         # We NEVER write the file until we're sure we can finish it.
-        source_list = self.get_sources(self.source_dir)
+        source_list, source_dirs = self.get_sources(self.source_dir)
 
-        # Everything past this point is string manipulation
-        output = open(outfile, 'w')
-        n = ninja_syntax.Writer(output)
-        
+        output = io.StringIO()
+        self._write(ninja_writer(output), outfile, source_list, source_dirs)
+        content = output.getvalue()
+
+        try:
+            with open(outfile, 'r') as fd:
+                if fd.read() == content:
+                    return False
+        except (IOError, OSError):
+            pass
+        with open(outfile, 'w') as fd:
+            fd.write(content)
+        return True
+
+    def _write(self, n, outfile, source_list, source_dirs):
+        """ Writes the build graph to the ninja writer n. """
         # these change ninja functionality
         n.variable('ninja_required_version', '1.7')
         n.variable('builddir', 'build')
+        # Only read by genninja.py --report
+        n.variable('profile', self.profile)
         n.newline()
 
         # Add a bunch of variables which we will use later
@@ -102,29 +263,66 @@ class NinjaGen:
         n.variable('warnflags', WARN_FLAGS)
         n.variable('includes', INCLUDES)
         n.variable('dependflags', DEPEND_FLAGS)
-        n.variable('baseflags', PI3_FLAGS)
-        n.variable('cflags', '$baseflags $includes $dependflags $warnflags')
+        configs = self.configs()
+        if len(configs) == 1:
+            n.variable('baseflags', config_flags(configs[0][1], configs[0][2]))
+            n.variable('cflags', '$baseflags $includes $dependflags $warnflags')
+        else:
+            # Top level variables are expanded as they're read, so each configuration gets its own
+            # cflags which its build statements bind cflags to
+            for name, board, opt in configs:
+                suffix = '_' + name.replace('-', '_')
+                n.variable('baseflags' + suffix, config_flags(board, opt))
+                n.variable('cflags' + suffix, '$baseflags{} $includes $dependflags $warnflags'.format(suffix))
 
         # Next we add a rule to regenerate 
         regen_cmd = '$python $script_dir/genninja.py $bindir -o "{}"'.format(outfile)
         # Handle the include file if the user specified it
         if self.include_file:
             regen_cmd += ' -i "{}"'.format(self.include_file)
-        n.rule('regenerate', description='Regenerate build script', command=regen_cmd)
+        if self.use_cache:
+            regen_cmd += ' --cache'
+        if self.profile != DEFAULT_PROFILE:
+            regen_cmd += ' --profile ' + self.profile
+        if self.boards != [DEFAULT_BOARD]:
+            regen_cmd += ''.join(' --boards ' + board for board in self.boards)
+        if self.opts != [DEFAULT_OPT]:
+            regen_cmd += ''.join(' --opts ' + opt for opt in self.opts)
+        # restat because an unchanged build file isn't rewritten, generator so `ninja -t clean` leaves it alone
+        n.rule('regenerate', description='Regenerate build script', command=regen_cmd,
+            generator=True, restat=True)
         n.build('regen', 'regenerate')
+        # Adding or removing a file changes the modification time of its directory, so depending on
+        # every source directory regenerates the build file whenever the list of sources changes.
+        regen_deps = ['$script_dir/genninja.py', '$script_dir/toolchain.py'] + [fslash(d) for d in source_dirs]
+        if self.include_file:
+            regen_deps.append(self.include_file)
+        n.build(outfile, 'regenerate', implicit=regen_deps)
         n.newline()
 
         # Get the execution path for the binaries
         binaries = {}
         shell_prefix = '' if self.is_unix else 'cmd /c '
         exe_suffix = '.exe' if self.has_exe else ''
-        for name in ['gcc', 'as', 'ld', 'objcopy', 'objdump']:
+        for name in ['gcc', 'g++', 'as', 'ld', 'objcopy', 'objdump']:
             binaries[name] = shell_prefix + '$bindir/' + self.arm_gnu + name + exe_suffix
+        # Compiles go through objcache.py which skips the compiler when it has seen the same input before
+        if self.use_cache:
+            n.variable('objcache', '$python $script_dir/objcache.py')
+            for name in ['gcc', 'g++']:
+                binaries[name] = shell_prefix + '$objcache $bindir/' + self.arm_gnu + name + exe_suffix
         # Now add build rules
+        listings = self.profile != 'dev'
+        listing = ' ' + LISTING_FLAGS if listings else ''
         n.rule('cc', description='Compile C',
-            command='{} $cflags -c $in -o $out -Wa,-adhln > ${{out}}.lst'.format(binaries['gcc']))
+            command='{} $cflags -c $in -o $out{}'.format(binaries['gcc'], listing))
+        n.rule('cxx', description='Compile C++',
+            command='{} $cflags -c $in -o $out{}'.format(binaries['g++'], listing))
         n.rule('as', description='Assemble',
             command='{} $in -o $out'.format(binaries['as']))
+        # .S files go through the C preprocessor first
+        n.rule('cpp_as', description='Assemble',
+            command='{} $cflags -c $in -o $out'.format(binaries['gcc']))
         n.rule('ld', description='Link',
             command='{} --no-undefined $in -Map $mapfile -o $out -T $linkfile'.format(binaries['ld']))
         n.rule('objcopy', description='objcopy',
@@ -133,34 +331,51 @@ class NinjaGen:
             command='{} -d $in > $out'.format(binaries['objdump']))
         n.newline()
 
-        # Build commands for each source file
-        obj_list = []
-        for source in source_list:
-            obj = self.to_obj(source)
-            obj_list.append(obj)
-            if source.endswith('.s'):
-                n.build(obj, 'as', source)
-            else:
-                # Compiling also generates .lst and .d files so list those as side-effect outputs
-                implicit = [obj + '.lst', obj.replace('.o', '.d')]
-                n.build(obj, 'cc', source, implicit_outputs=implicit)
-
-        # Add rules for other targets
-        target_img = os.path.join(self.output_dir, 'kernel7.img')
-        target_hex = os.path.join(self.output_dir, 'kernel7.hex')
-        target_lst = os.path.join(self.output_dir, 'kernel7.lst')
-        target_elf = os.path.join(self.build_dir, 'output.elf')
-        target_map = os.path.join(self.output_dir, 'kernel7.map')
-        
-        n.build(target_elf, 'ld', obj_list,
-            variables={ 'linkfile': 'kernel_c.ld', 'mapfile': target_map },
-            implicit_outputs=['$mapfile'])
-        n.build(target_lst, 'objdump', target_elf)
-        n.build(target_img, 'objcopy', target_elf, variables={ 'format': 'binary' })
-        n.build(target_hex, 'objcopy', target_elf, variables={ 'format': 'ihex' })
-
-        # Default "all" target
-        n.build('all', 'phony', [target_img, target_hex, target_lst, target_elf])
+        # Build commands for each source file, and the kernel, for each configuration
+        all_targets = []
+        for name, board, opt in configs:
+            build_dir = os.path.join(self.build_dir, name) if name else self.build_dir
+            output_dir = os.path.join(self.output_dir, name) if name else self.output_dir
+            flags = { 'cflags': '$cflags_' + name.replace('-', '_') } if name else None
+            obj_list = []
+            for source in source_list:
+                obj = self.to_obj(source, build_dir)
+                obj_list.append(obj)
+                rule = SOURCE_EXTENSIONS[os.path.splitext(source)[1]]
+                if rule == 'as':
+                    n.build(obj, 'as', source)
+                elif rule == 'cpp_as':
+                    n.build(obj, 'cpp_as', source, implicit_outputs=[obj[:-2] + '.d'], variables=flags)
+                else:
+                    # Compiling also generates .lst and .d files so list those as side-effect outputs
+                    implicit = ([obj + '.lst'] if listings else []) + [obj[:-2] + '.d']
+                    n.build(obj, rule, source, implicit_outputs=implicit, variables=flags)
+
+            # Add rules for other targets
+            target_img = os.path.join(output_dir, 'kernel7.img')
+            target_hex = os.path.join(output_dir, 'kernel7.hex')
+            target_lst = os.path.join(output_dir, 'kernel7.lst')
+            target_elf = os.path.join(build_dir, 'output.elf')
+            target_map = os.path.join(output_dir, 'kernel7.map')
+
+            n.build(target_elf, 'ld', obj_list,
+                variables={ 'linkfile': 'kernel_c.ld', 'mapfile': target_map },
+                implicit_outputs=['$mapfile'])
+            n.build(target_lst, 'objdump', target_elf)
+            n.build(target_img, 'objcopy', target_elf, variables={ 'format': 'binary' })
+            n.build(target_hex, 'objcopy', target_elf, variables={ 'format': 'ihex' })
+
+            # piterm encodes kernel7.img itself so the hex file is only built on request,
+            # and so is kernel7.lst for dev builds.
+            targets = [target_img, target_lst, target_elf] if listings else [target_img, target_elf]
+            if name:
+                # A shortcut for building just this configuration, e.g. `ninja pi2-debug`
+                n.build(name, 'phony', targets)
+                n.newline()
+            all_targets += targets
+
+        # Default "all" target builds every configuration
+        n.build('all', 'phony', all_targets)
         n.default('all')
         n.newline()
 
@@ -178,40 +393,257 @@ class NinjaGen:
         if self.include_file:
             n.include(self.include_file)
 
-        # Close the file when we're done
-        n.close()
 
 def fslash(s):
     return s.replace('\\', '/')
 
+def split_ninja(line):
+    """ Splits a line of a ninja file into words, undoing $ escapes. A ':' on its own separates
+    a build statement's outputs from its rule and inputs, an escaped one ('$:') is part of a path.
+    """
+    words = []
+    word = ''
+    i = 0
+    while i < len(line):
+        c = line[i]
+        if c == '$' and i + 1 < len(line) and line[i + 1] in ' :$':
+            word += line[i + 1]
+            i += 2
+            continue
+        if c == ' ' or (c == ':' and ':' not in words):
+            if word:
+                words.append(word)
+            if c == ':':
+                words.append(':')
+            word = ''
+        else:
+            word += c
+        i += 1
+    if word:
+        words.append(word)
+    return words
+
+def read_edges(ninja_file):
+    """ Returns ({output: (rule, explicit inputs, all inputs)}, {top level variable: value})
+    for the build statements in a ninja file. Order-only inputs are left out.
+    """
+    with open(ninja_file, 'r') as f:
+        text = f.read().replace('$\n', '')
+    edges = {}
+    variables = {}
+    for line in text.splitlines():
+        if line.startswith('build '):
+            words = split_ninja(line[len('build '):])
+            colon = words.index(':')
+            outputs = [w for w in words[:colon] if w != '|']
+            rule = words[colon + 1]
+            inputs = words[colon + 2:]
+            if '||' in inputs:
+                inputs = inputs[:inputs.index('||')]
+            explicit = inputs[:inputs.index('|')] if '|' in inputs else inputs
+            for output in outputs:
+                edges[output] = (rule, explicit, [i for i in inputs if i != '|'])
+        elif line and not line[0].isspace() and ' = ' in line:
+            key, value = line.split(' = ', 1)
+            variables[key] = value
+    return edges, variables
+
+def read_ninja_log(path):
+    """ Returns the commands ninja ran in its most recent build as a list of
+    (start seconds, end seconds, [outputs]). A command with several outputs gets one line
+    per output in the log, they are put back together here.
+    """
+    entries = []
+    with open(path, 'r') as f:
+        header = f.readline()
+        if not header.startswith('# ninja log v'):
+            raise Exception(path + ' is not a ninja log')
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) >= 5:
+                entries.append((int(fields[0]), int(fields[1]), fields[3], fields[4]))
+    # Times count from the start of each build, so a new build starts wherever they go back
+    # down. Older builds' entries are kept until ninja tidies the log up.
+    last = 0
+    for i in range(1, len(entries)):
+        if entries[i][1] < entries[i - 1][1]:
+            last = i
+    commands = {}
+    for start, end, output, command_hash in entries[last:]:
+        commands.setdefault((start, end, command_hash), []).append(output)
+    return sorted((start / 1000.0, end / 1000.0, outputs) for (start, end, _), outputs in commands.items())
+
+def critical_path(commands, edges):
+    """ Returns the chain of commands that the build had to wait for one after another, as
+    (seconds, [(output, rule, seconds), ...]). Only commands that ran count, anything else was
+    already up to date.
+    """
+    ran = {}
+    for start, end, outputs in commands:
+        for output in outputs:
+            ran[output] = (outputs[0], end - start)
+    longest = {}
+
+    def visit(output):
+        first, seconds = ran[output]
+        if first not in longest:
+            longest[first] = (seconds, [])
+            best = (0, [])
+            for dep in edges.get(first, (None, [], []))[2]:
+                if dep in ran and ran[dep][0] != first:
+                    best = max(best, visit(dep), key=lambda item: item[0])
+            longest[first] = (best[0] + seconds, best[1] + [(first, edges.get(first, ('?',))[0], seconds)])
+        return longest[first]
+
+    paths = [visit(output) for output in ran]
+    return max(paths, key=lambda item: item[0]) if paths else (0, [])
+
+def compile_times(commands, edges):
+    """ Returns {object file: seconds} for the compile commands among commands. """
+    times = {}
+    for start, end, outputs in commands:
+        rule = edges.get(outputs[0], (None,))[0]
+        if rule in COMPILE_RULES:
+            times[outputs[0]] = end - start
+    return times
+
+def listing_cost(history, edges):
+    """ Returns (compiles compared, seconds with listings, seconds without) for the objects built
+    by both profiles, or None if there aren't any yet.
+    """
+    release = history.get('release', {})
+    dev = history.get('dev', {})
+    common = [obj for obj in release if obj in dev and edges.get(obj, (None,))[0] in ('cc', 'cxx')]
+    if not common:
+        return None
+    return len(common), sum(release[obj] for obj in common), sum(dev[obj] for obj in common)
+
+def report(ninja_file):
+    """ Prints where the time went in the last build of ninja_file. """
+    edges, variables = read_edges(ninja_file)
+    build_dir = variables.get('builddir', '.')
+    profile = variables.get('profile', DEFAULT_PROFILE)
+    log_path = os.path.join(build_dir, NINJA_LOG)
+    if not os.path.exists(log_path):
+        raise Exception(log_path + ' not found, run ninja first')
+    # Name each command after an output the build file knows about (some outputs are variables)
+    commands = [(start, end, sorted(outputs, key=lambda output: output not in edges))
+        for start, end, outputs in read_ninja_log(log_path)]
+    if not commands:
+        print('ninja had nothing to do in the last build')
+        return
+
+    # Remember this profile's compile times, so a later report can compare it with the other profile
+    history_path = os.path.join(build_dir, PROFILE_HISTORY)
+    try:
+        with open(history_path, 'r') as f:
+            history = json.load(f)
+    except (IOError, OSError, ValueError):
+        history = {}
+    history.setdefault(profile, {}).update(compile_times(commands, edges))
+    with open(history_path, 'w') as f:
+        json.dump(history, f, indent=1, sort_keys=True)
+
+    total = sum(end - start for start, end, outputs in commands)
+    wall = max(end for start, end, outputs in commands) - min(start for start, end, outputs in commands)
+    print('Last build ({} profile): {} commands, {:.2f}s from first start to last finish, {:.2f}s in all, '
+        '{:.1f} running at once on average'.format(profile, len(commands), wall, total, total / wall if wall else 1))
+
+    print('\nBy rule:       commands       time')
+    rules = {}
+    for start, end, outputs in commands:
+        rule = edges.get(outputs[0], ('?',))[0]
+        count, seconds = rules.get(rule, (0, 0))
+        rules[rule] = (count + 1, seconds + end - start)
+    for rule, (count, seconds) in sorted(rules.items(), key=lambda item: -item[1][1]):
+        print('  {:12} {:9} {:9.2f}s {:5.1f}%'.format(rule, count, seconds, 100 * seconds / total if total else 0))
+
+    print('\nSlowest files:')
+    slowest = sorted(((end - start, outputs[0]) for start, end, outputs in commands), reverse=True)
+    for seconds, output in slowest[:REPORT_TOP]:
+        rule, explicit, _ = edges.get(output, ('?', [], []))
+        name = explicit[0] if rule in COMPILE_RULES and explicit else output
+        print('  {:9.2f}s  {:8} {}'.format(seconds, rule, name))
+
+    length, path = critical_path(commands, edges)
+    print('\nCritical path, {:.2f}s:'.format(length))
+    for output, rule, seconds in path:
+        print('  {:9.2f}s  {:8} {}'.format(seconds, rule, output))
+
+    print('\nListings:')
+    for start, end, outputs in commands:
+        if edges.get(outputs[0], (None,))[0] == 'objdump':
+            print('  {} took {:.2f}s'.format(outputs[0], end - start))
+    cost = listing_cost(history, edges)
+    if cost:
+        count, with_listings, without = cost
+        print('  Compiling {} files took {:.2f}s with listings (release) and {:.2f}s without (dev), '
+            'listings add {:.0f}%'.format(count, with_listings, without,
+            100 * (with_listings - without) / without if without else 0))
+    else:
+        other = 'dev' if profile == 'release' else 'release'
+        print('  Regenerate with --profile {} and rebuild everything to see what the per-file listings cost'.format(other))
+
 def main(args):
     parser = argparse.ArgumentParser()
-    parser.add_argument('directory',
-        help='the directory where Yagarto or Linaro is installed')
+    parser.add_argument('directory', nargs='*',
+        help='the directories where Yagarto or Linaro might be installed, more can be given in the '
+            + toolchain.TOOLCHAIN_PATH_VAR + ' environment variable')
     parser.add_argument('-o', metavar='output', default=DEFAULT_FILE,
         help='the name of the generated ninja file')
     parser.add_argument('-i', metavar='include', default=None,
         help='includes the given file to allow overriding default variables and rules')
+    parser.add_argument('--cache', action='store_true',
+        help='run compiles through objcache.py so unchanged sources are restored from a cache')
+    parser.add_argument('--list', action='store_true',
+        help='list every compiler found and exit, the one that would be used is marked with *')
+    parser.add_argument('--rescan', action='store_true',
+        help='search for the compiler again instead of using the one in ' + toolchain.CONFIG_FILE)
+    parser.add_argument('--profile', choices=PROFILES, default=DEFAULT_PROFILE,
+        help='dev leaves out the assembler listings for faster builds, default: %(default)s')
+    # One value per option (--boards pi2 --boards pi3) so the directories can still come after them
+    parser.add_argument('--boards', action='append', choices=list(BOARD_FLAGS), metavar='BOARD',
+        help='a board to build for, give it again for each board, more than one builds each into its own '
+            'directory, one of: {}, default: {}'.format(', '.join(BOARD_FLAGS), DEFAULT_BOARD))
+    parser.add_argument('--opts', action='append', choices=list(OPT_FLAGS), metavar='OPT',
+        help='an optimization level to build each board at, give it again for each level, '
+            'one of: {}, default: {}'.format(', '.join(OPT_FLAGS), DEFAULT_OPT))
+    parser.add_argument('--report', action='store_true',
+        help='show where the time went in the last ninja build of the output file and exit')
     # parser.add_argument('-s', action='append',
     #     help='specify a setting in the form "key=value" or just "key"')
     opt = parser.parse_args(args)
 
     try:
-        # Normalize the guess directory and expand ~ if they're just guessing
-        guess_dir = os.path.normpath(os.path.expanduser(opt.directory + os.sep))
-        # If they gave us a bad directory, they might be using Cygwin
-        if not os.path.exists(guess_dir):
-            raise Exception(guess_dir + ' not found. Are you trying to use Windows Python in Cygwin?')
-        print('Searching ' + guess_dir + ' for compiler')
+        if opt.report:
+            report(opt.o)
+            return
+        if not opt.directory and not os.environ.get(toolchain.TOOLCHAIN_PATH_VAR):
+            raise Exception('No directory given to search for the compiler')
+        # Normalize the guess directories and expand ~ if they're just guessing
+        guess_dirs = [os.path.normpath(os.path.expanduser(d + os.sep)) for d in opt.directory]
+        for guess_dir in guess_dirs:
+            # If they gave us a bad directory, they might be using Cygwin
+            if not os.path.exists(guess_dir):
+                raise Exception(guess_dir + ' not found. Are you trying to use Windows Python in Cygwin?')
+            print('Searching ' + guess_dir + ' for compiler')
         # Now search for the compiler
-        gen = NinjaGen(guess_dir, opt.i)
-        if not gen.locate():
+        gen = NinjaGen(guess_dirs, opt.i, opt.cache, opt.profile, opt.boards, opt.opts)
+        if opt.list:
+            # Listed without running any of them, so one that doesn't work still shows up
+            toolchain.print_compilers(guess_dirs, toolchain.chosen_compiler(guess_dirs, not opt.rescan))
+            return
+        found = gen.locate(use_index=not opt.rescan)
+        if not found:
             raise Exception('Unable to locate compiler')
-        print('Detected compiler: ' + gen.name)
+        print('Detected compiler: {} ({} {})'.format(gen.name, gen.toolchain.machine, gen.toolchain.version))
+        gen.check_boards()
         # Output the build file
         outfile = opt.o
-        gen.generate(outfile)
-        print('Success! Wrote to ' + outfile)
+        if gen.generate(outfile):
+            print('Success! Wrote to ' + outfile)
+        else:
+            print(outfile + ' is up to date')
     except BaseException as e:
         raise e
 
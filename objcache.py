@@ -0,0 +1,388 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2017 Binder News
+# This software is licensed under the MIT License. See LICENSE for details.
+#
+# A small ccache-like compiler wrapper. Put it in front of the compiler:
+#     python objcache.py arm-none-eabi-gcc $cflags -c source/main.c -o build/main.o > build/main.o.lst
+# The source is run through the preprocessor and hashed together with the flags and
+# the compiler's identity (and the working directory for -g builds, and the source files
+# themselves when the listing shows them). If that hash has been compiled before the object file,
+# dependency file and whatever the compiler printed (the assembler listing) are
+# restored from the cache instead of running the compiler again.
+# Anything that isn't a plain `-c` compile of one file is passed straight through.
+#
+# genninja.py --cache and genmake.py --cache set this up.
+#     python objcache.py --stats     show hit/miss counts and the cache size
+#     python objcache.py --clear     empty the cache
+#
+# The cache lives in ~/.cache/baremetal-pi-tools/objcache (or $OBJCACHE_DIR) and is
+# kept under $OBJCACHE_SIZE megabytes by throwing out the least recently used entries.
+# A running total of its size is kept in size.log, so the cache is only walked to find
+# what to throw out once that total says it's full.
+#
+
+from __future__ import print_function
+
+import hashlib
+import os
+import os.path
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+
+CACHE_DIR = os.environ.get('OBJCACHE_DIR') or \
+    os.path.join(os.path.expanduser('~'), '.cache', 'baremetal-pi-tools', 'objcache')
+MAX_SIZE = int(os.environ.get('OBJCACHE_SIZE', '500')) * 1024 * 1024
+# Every compile appends hit, miss or uncacheable, and the lines are folded into one count each
+# once there are SIZE_LOG_LINES of them
+STATS_FILE = 'stats.log'
+# Running total of the cache's size, so a miss doesn't have to walk the whole cache to check it.
+# Every stored entry appends its size, and the lines are added up into one once there are this many.
+SIZE_FILE = 'size.log'
+SIZE_LOG_LINES = 1000
+# Eviction makes this much of max_size free, so a full cache isn't walked again on the very next miss
+EVICT_SLACK = 0.1
+# Bumped whenever the layout of an entry changes
+VERSION = b'objcache 1'
+
+SOURCE_EXTENSIONS = ('.c', '.cpp', '.cc', '.S', '.s')
+# Options that only matter for the dependency file, with whether they take an argument
+DEPEND_OPTIONS = {'-MD': False, '-MMD': False, '-MP': False, '-MF': True, '-MT': True, '-MQ': True}
+# The files the preprocessor read, from the line markers in its output
+LINE_MARKER = re.compile(br'^# \d+ "([^"]+)"', re.M)
+
+# Names of the files in an entry
+OBJECT = 'object'
+DEPFILE = 'depend'
+STDOUT = 'stdout'
+STDERR = 'stderr'
+
+class Uncacheable(Exception):
+    pass
+
+class Compile(object):
+    """ A compiler command line, picked apart into the bits the cache cares about. """
+    def __init__(self, argv):
+        self.compiler = argv[0]
+        self.args = argv[1:]
+        self.output = None
+        self.source = None
+        self.depfile = None
+        self.preprocess_args = []
+        writes_depfile = False
+        compile_only = False
+
+        i = 0
+        while i < len(self.args):
+            arg = self.args[i]
+            value = self.args[i + 1] if i + 1 < len(self.args) else None
+            if arg == '-c':
+                compile_only = True
+            elif arg == '-o':
+                self.output = value
+                i += 1
+            elif arg in DEPEND_OPTIONS:
+                if arg in ('-MD', '-MMD'):
+                    writes_depfile = True
+                elif arg == '-MF':
+                    self.depfile = value
+                if DEPEND_OPTIONS[arg]:
+                    i += 1
+            elif arg in ('-E', '-S', '-M', '-MM', '-') or arg.startswith('@'):
+                raise Uncacheable(arg)
+            elif not arg.startswith('-') and arg.endswith(SOURCE_EXTENSIONS):
+                if self.source:
+                    raise Uncacheable('more than one source file')
+                self.source = arg
+                self.preprocess_args.append(arg)
+            else:
+                self.preprocess_args.append(arg)
+            i += 1
+
+        if not compile_only or not self.source or not self.output:
+            raise Uncacheable('not a single compile')
+        if writes_depfile and not self.depfile:
+            # gcc puts it next to the object file
+            self.depfile = os.path.splitext(self.output)[0] + '.d'
+        elif not writes_depfile:
+            self.depfile = None
+
+    def identity(self):
+        """ Returns something that changes whenever the compiler does. """
+        path = self.compiler
+        if not os.path.dirname(path):
+            path = find_program(path) or path
+        st = os.stat(path)
+        return '{}:{}:{}'.format(os.path.realpath(path), st.st_size, int(st.st_mtime)).encode('utf-8')
+
+    def key(self):
+        """ Returns the cache key, running the preprocessor to get it. """
+        proc = subprocess.Popen([self.compiler] + self.preprocess_args + ['-E'],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        preprocessed, _ = proc.communicate()
+        if proc.returncode != 0:
+            # Let the real compile report the error
+            raise Uncacheable('preprocessor failed')
+        h = hashlib.sha1(VERSION)
+        for piece in [self.identity()] + [a.encode('utf-8') for a in self.args]:
+            h.update(piece)
+            h.update(b'\0')
+        h.update(preprocessed)
+        # Debug info records the directory the compile ran in (DW_AT_comp_dir)
+        if any(a.startswith('-g') and a != '-g0' for a in self.args):
+            h.update(os.getcwd().encode('utf-8'))
+        # A listing with the source in it (-Wa,-adhln) shows the comments -E strips
+        if self.lists_source():
+            for path in sorted(set(LINE_MARKER.findall(preprocessed))):
+                try:
+                    with open(path, 'rb') as f:
+                        h.update(path + b'\0' + f.read())
+                except (IOError, OSError):
+                    # <built-in>, <command-line> and the like
+                    continue
+        return h.hexdigest()
+
+    def lists_source(self):
+        """ True if the assembler is asked for a listing that includes the source (-a with h). """
+        for arg in self.args:
+            if arg.startswith('-Wa,'):
+                for option in arg.split(',')[1:]:
+                    if option.startswith('-a') and 'h' in option.split('=')[0]:
+                        return True
+        return False
+
+def find_program(name):
+    for directory in os.environ.get('PATH', '').split(os.pathsep):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path):
+            return path
+    return None
+
+class ObjectCache(object):
+    """ Entries are directories named after the key, holding the files a compile produced.
+    An entry's modification time is bumped on every hit so eviction can drop the least
+    recently used ones first.
+    """
+    def __init__(self, directory=CACHE_DIR, max_size=MAX_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+
+    def _entry(self, key):
+        return os.path.join(self.directory, key[:2], key[2:])
+
+    def restore(self, key, job):
+        """ Copies a cached result into place, returns (stdout, stderr) or None on a miss. """
+        entry = self._entry(key)
+        if not os.path.isdir(entry):
+            return None
+        try:
+            shutil.copyfile(os.path.join(entry, OBJECT), job.output)
+            if job.depfile:
+                shutil.copyfile(os.path.join(entry, DEPFILE), job.depfile)
+            with open(os.path.join(entry, STDOUT), 'rb') as f:
+                out = f.read()
+            with open(os.path.join(entry, STDERR), 'rb') as f:
+                err = f.read()
+            os.utime(entry, None)
+        except (IOError, OSError):
+            return None
+        return out, err
+
+    def store(self, key, job, out, err):
+        """ Saves the result of a successful compile. """
+        entry = self._entry(key)
+        if not os.path.isdir(os.path.dirname(entry)):
+            try:
+                os.makedirs(os.path.dirname(entry))
+            except OSError:
+                # Another compile got there first
+                pass
+        # Fill a temporary directory and rename it so a parallel build never sees half an entry
+        temp = tempfile.mkdtemp(dir=os.path.dirname(entry))
+        try:
+            shutil.copyfile(job.output, os.path.join(temp, OBJECT))
+            if job.depfile:
+                shutil.copyfile(job.depfile, os.path.join(temp, DEPFILE))
+            with open(os.path.join(temp, STDOUT), 'wb') as f:
+                f.write(out)
+            with open(os.path.join(temp, STDERR), 'wb') as f:
+                f.write(err)
+            size = sum(os.path.getsize(os.path.join(temp, f)) for f in os.listdir(temp))
+            os.rename(temp, entry)
+        except (IOError, OSError):
+            shutil.rmtree(temp, ignore_errors=True)
+            return
+        self.grow(size)
+
+    def grow(self, size):
+        """ Adds size to the running total in SIZE_FILE, and evicts once that goes over max_size.
+        The total is only an estimate (a repeated key isn't stored twice), evict() recounts it.
+        """
+        path = os.path.join(self.directory, SIZE_FILE)
+        try:
+            # Without a total to add to, count what's already there
+            if not os.path.exists(path):
+                self.evict()
+                return
+            # Added to without a lock, the same way as STATS_FILE
+            with open(path, 'a') as f:
+                f.write('{}\n'.format(size))
+            with open(path, 'r') as f:
+                sizes = [int(line) for line in f.read().split()]
+        except (IOError, OSError, ValueError):
+            self.evict()
+            return
+        if sum(sizes) > self.max_size:
+            self.evict()
+        elif len(sizes) > SIZE_LOG_LINES:
+            self._save_size(sum(sizes))
+
+    def _save_size(self, total):
+        self._replace(SIZE_FILE, '{}\n'.format(total))
+
+    def _replace(self, name, text):
+        """ Swaps the log called name for text, so a parallel compile reads either the old or the new one. """
+        path = os.path.join(self.directory, name)
+        temp = '{}.{}'.format(path, os.getpid())
+        try:
+            with open(temp, 'w') as f:
+                f.write(text)
+            os.replace(temp, path)
+        except (IOError, OSError):
+            pass
+
+    def entries(self):
+        """ Returns (mtime, size, path) for every entry. """
+        result = []
+        if not os.path.isdir(self.directory):
+            return result
+        for prefix in os.listdir(self.directory):
+            prefix_dir = os.path.join(self.directory, prefix)
+            if not os.path.isdir(prefix_dir):
+                continue
+            for name in os.listdir(prefix_dir):
+                entry = os.path.join(prefix_dir, name)
+                try:
+                    size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+                    result.append((os.path.getmtime(entry), size, entry))
+                except OSError:
+                    continue
+        return result
+
+    def evict(self):
+        """ Removes the least recently used entries until the cache fits in max_size, with
+        EVICT_SLACK of it to spare if anything had to go.
+        """
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        limit = self.max_size if total <= self.max_size else self.max_size * (1 - EVICT_SLACK)
+        for _, size, entry in sorted(entries):
+            if total <= limit:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+        self._save_size(total)
+
+    def count(self, what):
+        """ Records a hit, miss or uncacheable compile, folding STATS_FILE the same way as SIZE_FILE. """
+        path = os.path.join(self.directory, STATS_FILE)
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            # Appends this small are atomic, so parallel compiles don't need a lock
+            with open(path, 'a') as f:
+                f.write(what + '\n')
+            with open(path, 'r') as f:
+                lines = f.read().splitlines()
+        except (IOError, OSError):
+            return
+        if len(lines) > SIZE_LOG_LINES:
+            # A compile that counts itself while this is written is lost, the counts are only a guide
+            self._replace(STATS_FILE, ''.join('{} {}\n'.format(name, number)
+                for name, number in sorted(tally(lines).items()) if number))
+
+    def stats(self):
+        try:
+            with open(os.path.join(self.directory, STATS_FILE), 'r') as f:
+                return tally(f.read().splitlines())
+        except (IOError, OSError):
+            return tally([])
+
+    def clear(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+def tally(lines):
+    """ Returns the hit, miss and uncacheable counts in the lines of STATS_FILE.
+    A line is either one compile ("hit") or a folded count ("hit 250").
+    """
+    counts = {'hit': 0, 'miss': 0, 'uncacheable': 0}
+    for line in lines:
+        fields = line.split()
+        if fields and fields[0] in counts:
+            try:
+                counts[fields[0]] += int(fields[1]) if len(fields) > 1 else 1
+            except ValueError:
+                continue
+    return counts
+
+def write_output(out, err):
+    getattr(sys.stdout, 'buffer', sys.stdout).write(out)
+    sys.stdout.flush()
+    getattr(sys.stderr, 'buffer', sys.stderr).write(err)
+    sys.stderr.flush()
+
+def cached_compile(argv, cache):
+    """ Compile using the cache where possible, returns the compiler's exit code. """
+    try:
+        c = Compile(argv)
+        key = c.key()
+    except (Uncacheable, OSError):
+        cache.count('uncacheable')
+        return subprocess.call(argv)
+
+    result = cache.restore(key, c)
+    if result is not None:
+        cache.count('hit')
+        write_output(*result)
+        return 0
+
+    cache.count('miss')
+    proc = subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    write_output(out, err)
+    if proc.returncode == 0:
+        cache.store(key, c, out, err)
+    return proc.returncode
+
+def print_stats(cache):
+    counts = cache.stats()
+    entries = cache.entries()
+    lookups = counts['hit'] + counts['miss']
+    print('Cache directory: ' + cache.directory)
+    print('Hits:            {}'.format(counts['hit']))
+    print('Misses:          {}'.format(counts['miss']))
+    print('Uncacheable:     {}'.format(counts['uncacheable']))
+    if lookups:
+        print('Hit rate:        {:.1f}%'.format(100.0 * counts['hit'] / lookups))
+    print('Entries:         {}'.format(len(entries)))
+    print('Size:            {:.1f} of {:.0f} MB'.format(
+        sum(size for _, size, _ in entries) / 1048576.0, cache.max_size / 1048576.0))
+
+def main(argv):
+    cache = ObjectCache()
+    if argv == ['--stats']:
+        print_stats(cache)
+        return 0
+    if argv == ['--clear']:
+        cache.clear()
+        return 0
+    if not argv or argv[0].startswith('-'):
+        print('usage: objcache.py compiler [args...] | --stats | --clear', file=sys.stderr)
+        return 2
+    return cached_compile(argv, cache)
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
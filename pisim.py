@@ -0,0 +1,546 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2017 Binder News
+# This software is licensed under the MIT License. See LICENSE for details.
+#
+# A simulated bootloader for testing piterm without a Raspberry Pi. It opens a
+# pseudo-terminal, prints the device name and then behaves like the bootloader in
+# bootloader/source/main.c would on the other end of the serial cable.
+# Run it, then point piterm at the device it printed.
+# Sending it SIGUSR1 is like pressing reset, and --say stands in for what the program
+# would print once it's started, which is enough to try out `piterm run`.
+#
+
+from __future__ import print_function
+
+import os
+import random
+import select
+import signal
+import struct
+import sys
+import time
+import tty
+import zlib
+
+RPI_BOOT = 0x8000
+# The bootloader itself lives at 0x200000, programs are loaded below it.
+MEMORY_SIZE = 0x200000
+
+# Asking which requests are understood, keep in sync with load_program() in bootloader/source/main.c
+HELLO_REQUEST = 0x02
+PROTOCOL_VERSION = 1
+
+# Framed binary protocol, keep in sync with load_binary() in bootloader/source/main.c
+BIN_START = 0x01
+BIN_ACK = 0x06
+BIN_NAK = 0x15
+BIN_MAX_CHUNK = 4096
+BIN_TIMEOUT = 2.0
+BIN_DRAIN = 0.02
+BIN_QUIET = 0.75
+BIN_HEADER = struct.Struct('<IIHH')
+BIN_CHUNK = struct.Struct('<HH')
+BIN_CRC = struct.Struct('<I')
+
+# Compressed binary transfers, keep in sync with decompress() in bootloader/source/main.c
+BIN_FLAG_LZ4 = 0x0001
+COMPRESSED_MAX = 0x01000000
+LZ4_MIN_MATCH = 4
+
+# Asking what is in memory, keep in sync with report_crc() in bootloader/source/main.c
+CRC_REQUEST = 0x03
+CRC_REQUEST_FRAME = struct.Struct('<II')
+
+# Baud rate negotiation, keep in sync with negotiate_baud() in bootloader/source/main.c
+BAUD_REQUEST = 0x05
+BAUD_TIMEOUT = 0.5
+BAUD_PROBE = b'\x55\xaa\x00\xffPITERM\x0f\xf0'
+BASE_BAUD = 115200
+UART_CLOCK = 48000000
+
+# ihex checksums, keep in sync with report_sums() in bootloader/source/main.c
+SUM_SEGMENTS = 17
+
+# The PL011's receive FIFO. With UART timing on, this is how many bytes can pile up while
+# the bootloader is busy, so it's also the most that can be read at once.
+FIFO_DEPTH = 16
+# Start bit, 8 data bits, stop bit
+BITS_PER_BYTE = 10
+
+class Timeout(Exception):
+    pass
+
+class Reset(Exception):
+    pass
+
+def lz4_decompress(data, max_size=None):
+    """ Returns the LZ4 block in data expanded, the same way decompress() in main.c does it.
+    Raises ValueError if the block is corrupt or would expand past max_size bytes.
+    """
+    data = bytearray(data)
+    out = bytearray()
+    pos = 0
+
+    def more_length(length):
+        # Lengths of 15 carry on in the next bytes, until one of them isn't 255
+        nonlocal pos
+        while True:
+            if pos >= len(data):
+                raise ValueError('LZ4 block ends in the middle of a length')
+            c = data[pos]
+            pos += 1
+            length += c
+            if c != 255:
+                return length
+
+    while pos < len(data):
+        token = data[pos]
+        pos += 1
+        length = token >> 4
+        if length == 15:
+            length = more_length(length)
+        if pos + length > len(data):
+            raise ValueError('LZ4 literals run past the end of the block')
+        out += data[pos:pos + length]
+        pos += length
+        if pos == len(data):
+            break
+        if pos + 2 > len(data):
+            raise ValueError('LZ4 block ends in the middle of an offset')
+        offset = data[pos] | (data[pos + 1] << 8)
+        pos += 2
+        if not 0 < offset <= len(out):
+            raise ValueError('LZ4 match offset {} is out of range'.format(offset))
+        length = token & 0xF
+        if length == 15:
+            length = more_length(length)
+        length += LZ4_MIN_MATCH
+        # The match can overlap what it's copying, which repeats the last offset bytes
+        start = len(out) - offset
+        while length > 0:
+            piece = out[start:start + min(length, offset)]
+            out += piece
+            start += len(piece)
+            length -= len(piece)
+        if max_size is not None and len(out) > max_size:
+            raise ValueError('LZ4 block expands past {} bytes'.format(max_size))
+    if max_size is not None and len(out) > max_size:
+        raise ValueError('LZ4 block expands past {} bytes'.format(max_size))
+    return bytes(out)
+
+def baud_divisor(baud):
+    """ Same as baud_divisor() in bootloader/source/uart.c. """
+    if baud == 0:
+        return 0
+    divisor = (4 * UART_CLOCK + baud // 2) // baud
+    if not 0 < (divisor >> 6) <= 0xFFFF:
+        return 0
+    actual = 4 * UART_CLOCK // divisor
+    if abs(actual - baud) * 50 > baud:
+        return 0
+    return divisor
+
+class SimBootloader(object):
+    """ The bootloader's load_program() loop, talking over a file descriptor instead of the UART.
+
+    A pty doesn't care about baud rates, so max_baud says which rates the simulated cable can
+    carry. Switching to anything faster garbles the probe and the negotiation falls back.
+
+    With uart_timing, bytes are only taken from the pty as fast as they could arrive at the
+    current baud rate, at most fifo_depth at a time. Whatever hasn't been taken yet stays queued
+    on the host's side, so piterm sees the same back pressure it would from a real UART.
+
+    drop_rate is the chance of each received byte being lost, like it would be when the
+    receive FIFO overflows. It's for trying out piterm's error handling. With drop_last_ack
+    the ACK for the last chunk of the first binary transfer never reaches the host, so it
+    has to resend that chunk.
+
+    legacy behaves like the bootloader did before any of the binary requests, it only takes ihex
+    and ignores HELLO_REQUEST.
+    """
+    def __init__(self, fd, max_baud=None, uart_timing=False, fifo_depth=FIFO_DEPTH, drop_rate=0.0,
+                 drop_last_ack=False, legacy=False):
+        self.fd = fd
+        self.legacy = legacy
+        self.drop_rate = drop_rate
+        self.drop_last_ack = drop_last_ack
+        self.random = random.Random(1)
+        self.max_baud = max_baud
+        self.uart_timing = uart_timing
+        self.fifo_depth = fifo_depth
+        self.baud = BASE_BAUD
+        self.memory = bytearray(MEMORY_SIZE)
+        self.low = None
+        self.high = None
+        self.received = 0
+        # ihex checksum of each 64K segment since the last End of File record
+        self.segment_sums = {}
+        self._rx = bytearray()
+        self._pos = 0
+        # When the last byte taken from the pty finished arriving
+        self._wire = 0.0
+
+    def _fill(self, timeout):
+        # Keep reading until something is left over after the drops, each read gets the whole timeout
+        while self._pos >= len(self._rx):
+            r, _, _ = select.select([self.fd], [], [], timeout)
+            if not r:
+                raise Timeout()
+            size = self._arrived() if self.uart_timing else 4096
+            self._rx = bytearray(os.read(self.fd, size))
+            self._pos = 0
+            if self.uart_timing:
+                # Dropped bytes still took their time on the wire
+                self._wire += len(self._rx) * BITS_PER_BYTE / float(self.baud)
+            if self.drop_rate:
+                self._rx = bytearray(c for c in self._rx if self.random.random() >= self.drop_rate)
+            self.received += len(self._rx)
+
+    def _arrived(self):
+        """ Wait until at least one byte could have come down the wire, returns how many have. """
+        byte_time = BITS_PER_BYTE / float(self.baud)
+        now = time.time()
+        # A FIFO's worth is all that can build up while nobody is reading
+        self._wire = max(self._wire, now - self.fifo_depth * byte_time)
+        count = int((now - self._wire) / byte_time)
+        if count < 1:
+            time.sleep(self._wire + byte_time - now)
+            count = 1
+        return count
+
+    def get_char(self, timeout=None):
+        """ Returns the next byte received, raises Timeout if nothing arrives in time. """
+        self._fill(timeout)
+        c = self._rx[self._pos]
+        self._pos += 1
+        return c
+
+    def read(self, size, timeout=None):
+        """ Returns exactly size bytes, waiting up to timeout seconds between each piece. """
+        data = bytearray()
+        while len(data) < size:
+            self._fill(timeout)
+            piece = self._rx[self._pos:self._pos + size - len(data)]
+            self._pos += len(piece)
+            data += piece
+        return bytes(data)
+
+    def put_string(self, s):
+        os.write(self.fd, s.encode('ascii'))
+
+    def put_char(self, c):
+        os.write(self.fd, bytes(bytearray([c])))
+
+    def store(self, address, data):
+        """ Write data into the simulated memory, keeping track of what was loaded. """
+        end = address + len(data)
+        if address < RPI_BOOT or end > MEMORY_SIZE:
+            raise ValueError('write to {:#x}-{:#x} is outside the program area'.format(address, end))
+        self.memory[address:end] = data
+        self.low = address if self.low is None else min(self.low, address)
+        self.high = end if self.high is None else max(self.high, end)
+
+    def image(self):
+        """ Returns the loaded program as it would be found at RPI_BOOT. """
+        if self.low is None:
+            return b''
+        return bytes(self.memory[RPI_BOOT:self.high])
+
+    def run(self):
+        """ Wait for a program and return once it's been started with 'g'.
+        Intel HEX is parsed one character at a time by the same state machine as load_program(),
+        quirks included: data is stored a whole word at a time and only record types 00, 01 and 02
+        are understood. See the comment in main.c for the states. The End of File record reports
+        the checksum of each segment loaded, see report_sums().
+        """
+        self.put_string('Bootloader waiting...\r\n')
+        state = 0
+        byte_count = 0
+        address = 0
+        record_type = 0
+        segment = 0
+        data = 0
+        while True:
+            ra = self.get_char()
+            if self.legacy:
+                # None of the binary requests existed yet, their bytes go to the ihex parser
+                pass
+            elif ra == HELLO_REQUEST:
+                os.write(self.fd, bytes(bytearray([BIN_ACK, PROTOCOL_VERSION])))
+                state = 0
+                continue
+            elif ra == BIN_START:
+                self.load_binary()
+                state = 0
+                continue
+            elif ra == BAUD_REQUEST:
+                self.negotiate_baud()
+                state = 0
+                continue
+            elif ra == CRC_REQUEST:
+                self.report_crc()
+                state = 0
+                continue
+            if ra == 0x3A:  # ':'
+                state = 1
+                continue
+            if ra in (0x0D, 0x0A):
+                state = 0
+                continue
+            if ra in (0x67, 0x47):  # 'g', 'G'
+                self.put_string('\r--\r\n\n')
+                return
+            if state == 0:
+                continue
+            if ra > 0x39:
+                ra -= 7
+            digit = ra & 0xF
+            if state <= 2:
+                byte_count = ((byte_count << 4) | digit) & 0xFF
+                state += 1
+            elif state <= 6:
+                address = (((address << 4) | digit) & 0xFFFF) | segment
+                state += 1
+            elif state == 7:
+                record_type = ((record_type << 4) | digit) & 0xFF
+                state += 1
+            elif state == 8:
+                record_type = ((record_type << 4) | digit) & 0xFF
+                if record_type == 0x00:
+                    state = 14
+                elif record_type == 0x01:
+                    self.report_sums()
+                    self.put_string("-- Press 'g' to start the program\r\n")
+                    state = 0
+                elif record_type == 0x02:
+                    state = 9
+                else:
+                    state = 0
+            elif state <= 12:
+                segment = ((segment << 4) | digit) & 0xFFFF
+                state += 1
+            elif state == 13:
+                segment <<= 4
+                state = 0
+            else:
+                data = ((data << 4) | digit) & 0xFFFFFFFF
+                if state == 21:
+                    # The hex digits are in memory order, load_program() swaps them into a word for PUT32
+                    word = struct.pack('>I', data)
+                    try:
+                        self.store(address, word)
+                    except ValueError:
+                        # A garbled address, the real thing would write there anyway
+                        pass
+                    index = address >> 16
+                    if index < SUM_SEGMENTS:
+                        self.segment_sums[index] = (self.segment_sums.get(index, 0) + address
+                            + struct.unpack('<I', word)[0]) & 0xFFFFFFFF
+                    address += 4
+                    state = 14
+                else:
+                    state += 1
+
+    def report_sums(self):
+        """ Same as report_sums() in main.c. """
+        for index in sorted(self.segment_sums):
+            self.put_string('-- Sum {:08X} {:08X}\r\n'.format(index << 16, self.segment_sums[index]))
+        self.segment_sums = {}
+
+    def _drain(self):
+        try:
+            while True:
+                self.get_char(BIN_DRAIN)
+        except Timeout:
+            pass
+
+    def _reject_frame(self):
+        self._drain()
+        self.put_char(BIN_NAK)
+
+    def load_binary(self):
+        """ Receive a program sent with the framed binary protocol. BIN_START has already been read. """
+        try:
+            header = self.read(BIN_HEADER.size, BIN_TIMEOUT)
+            check, = BIN_CRC.unpack(self.read(BIN_CRC.size, BIN_TIMEOUT))
+            address, length, chunk_size, flags = BIN_HEADER.unpack(header)
+            compressed = flags & BIN_FLAG_LZ4
+            if (zlib.crc32(header) & 0xFFFFFFFF != check or not 0 < chunk_size <= BIN_MAX_CHUNK
+                    or flags & ~BIN_FLAG_LZ4 or not RPI_BOOT <= address < MEMORY_SIZE
+                    or (not compressed and length > MEMORY_SIZE - address)
+                    or (compressed and not 4 <= length <= COMPRESSED_MAX)):
+                self._reject_frame()
+                return
+            self.put_char(BIN_ACK)
+            # Compressed data is collected on the side and expanded at the end
+            staging = bytearray(length) if compressed else None
+
+            chunks = (length + chunk_size - 1) // chunk_size
+            expected = 0
+            while True:
+                # Once every chunk is in, keep answering resent ones until the line goes quiet
+                try:
+                    first = self.get_char(BIN_TIMEOUT if expected < chunks else BIN_QUIET)
+                    seq = self.receive_chunk(first, address, length, chunk_size, staging)
+                except Timeout:
+                    break
+                if seq is None:
+                    continue
+                if seq == chunks - 1 and self.drop_last_ack:
+                    self.drop_last_ack = False
+                    sys.stderr.write('--- Lost the ACK for chunk {} ---\n'.format(seq))
+                else:
+                    self.put_char(BIN_ACK)
+                if seq == expected:
+                    expected += 1
+            if expected < chunks:
+                self._drain()
+                self.put_string('-- Transfer timed out\r\n')
+                return
+            if compressed:
+                size, = struct.unpack_from('<I', staging)
+                try:
+                    if size > MEMORY_SIZE - address:
+                        raise ValueError('{} bytes at {:#x} would overwrite the bootloader'.format(size, address))
+                    program = lz4_decompress(staging[4:], size)
+                    if len(program) != size:
+                        raise ValueError('LZ4 block expanded to {} bytes instead of {}'.format(len(program), size))
+                    self.store(address, program)
+                except ValueError as e:
+                    sys.stderr.write('--- Decompression failed: {} ---\n'.format(e))
+                    self.put_char(BIN_NAK)
+                    return
+            self.put_char(BIN_ACK)
+            self.put_string("-- Press 'g' to start the program\r\n")
+        except Timeout:
+            self._drain()
+            self.put_string('-- Transfer timed out\r\n')
+
+    def receive_chunk(self, first, address, length, chunk_size, staging):
+        """ Read the rest of a chunk whose first byte is first and store it, or NAK it.
+        Returns its sequence number, or None if it was refused. The caller sends the ACK.
+        """
+        head = bytes(bytearray([first])) + self.read(BIN_CHUNK.size - 1, BIN_TIMEOUT)
+        seq, count = BIN_CHUNK.unpack(head)
+        offset = seq * chunk_size
+        if seq >= (length + chunk_size - 1) // chunk_size or count > chunk_size or offset + count > length:
+            self._reject_frame()
+            return None
+        payload = self.read(count, BIN_TIMEOUT)
+        check, = BIN_CRC.unpack(self.read(BIN_CRC.size, BIN_TIMEOUT))
+        if zlib.crc32(head + payload) & 0xFFFFFFFF != check:
+            self._reject_frame()
+            return None
+        if staging is not None:
+            staging[offset:offset + count] = payload
+        else:
+            self.store(address + offset, payload)
+        return seq
+
+    def report_crc(self):
+        """ Tell the host the CRC32 of part of the program area. CRC_REQUEST has already been read. """
+        try:
+            request = self.read(CRC_REQUEST_FRAME.size, BIN_TIMEOUT)
+            check, = BIN_CRC.unpack(self.read(BIN_CRC.size, BIN_TIMEOUT))
+        except Timeout:
+            return
+        address, length = CRC_REQUEST_FRAME.unpack(request)
+        if (zlib.crc32(request) & 0xFFFFFFFF != check or not RPI_BOOT <= address < MEMORY_SIZE
+                or length > MEMORY_SIZE - address):
+            self._reject_frame()
+            return
+        os.write(self.fd, bytes(bytearray([BIN_ACK])) + BIN_CRC.pack(zlib.crc32(self.memory[address:address + length])))
+
+    def negotiate_baud(self):
+        """ Switch to the baud rate the host asked for. BAUD_REQUEST has already been read. """
+        try:
+            raw = self.read(4, BIN_TIMEOUT)
+            check, = BIN_CRC.unpack(self.read(BIN_CRC.size, BIN_TIMEOUT))
+        except Timeout:
+            return
+        baud, = struct.unpack('<I', raw)
+        divisor = baud_divisor(baud)
+        if zlib.crc32(raw) & 0xFFFFFFFF != check or not divisor:
+            self._reject_frame()
+            return
+        os.write(self.fd, bytes(bytearray([BIN_ACK])) + struct.pack('<I', 4 * UART_CLOCK // divisor))
+
+        old_baud = self.baud
+        self.baud = baud
+        try:
+            probe = self.read(len(BAUD_PROBE), BAUD_TIMEOUT)
+            garbled = self.max_baud is not None and baud > self.max_baud
+            if probe == BAUD_PROBE and not garbled:
+                os.write(self.fd, BAUD_PROBE)
+                if self.get_char(BAUD_TIMEOUT) == BIN_ACK:
+                    return
+        except Timeout:
+            pass
+        self.baud = old_baud
+        self._drain()
+
+def open_pty():
+    """ Returns (master fd, slave fd, slave name) for a new raw pseudo-terminal. """
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    return master, slave, os.ttyname(slave)
+
+def main(argv):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Pisim - A simulated bootloader on a pseudo-terminal.")
+    parser.add_argument("--dump", metavar="FILE", default=None,
+        help="write each loaded program to FILE when it is started")
+    parser.add_argument("--max-baud", type=int, default=None,
+        help="the fastest baud rate the simulated cable can carry, default: no limit")
+    parser.add_argument("--uart-timing", action="store_true",
+        help="only accept bytes as fast as the current baud rate could deliver them")
+    parser.add_argument("--fifo", type=int, default=FIFO_DEPTH, metavar="BYTES",
+        help="receive FIFO depth used with --uart-timing, default: %(default)s")
+    parser.add_argument("--drop-rate", type=float, default=0.0, metavar="P",
+        help="lose each received byte with probability P, default: %(default)s")
+    parser.add_argument("--drop-last-ack", action="store_true",
+        help="lose the ACK for the last chunk of the first binary upload, so piterm has to resend it")
+    parser.add_argument("--legacy", action="store_true",
+        help="behave like a bootloader from before the binary requests, which only takes ihex")
+    parser.add_argument("--say", action="append", default=[], metavar="LINE",
+        help="print LINE once a program is started, as if the program had printed it")
+    parser.add_argument("--once", action="store_true",
+        help="exit after the first program is started instead of waiting for another one")
+    args = parser.parse_args(argv)
+
+    # Keep the slave end open, otherwise reads on the master fail while piterm isn't connected
+    master, slave, name = open_pty()
+    sys.stderr.write('--- Simulated bootloader on {} ---\n'.format(name))
+
+    def reset(signum, frame):
+        raise Reset()
+    signal.signal(signal.SIGUSR1, reset)
+    try:
+        while True:
+            try:
+                board = SimBootloader(master, args.max_baud, args.uart_timing, args.fifo, args.drop_rate,
+                    args.drop_last_ack, args.legacy)
+                board.run()
+                for line in args.say:
+                    board.put_string(line + '\r\n')
+                image = board.image()
+                sys.stderr.write('--- Started program, {} bytes at {:#x} ({} baud) ---\n'.format(
+                    len(image), RPI_BOOT, board.baud))
+                if args.dump:
+                    with open(args.dump, 'wb') as f:
+                        f.write(image)
+            except Reset:
+                sys.stderr.write('--- Reset ---\n')
+                continue
+            if args.once:
+                break
+    except KeyboardInterrupt:
+        pass
+    finally:
+        os.close(master)
+        os.close(slave)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -3,81 +3,1766 @@
 # Copyright (c) 2017 Binder News
 # This software is licensed under the MIT License. See LICENSE for details.
 #
-# This program downloads PySerial and installs it to the user's install directory
-# (not site-wide) if it's not already installed. Then it subclasses the Miniterm
-# tool and injects an extra menu option: Ctrl+T, Ctrl+S which will send whatever
-# file the user specified on the command line over the serial port.
+# This program needs PySerial (`python -m pip install --user pyserial`). It subclasses
+# the Miniterm tool and injects an extra menu option: Ctrl+T, Ctrl+S which will send
+# whatever file the user specified on the command line over the serial port.
 # Basically it's miniterm but with this one extra feature.
 #
+# Files can be sent as Intel HEX text or, with --protocol binary, as a raw image
+# using the bootloader's framed binary protocol which is about half the size on the wire.
+# Adding --compress shrinks binary uploads further, kernel images are mostly zeros and
+# repetitive code. The bootloader expands them in place and it falls back to sending the
+# image as it is when compressing wouldn't save much.
+# Either way piterm takes kernel7.img or the linked ELF file directly, there's no need
+# to build a .hex file first.
+# With --verify, ihex uploads are checked against the checksums the bootloader reports
+# at the end and only the 64K segments that didn't arrive intact are sent again.
+# pisim.py simulates the bootloader end so this can be tried without a Pi.
+#
+# `piterm flash --ports ...` uploads to several boards in parallel and
+# `piterm console --ports ...` shows all of their output at once.
+# `piterm capture PORT --log FILE` saves everything a board sends without losing any of it
+# to a slow terminal, optionally with the time each line arrived.
+# `piterm run FILE --ports ... --expect PASS` is for test pipelines: it waits for the bootloader,
+# uploads, starts the program and checks its output, on any number of boards at once.
+#
 
 from __future__ import print_function
 
+import binascii
+import collections
+import glob
+import hashlib
+import io
+import json
 import os
+import re
+import struct
 import sys
+import threading
+import time
+import zlib
+
+def import_serial():
+    """ Returns the serial module, or exits with instructions if pyserial isn't installed.
+    It's imported on first use rather than at startup because it's the slowest part of starting piterm.
+    """
+    try:
+        import serial
+    except ImportError:
+        sys.stderr.write('piterm needs pyserial, install it with:\n    "{}" -m pip install --user pyserial\n'.format(
+            sys.executable))
+        sys.exit(1)
+    return serial
+
+# Default transmit queue thresholds (in bytes) used while streaming a file.
+# Once more than HIGH_WATER bytes are waiting we sleep until only LOW_WATER remain,
+# so the UART always has data to send but we never block on a full OS buffer.
+HIGH_WATER = 4096
+LOW_WATER = 1024
+BLOCK_SIZE = 1024
+
+# Asking which requests the bootloader understands, keep in sync with load_program() in
+# bootloader/source/main.c. One from before them ignores HELLO_REQUEST and takes any 'g' in their
+# frames as "start the program", so nothing binary is sent until it has answered.
+HELLO_REQUEST = b'\x02'
+PROTOCOL_VERSION = 1
+
+# Framed binary protocol, keep in sync with load_binary() in bootloader/source/main.c
+RPI_BOOT = 0x8000
+BIN_START = b'\x01'
+BIN_ACK = b'\x06'
+BIN_NAK = b'\x15'
+CHUNK_SIZE = 4096
+# How long to wait for an ACK once a frame has been sent, and how many times to send it
+REPLY_TIMEOUT = 0.5
+RETRIES = 5
+# The bootloader only finishes a transfer once the line has been quiet this long after the last
+# chunk, in case its ACK was lost and the chunk is resent. Keep it longer than REPLY_TIMEOUT.
+QUIET_TIME = 0.75
+
+# Compressed binary uploads, keep in sync with decompress() in bootloader/source/main.c
+BIN_FLAG_LZ4 = 0x0001
+# The bootloader ACKs once the image has been expanded, a plain memory copy so it doesn't take long
+DECOMPRESS_TIMEOUT = 5.0
+# Only send the compressed image if it's at least this much smaller
+MIN_SAVING = 0.1
+# LZ4 block format (https://github.com/lz4/lz4/blob/dev/doc/lz4_Block_format.md)
+LZ4_MIN_MATCH = 4
+LZ4_MAX_OFFSET = 0xFFFF
+# The last match has to start this far from the end and the last few bytes are always literals
+LZ4_MF_LIMIT = 12
+LZ4_LAST_LITERALS = 5
+# After this many positions in a row without a match the search starts skipping ahead
+LZ4_SKIP_TRIGGER = 6
+
+# Baud rate negotiation, keep in sync with negotiate_baud() in bootloader/source/main.c
+BASE_BAUD = 115200
+BAUD_REQUEST = b'\x05'
+BAUD_PROBE = b'\x55\xaa\x00\xffPITERM\x0f\xf0'
+BAUD_TIMEOUT = 0.5
+# Rates worth trying, fastest first. The Pi's UART can't go past UART_CLOCK / 16 = 3000000.
+STANDARD_BAUDS = [3000000, 2000000, 1500000, 1000000, 921600, 460800, 230400]
+
+# Asking the bootloader what is in memory, keep in sync with report_crc() in bootloader/source/main.c
+CRC_REQUEST = b'\x03'
+# Long enough for the bootloader to add up the whole program area
+CRC_TIMEOUT = 2.0
+
+# Where piterm remembers what it last sent to each port, for --delta uploads
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'piterm')
+DELTA_BLOCK_SIZE = 256
+# Each piece of a binary delta upload is a transfer of its own, which costs about this many seconds
+# on top of its data (the bootloader's quiet time and letting its message through). A gap that would
+# take less time than that to send is sent along with the pieces either side of it.
+PIECE_OVERHEAD = QUIET_TIME + 0.1
+# The bootloader prints this when it starts, so the board has forgotten the last upload
+BOOT_BANNER = 'Bootloader waiting...'
+
+# piterm capture: how much received data can wait for the log writer, how often it writes and
+# how often the terminal is updated
+CAPTURE_BUFFER = 4 * 1024 * 1024
+CAPTURE_FLUSH = 0.2
+CAPTURE_INTERVAL = 1.0
+# Lines longer than this are cut up for the display, the log always gets everything
+DISPLAY_LINE = 4096
+
+# piterm run exit codes, the worst board decides
+RUN_PASSED = 0
+RUN_FAILED = 1
+RUN_TIMED_OUT = 3
+RUN_ERROR = 4
+# load_program() prints this just before jumping to the program
+START_MARKER = b'\r--\r\n\n'
+# Lines longer than this are checked in pieces
+MATCH_LINE = 65536
+
+# Verified ihex uploads, see report_sums() in bootloader/source/main.c
+SUM_LINE = re.compile(br'-- Sum ([0-9A-F]{8}) ([0-9A-F]{8})')
+LOADED_LINE = b"-- Press 'g'"
+SUM_TIMEOUT = 2.0
+
+class UploadError(Exception):
+    pass
+
+def line_rate(serial_port):
+    """ Returns the number of data bytes per second the port can carry. """
+    s = serial_port
+    bits = 1 + s.bytesize + s.stopbits + (0 if s.parity == 'N' else 1)
+    return s.baudrate / float(bits)
+
+def crc32(data):
+    return zlib.crc32(data) & 0xFFFFFFFF
+
+def bootloader_version(serial_port):
+    """ Returns the PROTOCOL_VERSION the bootloader speaks, or None if it didn't answer, in which case
+    it only takes ihex (or isn't waiting for a program). Nothing else may be reading from the port while this runs.
+    """
+    old_timeout = serial_port.timeout
+    serial_port.timeout = REPLY_TIMEOUT
+    try:
+        serial_port.reset_input_buffer()
+        serial_port.write(HELLO_REQUEST)
+        reply = serial_port.read(2)
+        return bytearray(reply)[1] if len(reply) == 2 and reply[:1] == BIN_ACK else None
+    finally:
+        serial_port.timeout = old_timeout
+
+def negotiate_baud(serial_port, baud):
+    """ Ask the bootloader to switch to a new baud rate.
+    Returns True if both ends are now using it, False if both are still at the old rate.
+    Only ask a bootloader that answered bootloader_version(), the request can hold a 'g'.
+    Nothing else may be reading from the port while this runs.
+    """
+    old_baud = serial_port.baudrate
+    old_timeout = serial_port.timeout
+    request = struct.pack('<I', baud)
+    serial_port.timeout = BAUD_TIMEOUT
+    try:
+        serial_port.reset_input_buffer()
+        serial_port.write(BAUD_REQUEST + request + struct.pack('<I', crc32(request)))
+        # A NAK means the bootloader can't do this rate and is still at the old one
+        if serial_port.read(1) != BIN_ACK or len(serial_port.read(4)) != 4:
+            return False
+        try:
+            # Give the bootloader a moment to reprogram its UART
+            time.sleep(0.01)
+            serial_port.baudrate = baud
+            serial_port.reset_input_buffer()
+            serial_port.write(BAUD_PROBE)
+            if serial_port.read(len(BAUD_PROBE)) == BAUD_PROBE:
+                serial_port.write(BIN_ACK)
+                serial_port.flush()
+                return True
+        except (ValueError, IOError):
+            # Our side can't do this rate
+            pass
+        # The bootloader goes back on its own when it doesn't get an ACK, wait until it has
+        serial_port.baudrate = old_baud
+        time.sleep(2 * BAUD_TIMEOUT)
+        serial_port.reset_input_buffer()
+        return False
+    finally:
+        serial_port.timeout = old_timeout
+
+def board_crc(serial_port, address, length):
+    """ Ask the bootloader for the CRC32 of length bytes of memory from address.
+    Returns None if it didn't answer with one. Only ask a bootloader that answered bootloader_version(),
+    the request can hold a 'g'. Nothing else may be reading from the port while this runs.
+    """
+    old_timeout = serial_port.timeout
+    request = struct.pack('<II', address, length)
+    serial_port.timeout = CRC_TIMEOUT
+    try:
+        serial_port.reset_input_buffer()
+        serial_port.write(CRC_REQUEST + request + struct.pack('<I', crc32(request)))
+        if serial_port.read(1) != BIN_ACK:
+            return None
+        reply = serial_port.read(4)
+        return struct.unpack('<I', reply)[0] if len(reply) == 4 else None
+    finally:
+        serial_port.timeout = old_timeout
+
+def negotiate_fastest(serial_port, max_baud):
+    """ Try max_baud and then the slower standard rates until one works.
+    Returns the baud rate both ends ended up using.
+    """
+    for baud in [max_baud] + [b for b in STANDARD_BAUDS if b < max_baud]:
+        if baud <= serial_port.baudrate:
+            break
+        if negotiate_baud(serial_port, baud):
+            break
+    return serial_port.baudrate
+
+def join_pieces(pieces):
+    """ Returns (address, image) for a list of (address, data) pieces, gaps are filled with zeros. """
+    if not pieces:
+        return RPI_BOOT, bytearray()
+    low = min(address for address, payload in pieces)
+    high = max(address + len(payload) for address, payload in pieces)
+    image = bytearray(high - low)
+    for address, payload in pieces:
+        image[address - low:address - low + len(payload)] = payload
+    return low, image
+
+def read_ihex(data):
+    """ Returns (address, image) for the Intel HEX text in data. """
+    pieces = []
+    upper = 0
+    for line in data.splitlines():
+        line = line.strip()
+        if not line.startswith(b':'):
+            continue
+        record = bytearray(binascii.unhexlify(line[1:]))
+        if sum(record) & 0xFF:
+            raise ValueError('bad checksum in ihex record {}'.format(line.decode('ascii')))
+        count, offset, record_type = record[0], (record[1] << 8) | record[2], record[3]
+        payload = record[4:4 + count]
+        if record_type == 0x00:
+            pieces.append((upper + offset, payload))
+        elif record_type == 0x01:
+            break
+        elif record_type == 0x02:
+            upper = ((payload[0] << 8) | payload[1]) << 4
+        elif record_type == 0x04:
+            upper = ((payload[0] << 8) | payload[1]) << 16
+    return join_pieces(pieces)
+
+def read_elf(data):
+    """ Returns (address, image) for a 32-bit little endian ELF file.
+    Like objcopy -O binary this is every allocated section that has contents.
+    """
+    if data[:4] != b'\x7fELF' or bytearray(data[4:6]) != bytearray([1, 1]):
+        raise ValueError('only 32-bit little endian ELF files are supported')
+    shoff, = struct.unpack_from('<I', data, 32)
+    shentsize, shnum = struct.unpack_from('<HH', data, 46)
+    pieces = []
+    for i in range(shnum):
+        name, sh_type, flags, address, offset, size = struct.unpack_from('<IIIIII', data, shoff + i * shentsize)
+        # SHF_ALLOC and not SHT_NOBITS (.bss)
+        if flags & 0x2 and sh_type != 8 and size:
+            pieces.append((address, data[offset:offset + size]))
+    return join_pieces(pieces)
+
+def read_image(filename, data):
+    """ Returns (address, image) for the contents of a .hex file, an ELF file or a raw kernel image. """
+    if filename.lower().endswith('.hex'):
+        return read_ihex(data)
+    if data[:4] == b'\x7fELF':
+        return read_elf(data)
+    return RPI_BOOT, bytearray(data)
+
+def _lz4_length(out, length):
+    """ Append the extra length bytes for a literal or match length that didn't fit in the token. """
+    while length >= 255:
+        out.append(255)
+        length -= 255
+    out.append(length)
+
+def _lz4_sequence(out, literals, offset=0, match_length=0):
+    literal_length = len(literals)
+    match_code = match_length - LZ4_MIN_MATCH if offset else 0
+    out.append((min(literal_length, 15) << 4) | min(match_code, 15))
+    if literal_length >= 15:
+        _lz4_length(out, literal_length - 15)
+    out += literals
+    if offset:
+        out += struct.pack('<H', offset)
+        if match_code >= 15:
+            _lz4_length(out, match_code - 15)
+
+def _match_length(data, a, b, limit):
+    """ Returns how many bytes starting at a match the ones starting at b, without reading past limit. """
+    # Compare slices instead of single bytes, doubling while they match and halving when they don't
+    length = 0
+    step = 16
+    most = limit - b
+    while step and length < most:
+        size = min(step, most - length)
+        if data[a + length:a + length + size] == data[b + length:b + length + size]:
+            length += size
+            step *= 2
+        else:
+            step //= 2
+    return length
+
+def lz4_compress(data):
+    """ Returns data compressed into an LZ4 block, see decompress() in bootloader/source/main.c.
+
+    A greedy search with one hash table like the reference LZ4 in its fast mode, including
+    its trick of skipping ahead faster and faster through data that doesn't compress.
+    """
+    data = bytes(data)
+    out = bytearray()
+    table = {}
+    anchor = 0
+    pos = 0
+    misses = 0
+    limit = len(data) - LZ4_MF_LIMIT
+    match_limit = len(data) - LZ4_LAST_LITERALS
+    while pos < limit:
+        key = data[pos:pos + LZ4_MIN_MATCH]
+        candidate = table.get(key)
+        table[key] = pos
+        if candidate is None or pos - candidate > LZ4_MAX_OFFSET:
+            misses += 1
+            pos += 1 + (misses >> LZ4_SKIP_TRIGGER)
+            continue
+        misses = 0
+        length = LZ4_MIN_MATCH + _match_length(data, candidate + LZ4_MIN_MATCH, pos + LZ4_MIN_MATCH, match_limit)
+        # The match may start a little earlier than where it was found
+        while pos > anchor and candidate > 0 and data[pos - 1] == data[candidate - 1]:
+            pos -= 1
+            candidate -= 1
+            length += 1
+        _lz4_sequence(out, data[anchor:pos], pos - candidate, length)
+        pos += length
+        anchor = pos
+        if pos < limit:
+            table[data[pos - 2:pos + 2]] = pos - 2
+    _lz4_sequence(out, data[anchor:])
+    return bytes(out)
+
+class CompressedCache(object):
+    """ Compressed versions of recently sent images, so flashing the same image to several
+    boards only compresses it once.
+    """
+    def __init__(self, size=4):
+        self.size = size
+        self.by_hash = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def compress(self, data):
+        """ Returns what load_binary() expects after a header with BIN_FLAG_LZ4:
+        the image's length followed by the LZ4 block.
+        """
+        digest = hashlib.sha1(data).hexdigest()
+        # Held while compressing so boards being flashed in parallel wait for the first one
+        with self.lock:
+            if digest not in self.by_hash:
+                self.by_hash[digest] = struct.pack('<I', len(data)) + lz4_compress(data)
+                while len(self.by_hash) > self.size:
+                    self.by_hash.popitem(last=False)
+            return self.by_hash[digest]
+
+COMPRESSED_CACHE = CompressedCache()
+
+def ihex_record(record_type, address, payload):
+    record = bytearray([len(payload), (address >> 8) & 0xFF, address & 0xFF, record_type]) + payload
+    record.append(-sum(record) & 0xFF)
+    return b':' + binascii.hexlify(record).upper() + b'\n'
+
+def ihex_data_records(address, data, records_per_chunk):
+    """ Yields data records for a run of data that stays inside one 64K segment. """
+    # Hex encode the whole run in one go and slice each record out of it
+    digits = binascii.hexlify(data).upper()
+    out = []
+    for pos in range(0, len(data), 16):
+        count = min(16, len(data) - pos)
+        offset = (address + pos) & 0xFFFF
+        check = -(count + (offset >> 8) + (offset & 0xFF) + sum(data[pos:pos + count])) & 0xFF
+        out.append(b':%02X%04X00%s%02X\n' % (count, offset, digits[2 * pos:2 * (pos + count)], check))
+        if len(out) == records_per_chunk:
+            yield b''.join(out)
+            out = []
+    if out:
+        yield b''.join(out)
+
+def ihex_chunks(segments, records_per_chunk=64):
+    """ Yields the Intel HEX encoding of a list of (address, data) pieces, a few records at a time.
+
+    load_program() stores whole words, so addresses must be word aligned and data is padded
+    with zeros to a multiple of 4. Every piece starts with its own segment record.
+    """
+    for address, data in segments:
+        if address % 4:
+            raise ValueError('{:#x} is not word aligned'.format(address))
+        if len(data) % 4:
+            data = bytearray(data) + bytearray(-len(data) % 4)
+        if address + len(data) > 0x100000:
+            raise ValueError('ihex uploads only reach the first 1MB, use --protocol binary')
+        data = memoryview(data)
+        pos = 0
+        while pos < len(data):
+            current = address + pos
+            # Records never cross into the next segment
+            run = min(len(data) - pos, 0x10000 - (current & 0xFFFF))
+            yield ihex_record(0x02, 0, bytearray([(current >> 16) << 4, 0]))
+            for chunk in ihex_data_records(current, data[pos:pos + run], records_per_chunk):
+                yield chunk
+            pos += run
+    yield ihex_record(0x01, 0, bytearray())
+
+def write_ihex(segments):
+    """ Returns the Intel HEX encoding of a list of (address, data) pieces. """
+    return b''.join(ihex_chunks(segments))
+
+def split_segments(segments):
+    """ Returns {segment address: [(address, data), ...]} for a list of (address, data) pieces.
+    Pieces are cut at 64K boundaries and padded to whole words like ihex_chunks() does,
+    so they can be checked against the bootloader's sum for each segment.
+    """
+    result = collections.OrderedDict()
+    for address, data in segments:
+        if len(data) % 4:
+            data = bytearray(data) + bytearray(-len(data) % 4)
+        pos = 0
+        while pos < len(data):
+            current = address + pos
+            run = min(len(data) - pos, 0x10000 - (current & 0xFFFF))
+            result.setdefault(current & ~0xFFFF, []).append((current, data[pos:pos + run]))
+            pos += run
+    return result
+
+def segment_sum(pieces):
+    """ The bootloader's checksum of one segment: the address plus the value of every word stored. """
+    total = 0
+    for address, data in pieces:
+        count = len(data) // 4
+        total += sum(struct.unpack('<%dI' % count, bytes(data))) + count * address + 2 * count * (count - 1)
+    return total & 0xFFFFFFFF
+
+class IhexCache(object):
+    """ Intel HEX encodings of recently sent files, so sending an unchanged image again costs nothing.
+    Files are recognised by modification time and size, or failing that by their contents.
+    The least recently used encoding is dropped first. Parallel flashes share one cache, so
+    every change to it is made with the lock held.
+    """
+    def __init__(self, size=4):
+        self.size = size
+        self.lock = threading.Lock()
+        # path: (mtime, size, digest) of what it held when it was last read
+        self.by_stat = {}
+        self.by_hash = collections.OrderedDict()
+
+    def encode(self, f):
+        """ Returns the encoding of the open file f as an iterable of bytes.
+        The first time a file is seen it's encoded as it is sent.
+        """
+        st = os.fstat(f.fileno())
+        path = os.path.abspath(f.name)
+        with self.lock:
+            mtime, size, digest = self.by_stat.get(path, (None, None, None))
+            if (mtime, size) == (st.st_mtime, st.st_size) and digest in self.by_hash:
+                return self._hit(digest)
+        data = f.read()
+        digest = hashlib.sha1(data).hexdigest()
+        with self.lock:
+            self.by_stat[path] = (st.st_mtime, st.st_size, digest)
+            if digest in self.by_hash:
+                return self._hit(digest)
+        return self._remember(digest, ihex_chunks([read_image(f.name, data)]))
+
+    def _hit(self, digest):
+        self.by_hash.move_to_end(digest)
+        return self.by_hash[digest]
+
+    def _remember(self, digest, chunks):
+        done = []
+        for chunk in chunks:
+            done.append(chunk)
+            yield chunk
+        with self.lock:
+            self.by_hash[digest] = done
+            while len(self.by_hash) > self.size:
+                dropped, _ = self.by_hash.popitem(last=False)
+                for path in [p for p, (_, _, d) in self.by_stat.items() if d == dropped]:
+                    del self.by_stat[path]
+
+IHEX_CACHE = IhexCache()
+
+class DeltaCache(object):
+    """ Remembers block hashes of the last image sent to a port, so the next upload can skip
+    the blocks that haven't changed. Resetting the board zeroes the image, so Flasher checks
+    with board_crc() that the board still has it first.
+    """
+    def __init__(self, port, directory=CACHE_DIR, block_size=DELTA_BLOCK_SIZE):
+        self.path = os.path.join(directory, re.sub(r'[^\w.-]', '_', port) + '.json')
+        self.block_size = block_size
 
-def install_package(package):
-    """Install a pip package to the user's site-packages directory."""
-    import pip
-    exitval = pip.main(['install', '--user', package])
-    if exitval == 0:
-        # Reload sys.path to make sure the user's site-packages are in sys.path
-        import site
-        site.main()
-    return exitval == 0
-
-try:
-    import serial
-    from serial.tools.miniterm import Miniterm, key_description
-except ImportError:
-    install_package('pyserial')
-    import serial
-    from serial.tools.miniterm import Miniterm, key_description
-
-class MyMiniterm(Miniterm):
-    def handle_menu_key(self, c):
-        #print('{:#x}'.format(ord(c)))
-        # Ctrl+T, Ctrl+S
-        if c == '\x13':
-            self.upload_specific_file(self.upload_file_name)
+    def _hashes(self, image):
+        return [hashlib.sha1(image[i:i + self.block_size]).hexdigest()
+                for i in range(0, len(image), self.block_size)]
+
+    def last(self):
+        """ Returns what was saved about the last upload, or None. """
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def changed(self, address, image, gap=0):
+        """ Returns the (address, data) pieces of image that differ from the last upload.
+        Everything is returned if the board doesn't have a matching image.
+        Pieces up to gap bytes apart are joined into one.
+        """
+        last = self.last()
+        if not last or last['address'] != address or last['block_size'] != self.block_size:
+            return [(address, image)] if image else []
+        old = last['hashes']
+        new = self._hashes(image)
+        return self._pieces(address, image, gap, lambda i, block: i >= len(old) or old[i] != new[i])
+
+    def nonzero(self, address, image, gap=0):
+        """ Returns the (address, data) pieces of image that aren't all zeros, which is all a board
+        needs once a reset has zeroed its program area. Pieces up to gap bytes apart are joined into one.
+        """
+        return self._pieces(address, image, gap, lambda i, block: block.count(0) != len(block))
+
+    def _pieces(self, address, image, gap, wanted):
+        """ Returns image's blocks that wanted(index, block) is True for, as (address, data) pieces. """
+        segments = []
+        for i, start in enumerate(range(0, len(image), self.block_size)):
+            block = image[start:start + self.block_size]
+            if not wanted(i, block):
+                continue
+            # Merge runs of blocks, and the short gaps between them, into one piece
+            end = segments[-1][0] + len(segments[-1][1]) - address if segments else None
+            if segments and start - end <= gap:
+                segments[-1][1].extend(image[end:start + self.block_size])
+            else:
+                segments.append((address + start, bytearray(block)))
+        return segments
+
+    def save(self, address, image):
+        if not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'w') as f:
+            json.dump({'address': address, 'size': len(image), 'crc': crc32(image), 'block_size': self.block_size,
+                'hashes': self._hashes(image)}, f)
+
+    def invalidate(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+class BannerWatch(object):
+    """ Calls callback whenever the bootloader's banner shows up in the received text.
+    Miniterm only calls rx() on its rx_transformations, so this doesn't need to subclass its Transform.
+    """
+    def __init__(self, callback):
+        self.callback = callback
+        self.tail = ''
+
+    def rx(self, text):
+        seen = self.tail + text
+        if BOOT_BANNER in seen:
+            self.callback()
+        # Keep enough to spot a banner that is split across reads
+        self.tail = seen[-(len(BOOT_BANNER) - 1):]
+        return text
+
+class UploadStats(object):
+    """ Size and timing of a finished upload. wire_size is how many bytes that took to send,
+    if it isn't size. """
+    def __init__(self, size, elapsed, line_rate, wire_size=None):
+        self.size = size
+        self.elapsed = elapsed
+        self.line_rate = line_rate
+        self.wire_size = size if wire_size is None else wire_size
+
+    @property
+    def rate(self):
+        """ Bytes per second actually achieved. """
+        return self.size / self.elapsed if self.elapsed > 0 else 0.0
+
+    @property
+    def efficiency(self):
+        """ Achieved rate as a percentage of the theoretical line rate. """
+        return 100.0 * self.rate / self.line_rate if self.line_rate > 0 else 0.0
+
+    def __str__(self):
+        text = '{} bytes in {:.2f}s, {:.0f} bytes/s ({:.0f}% of line rate)'.format(
+            self.size, self.elapsed, self.rate, self.efficiency)
+        if self.wire_size != self.size:
+            text += ', compressed to {} bytes'.format(self.wire_size)
+        return text
+
+class StreamUploader(object):
+    """ Streams data to a serial port while keeping its transmit queue full.
+
+    Works with anything that looks like a serial.Serial, so it can be pointed at a pty.
+    """
+    def __init__(self, serial_port, high_water=HIGH_WATER, low_water=LOW_WATER, block_size=BLOCK_SIZE):
+        if low_water >= high_water:
+            raise ValueError('low water mark must be below the high water mark')
+        self.serial = serial_port
+        self.high_water = high_water
+        self.low_water = low_water
+        self.block_size = block_size
+
+    def _out_waiting(self):
+        # Not every platform can report the queue size, in which case write() just blocks
+        try:
+            return self.serial.out_waiting
+        except (AttributeError, NotImplementedError, IOError):
+            return None
+
+    def _throttle(self):
+        """ Sleep until the transmit queue drops below the low water mark, if it's above the high one. """
+        waiting = self._out_waiting()
+        if waiting is None or waiting <= self.high_water:
+            return
+        rate = line_rate(self.serial)
+        while waiting is not None and waiting > self.low_water:
+            time.sleep((waiting - self.low_water) / rate)
+            waiting = self._out_waiting()
+
+    def send(self, source, progress=None):
+        """ Send everything from source, a file-like object or an iterable of bytes. Returns an UploadStats.
+        progress is called with the total number of bytes queued after each block.
+        """
+        if hasattr(source, 'read'):
+            blocks = iter(lambda: source.read(self.block_size), b'')
+        else:
+            blocks = iter(source)
+        start = time.time()
+        sent = 0
+        block = next(blocks, None)
+        while block is not None:
+            self.serial.write(block)
+            sent += len(block)
+            # Get the next block ready while the UART is busy with this one
+            block = next(blocks, None)
+            self._throttle()
+            if progress:
+                progress(sent)
+        # Only wait for the line to drain once, at the very end
+        self.serial.flush()
+        return UploadStats(sent, time.time() - start, line_rate(self.serial))
+
+class BinaryUploader(object):
+    """ Sends a raw image with the framed binary protocol, the bootloader ACKs or NAKs every frame.
+
+    With compress, the image is sent LZ4 compressed if that makes it at least MIN_SAVING smaller.
+    It's sent as it is if the bootloader is too old to understand that.
+
+    The caller must make sure nothing else is reading from the port while this runs.
+    """
+    def __init__(self, serial_port, address=RPI_BOOT, chunk_size=CHUNK_SIZE, retries=RETRIES,
+                 compress=False, log=None):
+        self.serial = serial_port
+        self.address = address
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.compress = compress
+        self.log = log or (lambda message: None)
+
+    def _try_exchange(self, frame):
+        """ Send frame until the bootloader ACKs it, returns False if it never does. """
+        # Allow for the time it takes to actually send the frame
+        self.serial.timeout = REPLY_TIMEOUT + len(frame) / line_rate(self.serial)
+        for attempt in range(self.retries):
+            self.serial.write(frame)
+            reply = self.serial.read(1)
+            if reply == BIN_ACK:
+                return True
+        return False
+
+    def _exchange(self, frame, what):
+        if not self._try_exchange(frame):
+            raise UploadError('{} was not acknowledged after {} attempts'.format(what, self.retries))
+
+    def _header(self, length, flags):
+        header = struct.pack('<IIHH', self.address, length, self.chunk_size, flags)
+        return BIN_START + header + struct.pack('<I', crc32(header))
+
+    def _send_chunks(self, data, progress, scale=1.0):
+        for seq, offset in enumerate(range(0, len(data), self.chunk_size)):
+            payload = data[offset:offset + self.chunk_size]
+            body = struct.pack('<HH', seq, len(payload)) + payload.tobytes()
+            self._exchange(body + struct.pack('<I', crc32(body)), 'chunk {}'.format(seq))
+            if progress:
+                progress(int((offset + len(payload)) * scale))
+
+    def _send_compressed(self, data, packed, progress):
+        """ Returns True once the bootloader has expanded packed into data, False if it can't. """
+        if not self._try_exchange(self._header(len(packed), BIN_FLAG_LZ4)):
+            self.log("The bootloader doesn't take compressed uploads, sending it uncompressed")
+            return False
+        self._send_chunks(memoryview(packed), progress, len(data) / float(len(packed)))
+        # One more reply once the image has been expanded
+        if self._finish(DECOMPRESS_TIMEOUT):
+            return True
+        self.log("The bootloader couldn't decompress the image, sending it uncompressed")
+        return False
+
+    def _finish(self, extra=0.0):
+        """ Returns True if the bootloader ends the transfer with an ACK, which it only sends once the
+        line has been quiet for QUIET_TIME, plus extra seconds of work.
+        """
+        self.serial.timeout = QUIET_TIME + REPLY_TIMEOUT + extra
+        return self.serial.read(1) == BIN_ACK
+
+    def send(self, data, progress=None):
+        """ Send the bytes in data, returns an UploadStats.
+        progress is called with the total number of bytes acknowledged after each chunk.
+        """
+        data = memoryview(data)
+        old_timeout = self.serial.timeout
+        start = time.time()
+        try:
+            if self.compress:
+                packed = COMPRESSED_CACHE.compress(data)
+                if len(packed) <= len(data) * (1 - MIN_SAVING):
+                    if self._send_compressed(data, packed, progress):
+                        return UploadStats(len(data), time.time() - start, line_rate(self.serial), len(packed))
+                else:
+                    self.log('Compressed it would still be {:.0f}% of its size, sending it uncompressed'.format(
+                        100.0 * len(packed) / max(len(data), 1)))
+            self._exchange(self._header(len(data), 0), 'header')
+            self._send_chunks(data, progress)
+            if not self._finish():
+                raise UploadError('the bootloader never finished the upload')
+        finally:
+            self.serial.timeout = old_timeout
+        return UploadStats(len(data), time.time() - start, line_rate(self.serial))
+
+class Flasher(object):
+    """ Gets a file onto a board: picks the protocol, negotiates the baud rate and does delta uploads.
+    Nothing else may be reading from the port while it runs.
+
+    echo is called with anything the board says in the middle of an upload,
+    log with messages about how the upload is going.
+    """
+    def __init__(self, serial_port, protocol='ihex', max_baud=BASE_BAUD, delta_cache=None,
+                 high_water=HIGH_WATER, low_water=LOW_WATER, verify=False, compress=False, echo=None, log=None):
+        self.serial = serial_port
+        self.protocol = protocol
+        self.compress = compress and protocol == 'binary'
+        # Binary uploads are always checked, this is for ihex
+        self.verify = verify and protocol == 'ihex'
+        self.max_baud = max_baud
+        self.delta_cache = delta_cache
+        self.high_water = high_water
+        self.low_water = low_water
+        self.echo = echo
+        self.log = log or (lambda message: None)
+
+    def needs_replies(self):
+        """ True if the upload has to read from the port as well as write to it. """
+        return (self.protocol == 'binary' or self.verify or self.max_baud > self.serial.baudrate
+            or self.delta_cache is not None)
+
+    def needs_hello(self):
+        """ True if the upload sends binary requests, which the bootloader has to answer HELLO_REQUEST for first. """
+        return self.protocol == 'binary' or self.max_baud > self.serial.baudrate or self.delta_cache is not None
+
+    def upload(self, f, progress=None):
+        """ Upload the open file f, returns an UploadStats.
+        If allowed, the baud rate is raised for the upload and put back afterwards.
+        A bootloader that doesn't answer HELLO_REQUEST is sent plain ihex instead.
+        """
+        if self.needs_hello() and (bootloader_version(self.serial) or 0) < PROTOCOL_VERSION:
+            self.log("The bootloader didn't say it takes binary requests, sending plain ihex. "
+                'If it was built before they were added, rebuild it (see Readme.md)')
+            return Flasher(self.serial, high_water=self.high_water, low_water=self.low_water, echo=self.echo,
+                log=self.log).upload(f, progress)
+        base_baud = self.serial.baudrate
+        if self.max_baud > base_baud:
+            self.log('Negotiated {} baud'.format(negotiate_fastest(self.serial, self.max_baud)))
+        try:
+            if self.delta_cache:
+                return self.upload_delta(f, progress)
+            uploader = StreamUploader(self.serial, self.high_water, self.low_water)
+            if self.protocol == 'binary':
+                address, image = read_image(f.name, f.read())
+                return BinaryUploader(self.serial, address, compress=self.compress, log=self.log).send(image, progress)
+            if self.verify:
+                return self.send_segments([read_image(f.name, f.read())], progress)
+            if f.name.lower().endswith('.hex'):
+                return uploader.send(f, progress)
+            # Images and ELF files are encoded on the fly, no .hex file needed
+            return uploader.send(IHEX_CACHE.encode(f), progress)
+        finally:
+            if self.serial.baudrate != base_baud:
+                # Show what the bootloader had to say before its replies get in the way
+                self.pass_through()
+                if not negotiate_baud(self.serial, base_baud):
+                    self.log('WARNING: could not go back to {} baud'.format(base_baud))
+
+    def upload_delta(self, f, progress=None):
+        """ Send only the parts of the file that changed since the last upload to this board.
+        That needs the board to still have the last upload, which it only does until it's reset:
+        boot.s zeroes the program area every time, so after the usual upload, run, reset there is
+        nothing left to compare with. A zeroed board is sent the blocks that aren't all zeros instead.
+        """
+        address, image = read_image(f.name, f.read())
+        # Only binary uploads pay for each piece, ihex sends them all in one go
+        gap = int(line_rate(self.serial) * PIECE_OVERHEAD) if self.protocol == 'binary' else 0
+        last = self.delta_cache.last()
+        if last and board_crc(self.serial, last['address'], last.get('size', 0)) == last.get('crc'):
+            segments = self.delta_cache.changed(address, image, gap)
+            if not segments:
+                self.log('Nothing changed since the last upload')
+        elif image and board_crc(self.serial, address, len(image)) == crc32(bytearray(len(image))):
+            segments = self.delta_cache.nonzero(address, image, gap)
+            self.log("The board's program area has been zeroed, sending {} of {} bytes and skipping zeros".format(
+                sum(len(data) for _, data in segments), len(image)))
         else:
-            super().handle_menu_key(c)
+            if last:
+                self.log("The board doesn't have the last upload any more, sending everything")
+            segments = [(address, image)] if image else []
+        stats = self.send_segments(segments, progress)
+        self.delta_cache.save(address, image)
+        return stats
+
+    def send_segments(self, segments, progress=None):
+        """ Send a list of (address, data) pieces with the current protocol. """
+        start = time.time()
+        size = 0
+        wire_size = 0
+        if self.protocol == 'binary':
+            for index, (address, data) in enumerate(segments):
+                if index:
+                    # Let what the bootloader printed after the last piece through, so it isn't taken for a reply
+                    self.pass_through()
+                stats = BinaryUploader(self.serial, address, compress=self.compress, log=self.log).send(data, progress)
+                size += stats.size
+                wire_size += stats.wire_size
+        elif segments and self.verify:
+            size = self.send_verified(segments, progress)
+        elif segments:
+            size = StreamUploader(self.serial, self.high_water, self.low_water).send(
+                io.BytesIO(write_ihex(segments)), progress).size
+        return UploadStats(size, time.time() - start, line_rate(self.serial), wire_size or None)
 
-    def upload_specific_file(self, filename):
+    def send_verified(self, segments, progress=None):
+        """ Send segments as ihex and check the bootloader's sums, resending the 64K segments
+        that didn't arrive intact. Returns the number of bytes sent.
+        """
+        everything = split_segments(segments)
+        pending = everything
+        size = 0
+        for attempt in range(RETRIES):
+            pieces = [piece for base in pending for piece in pending[base]]
+            size += StreamUploader(self.serial, self.high_water, self.low_water).send(
+                ihex_chunks(pieces), progress).size
+            sums = self.read_sums()
+            # A garbled segment record sends data to the wrong segment, so a sum for a segment
+            # that wasn't sent this time means it has been overwritten
+            bad = [base for base in everything
+                if (sums.get(base) != segment_sum(everything[base]) if base in pending else base in sums)]
+            if not bad:
+                return size
+            self.log('Resending {} of {} segments: {}'.format(len(bad), len(everything),
+                ', '.join('{:#x}'.format(base) for base in bad)))
+            pending = collections.OrderedDict((base, everything[base]) for base in bad)
+        raise UploadError('segments still not verified after {} tries, is the bootloader up to date?'.format(RETRIES))
+
+    def read_sums(self):
+        """ Returns {segment address: sum} from the report the bootloader prints at the end of an ihex upload.
+        If the End of File record got lost there's no report, so nothing will match and it all gets resent.
+        """
+        old_timeout = self.serial.timeout
+        self.serial.timeout = SUM_TIMEOUT
+        text = b''
+        try:
+            while LOADED_LINE not in text:
+                data = self.serial.read(self.serial.in_waiting or 1)
+                if not data:
+                    break
+                if self.echo:
+                    self.echo(data)
+                text += data
+        finally:
+            self.serial.timeout = old_timeout
+        return dict((int(base, 16), int(value, 16)) for base, value in SUM_LINE.findall(text))
+
+    def pass_through(self, quiet=0.1):
+        """ Hand whatever the board sends to echo until it has been quiet for a while. """
+        old_timeout = self.serial.timeout
+        self.serial.timeout = quiet
         try:
+            while True:
+                data = self.serial.read(self.serial.in_waiting or 1)
+                if not data:
+                    break
+                if self.echo:
+                    self.echo(data)
+        finally:
+            self.serial.timeout = old_timeout
+
+_miniterm_class = None
+
+def miniterm_class():
+    """ Returns MyMiniterm, pyserial's Miniterm with the upload menu added.
+    The class is built the first time it's needed so `piterm flash`, `piterm console` and --help
+    don't have to import miniterm.
+    """
+    global _miniterm_class
+    if _miniterm_class is None:
+        import_serial()
+        from serial.tools.miniterm import Miniterm
+
+        class MyMiniterm(Miniterm):
+            delta_cache = None
+
+            def update_transformations(self):
+                super().update_transformations()
+                self.rx_transformations.append(BannerWatch(self.board_reset))
+
+            def board_reset(self):
+                # Whatever we sent before has been zeroed, so the next upload can't be a delta
+                if self.delta_cache:
+                    self.delta_cache.invalidate()
+
+            def handle_menu_key(self, c):
+                #print('{:#x}'.format(ord(c)))
+                # Ctrl+T, Ctrl+S
+                if c == '\x13':
+                    self.upload_specific_file(self.upload_file_name)
+                else:
+                    super().handle_menu_key(c)
+
+            def upload_specific_file(self, filename):
+                # Progress indicator, one dot per block.
+                progress = lambda sent: sys.stderr.write('.')
+                log = lambda message: sys.stderr.write('\n--- {} ---\n'.format(message))
+                flasher = Flasher(self.serial, delta_cache=self.delta_cache, echo=self.console.write_bytes, log=log,
+                    **self.upload_options)
+                try:
+                    with open(filename, 'rb') as f:
+                        sys.stderr.write('--- Sending file {} ---\n'.format(filename))
+                        if flasher.needs_replies():
+                            # Pause the reader thread so we get to see the bootloader's replies
+                            self._stop_reader()
+                            try:
+                                stats = flasher.upload(f, progress)
+                            finally:
+                                self._start_reader()
+                        else:
+                            stats = flasher.upload(f, progress)
+                    sys.stderr.write('\n--- File {} sent: {} ---\n'.format(filename, stats))
+                except IOError as e:
+                    sys.stderr.write('--- ERROR opening file {}: {} ---\n'.format(filename, e))
+                except UploadError as e:
+                    sys.stderr.write('\n--- ERROR sending file {}: {} ---\n'.format(filename, e))
+
+            def set_upload_file(self, fname):
+                self.upload_file_name = fname
+
+            def set_upload_options(self, **options):
+                """ Keyword arguments for the Flasher used by upload_specific_file. """
+                self.upload_options = options
+
+            def set_delta_cache(self, cache):
+                self.delta_cache = cache
+
+        _miniterm_class = MyMiniterm
+    return _miniterm_class
+
+def port_tag(port):
+    """ A short name for a port, used to label its output. """
+    return os.path.basename(port)
+
+def expand_ports(patterns, default_file):
+    """ Returns a list of (port, file) from command line arguments.
+    Wildcards are expanded here because not every shell does it, and PORT=FILE
+    picks a different file for one board.
+    """
+    boards = []
+    for pattern in patterns:
+        pattern, _, filename = pattern.partition('=')
+        ports = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        boards.extend((port, filename or default_file) for port in ports)
+    return boards
+
+class FlashStatus(object):
+    """ Progress of several uploads at once, drawn as a single status line. """
+    def __init__(self, ports, interval=0.5):
+        self.lock = threading.Lock()
+        self.sent = dict((port, 0) for port in ports)
+        self.ports = ports
+        self.interval = interval
+        self.last_draw = 0
+
+    def update(self, port, sent):
+        with self.lock:
+            self.sent[port] = sent
+            now = time.time()
+            if now - self.last_draw >= self.interval:
+                self.last_draw = now
+                sys.stderr.write('\r' + '  '.join('{}: {}KB'.format(port_tag(p), self.sent[p] // 1024)
+                    for p in self.ports))
+
+    def message(self, port, text):
+        with self.lock:
+            sys.stderr.write('\n--- {}: {} ---\n'.format(port_tag(port), text))
+
+def flash_board(port, filename, options, status, boot=False):
+    """ Upload filename to the board on port and optionally start it. Returns an UploadStats. """
+    serial_port = import_serial().Serial(port, BASE_BAUD)
+    try:
+        delta_cache = DeltaCache(port) if options.get('delta') else None
+        flasher = Flasher(serial_port, delta_cache=delta_cache,
+            log=lambda message: status.message(port, message),
+            **dict((k, v) for k, v in options.items() if k != 'delta'))
+        with open(filename, 'rb') as f:
+            stats = flasher.upload(f, lambda sent: status.update(port, sent))
+        if boot:
+            serial_port.write(b'g')
+            serial_port.flush()
+        return stats
+    finally:
+        serial_port.close()
+
+def tag_lines(port, log_dir, lock, stop):
+    """ Print each line received on port with the port's name in front until stop is set. """
+    tag = port_tag(port)
+    serial = import_serial()
+    try:
+        serial_port = serial.Serial(port, BASE_BAUD, timeout=0.2)
+    except serial.SerialException as e:
+        with lock:
+            sys.stderr.write('--- {}: could not open port: {} ---\n'.format(tag, e))
+        return
+    log = open(os.path.join(log_dir, tag + '.log'), 'ab') if log_dir else None
+    pending = b''
+    try:
+        while not stop.is_set():
+            data = serial_port.read(serial_port.in_waiting or 1)
+            if not data:
+                continue
+            if log:
+                log.write(data)
+                log.flush()
+            lines = (pending + data).split(b'\n')
+            pending = lines.pop()
+            with lock:
+                for line in lines:
+                    sys.stdout.write('[{}] {}\n'.format(tag, line.rstrip(b'\r').decode('utf-8', 'replace')))
+                sys.stdout.flush()
+    finally:
+        serial_port.close()
+        if log:
+            log.close()
+
+def multiplex(ports, log_dir=None):
+    """ Show the output of every board, one labelled line at a time, until Ctrl+C. """
+    if log_dir and not os.path.isdir(log_dir):
+        os.makedirs(log_dir)
+    lock = threading.Lock()
+    stop = threading.Event()
+    threads = [threading.Thread(target=tag_lines, args=(port, log_dir, lock, stop)) for port in ports]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    sys.stderr.write('--- Watching {} ports, Ctrl+C to quit ---\n'.format(len(ports)))
+    try:
+        while any(thread.is_alive() for thread in threads):
+            time.sleep(0.2)
+    except KeyboardInterrupt:
+        pass
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+class OutputMatcher(object):
+    """ Checks a program's output against regular expressions as it arrives.
+
+    The expect patterns have to match in order, several may match in one line. Any of the
+    fail patterns matching means the test failed. Only the current line is ever searched
+    again, as it grows, so a program that stops without a newline still gets noticed.
+    """
+    def __init__(self, expect, fail=()):
+        self.expect = [re.compile(p.encode('utf-8')) for p in expect]
+        self.fail = re.compile(b'|'.join(b'(?:' + p.encode('utf-8') + b')' for p in fail)) if fail else None
+        self.matched = 0
+        self.failure = None
+        self.line = b''
+        # Where in self.line the next expect pattern starts looking
+        self.line_pos = 0
+
+    @property
+    def passed(self):
+        return self.matched == len(self.expect)
+
+    @property
+    def done(self):
+        return self.passed or self.failure is not None
+
+    def feed(self, data):
+        """ Check the next piece of output, returns True once the result is known. """
+        pos = 0
+        while pos < len(data) and not self.done:
+            newline = data.find(b'\n', pos)
+            end = len(data) if newline < 0 else newline + 1
+            self.line += data[pos:end]
+            pos = end
+            self._check()
+            if newline >= 0 or len(self.line) >= MATCH_LINE:
+                self.line = b''
+                self.line_pos = 0
+        return self.done
+
+    def _check(self):
+        if self.fail:
+            m = self.fail.search(self.line)
+            if m:
+                self.failure = self.line.strip().decode('utf-8', 'replace')
+                return
+        while self.matched < len(self.expect):
+            m = self.expect[self.matched].search(self.line, self.line_pos)
+            if not m:
+                break
+            self.line_pos = m.end()
+            self.matched += 1
+
+class RunResult(object):
+    """ How a test run on one board went.
+    status is one of 'passed', 'failed', 'timed out' or 'error' (the run never got as far as the test).
+    timings has the seconds spent in each phase that was reached: waiting for the bootloader,
+    uploading, booting (until the program's first output) and testing.
+    """
+    EXIT_CODES = {'passed': RUN_PASSED, 'failed': RUN_FAILED, 'timed out': RUN_TIMED_OUT, 'error': RUN_ERROR}
+
+    def __init__(self, port):
+        self.port = port
+        self.status = 'error'
+        self.message = ''
+        self.timings = collections.OrderedDict()
+        self.messages = []
+        self.output = bytearray()
+
+    @property
+    def exit_code(self):
+        return self.EXIT_CODES[self.status]
+
+    def as_dict(self):
+        return collections.OrderedDict([('port', self.port), ('status', self.status), ('message', self.message),
+            ('timings', dict((k, round(v, 4)) for k, v in self.timings.items())), ('messages', self.messages)])
+
+    def __str__(self):
+        text = '{} in {:.2f}s'.format(self.status.upper(), sum(self.timings.values()))
+        if self.timings:
+            text += ' ({})'.format(', '.join('{} {:.2f}s'.format(k, v) for k, v in self.timings.items()))
+        return text + ': ' + self.message if self.message else text
+
+class AsyncPort(object):
+    """ Reads a serial port from asyncio. On POSIX the event loop watches the port itself, so
+    a single thread can wait on any number of boards. Elsewhere each read waits in a worker thread.
+    The port's timeout has to be 0 while this is in use.
+    """
+    def __init__(self, serial_port, loop):
+        self.serial = serial_port
+        self.loop = loop
+        try:
+            self.fd = serial_port.fileno() if os.name == 'posix' else None
+        except (AttributeError, IOError, OSError):
+            self.fd = None
+
+    def _blocking_read(self):
+        self.serial.timeout = 0.1
+        try:
+            return self.serial.read(self.serial.in_waiting or 1)
+        finally:
+            self.serial.timeout = 0
+
+    async def read(self):
+        """ Waits for data and returns everything that has arrived. """
+        if self.fd is None:
+            data = b''
+            while not data:
+                data = await self.loop.run_in_executor(None, self._blocking_read)
+            return data
+        data = self.serial.read(self.serial.in_waiting)
+        while not data:
+            ready = self.loop.create_future()
+            self.loop.add_reader(self.fd, lambda: ready.done() or ready.set_result(None))
+            try:
+                await ready
+            finally:
+                self.loop.remove_reader(self.fd)
+            data = self.serial.read(self.serial.in_waiting or 1)
+        return data
+
+    async def read_until(self, marker):
+        """ Reads until marker has been received, returns whatever came after it. """
+        seen = b''
+        while marker not in seen:
+            # Only the tail can hold the start of a marker that is split across reads
+            seen = seen[-(len(marker) - 1):] + await self.read()
+        return seen.split(marker, 1)[1]
+
+async def run_board(port, filename, expect, fail=(), timeout=10.0, wait_timeout=10.0, reset=None, ready=False,
+                    upload_options=None):
+    """ Upload filename to the board on port, start it and check its output with an OutputMatcher.
+    Returns a RunResult.
+
+    The board has to be reset first so the bootloader prints its banner. reset is a shell
+    command that does that, with {port} replaced by the port. If the bootloader is known to be
+    waiting already, ready skips looking for the banner. timeout covers booting and testing.
+    upload_options are the Flasher's keyword arguments, plus delta. A delta upload only sends
+    what changed when ready is set and there's no reset, otherwise the board has just zeroed
+    its last upload and only gets the parts of the file that aren't zeros.
+    """
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    result = RunResult(port)
+    serial = import_serial()
+    try:
+        serial_port = serial.Serial(port, BASE_BAUD, timeout=0)
+    except serial.SerialException as e:
+        result.message = 'could not open port: {}'.format(e)
+        return result
+    board = AsyncPort(serial_port, loop)
+    phase = 'wait'
+    started = time.monotonic()
+
+    def finish(name):
+        nonlocal started
+        now = time.monotonic()
+        result.timings[name] = now - started
+        started = now
+
+    try:
+        if reset:
+            proc = await asyncio.create_subprocess_shell(reset.replace('{port}', port))
+            if await proc.wait() != 0:
+                result.message = 'reset command failed with {}'.format(proc.returncode)
+                return result
+        if not ready:
+            await asyncio.wait_for(board.read_until(BOOT_BANNER.encode('ascii')), wait_timeout)
+        finish('wait')
+
+        phase = 'upload'
+        options = dict(upload_options or {})
+        delta_cache = DeltaCache(port) if options.pop('delta', False) else None
+        if delta_cache and (reset or not ready):
+            # The board was just reset, which zeroed the last upload
+            delta_cache.invalidate()
+        flasher = Flasher(serial_port, delta_cache=delta_cache, log=result.messages.append, **options)
+
+        def upload():
             with open(filename, 'rb') as f:
-                sys.stderr.write('--- Sending file {} ---\n'.format(filename))
-                while True:
-                    block = f.read(1024)
-                    if not block:
-                        break
-                    self.serial.write(block)
-                    # Wait for output buffer to drain.
-                    self.serial.flush()
-                    sys.stderr.write('.')   # Progress indicator.
-            sys.stderr.write('\n--- File {} sent ---\n'.format(filename))
-        except IOError as e:
-            sys.stderr.write('--- ERROR opening file {}: {} ---\n'.format(filename, e))
-
-    def set_upload_file(self, fname):
-        self.upload_file_name = fname
+                return flasher.upload(f)
+        stats = await loop.run_in_executor(None, upload)
+        result.messages.append('sent {}: {}'.format(filename, stats))
+        finish('upload')
+
+        phase = 'boot'
+        serial_port.write(b'g')
+        matcher = OutputMatcher(expect, fail)
+
+        async def boot_and_test():
+            nonlocal phase
+            data = await board.read_until(START_MARKER)
+            while not data:
+                data = await board.read()
+            finish('boot')
+            phase = 'test'
+            while True:
+                result.output += data
+                if matcher.feed(data):
+                    return
+                data = await board.read()
+        await asyncio.wait_for(boot_and_test(), timeout)
+        finish(phase)
+        if matcher.passed:
+            result.status = 'passed'
+        else:
+            result.status = 'failed'
+            result.message = matcher.failure
+    except asyncio.TimeoutError:
+        finish(phase)
+        if phase in ('boot', 'test'):
+            result.status = 'timed out'
+            result.message = 'matched {} of {} patterns'.format(matcher.matched, len(expect))
+        else:
+            result.message = "the bootloader didn't start" if phase == 'wait' else 'upload timed out'
+    except (IOError, OSError, UploadError, ValueError, serial.SerialException) as e:
+        finish(phase)
+        result.message = '{} failed: {}'.format(phase, e)
+    finally:
+        serial_port.close()
+    return result
+
+async def run_boards(boards, report=None, **options):
+    """ Run the same test on a list of (port, file) boards at once, returns their RunResults.
+    report is called with each result as it comes in, options are passed on to run_board().
+    """
+    import asyncio
+
+    results = []
+    for done in asyncio.as_completed([run_board(port, filename, **options) for port, filename in boards]):
+        result = await done
+        results.append(result)
+        if report:
+            report(result)
+    return results
+
+class RingBuffer(object):
+    """ A fixed size byte queue between one thread that receives and one that writes it out.
+    When the writer falls behind, whatever doesn't fit is dropped and recorded in gaps as
+    (bytes kept before it, bytes lost), so the log says exactly where something is missing.
+    Every write is remembered with the time it arrived, see read().
+    """
+    def __init__(self, size=CAPTURE_BUFFER):
+        self.buffer = bytearray(size)
+        self.size = size
+        # Totals kept and taken since the start, their difference is what's waiting
+        self.head = 0
+        self.tail = 0
+        self.lost = 0
+        self.gaps = []
+        self.marks = collections.deque()
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def write(self, data, when):
+        """ Queue data, which arrived at when. Returns how many bytes were kept. """
+        with self.cond:
+            free = self.size - (self.head - self.tail)
+            if len(data) > free:
+                self.gaps.append((self.head, len(data) - free))
+                self.lost += len(data) - free
+                data = data[:free]
+            start = self.head % self.size
+            first = min(len(data), self.size - start)
+            self.buffer[start:start + first] = data[:first]
+            self.buffer[:len(data) - first] = data[first:]
+            self.head += len(data)
+            self.marks.append((self.head, when))
+            # Let the writer batch up small reads, but don't let the buffer fill up
+            if self.head - self.tail >= self.size // 2:
+                self.cond.notify()
+        return len(data)
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+
+    def read(self, timeout):
+        """ Waits up to timeout or until the buffer is half full and takes everything queued.
+        Returns (offset, data, marks) where offset counts the bytes taken before this and marks
+        are (end offset, time) for each write the data came from.
+        """
+        with self.cond:
+            if not self.closed and self.head - self.tail < self.size // 2:
+                self.cond.wait(timeout)
+            offset = self.tail
+            start = offset % self.size
+            count = self.head - self.tail
+            first = min(count, self.size - start)
+            data = bytes(self.buffer[start:start + first]) + bytes(self.buffer[:count - first])
+            self.tail = self.head
+            marks = []
+            while self.marks and self.marks[0][0] <= self.tail:
+                marks.append(self.marks.popleft())
+        return offset, data, marks
+
+class LineStamper(object):
+    """ Puts the time each line started arriving, in seconds since start, in front of it. """
+    def __init__(self, start):
+        self.start = start
+        self.at_line_start = True
+
+    def stamp(self, offset, data, marks):
+        """ Returns data with its lines stamped, using the marks from RingBuffer.read(). """
+        out = []
+        pos = 0
+        mark = 0
+        while pos < len(data):
+            if self.at_line_start:
+                while marks[mark][0] <= offset + pos:
+                    mark += 1
+                out.append(b'[%12.6f] ' % (marks[mark][1] - self.start))
+            newline = data.find(b'\n', pos)
+            end = len(data) if newline < 0 else newline + 1
+            out.append(data[pos:end])
+            self.at_line_start = newline >= 0
+            pos = end
+        return b''.join(out)
+
+def uart_errors(serial_port):
+    """ Returns (overruns, buffer overruns) counted by the serial driver, or None if it can't say.
+    An overrun is a byte lost because the UART's FIFO filled up before it was read, which
+    piterm otherwise has no way of seeing. Only Linux reports these, and not for every adapter.
+    """
+    try:
+        import fcntl
+        import termios
+        counts = struct.unpack('20i', fcntl.ioctl(serial_port.fileno(), termios.TIOCGICOUNT, b'\0' * 80))
+    except (ImportError, AttributeError, IOError, OSError, ValueError):
+        return None
+    # struct serial_icounter_struct: cts, dsr, rng, dcd, rx, tx, frame, overrun, parity, brk, buf_overrun
+    return counts[7], counts[10]
+
+class Capture(object):
+    """ Saves everything received on a serial port to a log file as fast as it arrives.
+
+    One thread does nothing but read whatever the port has waiting into a RingBuffer, so
+    the driver's buffer never gets a chance to fill up. Another writes it to the log in
+    batches every flush_interval, adding timestamps if asked. The terminal only gets a sample:
+    show() returns at most the last few lines received since it was last called.
+    """
+    def __init__(self, serial_port, log_file, buffer_size=CAPTURE_BUFFER, flush_interval=CAPTURE_FLUSH,
+                 timestamps=False, show_lines=5):
+        self.serial = serial_port
+        self.log_file = log_file
+        self.ring = RingBuffer(buffer_size)
+        self.flush_interval = flush_interval
+        self.show_lines = show_lines
+        self.start_time = time.monotonic()
+        self.stamper = LineStamper(self.start_time) if timestamps else None
+        self.stop_event = threading.Event()
+        self.lock = threading.Lock()
+        self.received = 0
+        self.written = 0
+        self.lines = 0
+        self.recent = collections.deque(maxlen=show_lines)
+        self.shown = 0
+        self.pending = b''
+        self.errors = None
+        self.threads = []
+
+    def start(self):
+        self.errors = uart_errors(self.serial)
+        for target in (self._read_loop, self._write_loop):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        self.stop_event.set()
+        self.threads[0].join()
+        self.ring.close()
+        self.threads[1].join()
+
+    def _read_loop(self):
+        try:
+            while not self.stop_event.is_set():
+                data = self.serial.read(self.serial.in_waiting or 1)
+                if data:
+                    self.received += len(data)
+                    self.ring.write(data, time.monotonic())
+        finally:
+            self.ring.close()
+
+    def _write_loop(self):
+        while True:
+            offset, data, marks = self.ring.read(self.flush_interval)
+            if data:
+                self.log_file.write(self.stamper.stamp(offset, data, marks) if self.stamper else data)
+                self.log_file.flush()
+                self.written += len(data)
+                self._remember_lines(data)
+            elif self.ring.closed:
+                return
+
+    def _remember_lines(self, data):
+        """ Keep the last few complete lines for show(), without splitting up all of data. """
+        text = self.pending + data
+        count = data.count(b'\n')
+        parts = text.rsplit(b'\n', self.show_lines + 1)
+        pending = parts.pop()
+        if len(parts) > self.show_lines:
+            parts.pop(0)
+        with self.lock:
+            first = self.lines + count - len(parts)
+            self.recent.extend(enumerate(parts, first))
+            self.lines += count
+            self.pending = pending[-DISPLAY_LINE:]
+
+    def show(self):
+        """ Returns (lines received since the last call that weren't kept, the newest lines). """
+        with self.lock:
+            lines = [line for number, line in self.recent if number >= self.shown]
+            skipped = self.lines - self.shown - len(lines)
+            self.shown = self.lines
+        return skipped, [line.rstrip(b'\r')[:DISPLAY_LINE].decode('utf-8', 'replace') for line in lines]
+
+    def overruns(self):
+        """ Overruns the driver counted since the capture started, or None if it can't say. """
+        now = uart_errors(self.serial)
+        if now is None or self.errors is None:
+            return None
+        return sum(now) - sum(self.errors)
+
+def capture_main(argv):
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="piterm capture",
+        description="Save everything a board sends to a log file, without the terminal slowing it down.")
+    parser.add_argument("port", help="serial port name")
+    parser.add_argument("--log", default=None, metavar="FILE",
+        help="file to save the output in (appended to), default: <port>.log")
+    parser.add_argument("--baud", type=int, default=BASE_BAUD, help="baud rate, default: %(default)s")
+    parser.add_argument("--timestamps", action="store_true",
+        help="start each line in the log with the time it arrived, in seconds since the capture started")
+    parser.add_argument("--show", type=int, default=5, metavar="LINES",
+        help="show at most this many of the newest lines every interval, default: %(default)s")
+    parser.add_argument("--interval", type=float, default=CAPTURE_INTERVAL, metavar="SECONDS",
+        help="how often to update the terminal, default: %(default)s")
+    parser.add_argument("--buffer", type=int, default=CAPTURE_BUFFER // 1024, metavar="KB",
+        help="how much received data may wait to be written, default: %(default)s")
+    parser.add_argument("--duration", type=float, default=None, metavar="SECONDS",
+        help="stop after this long instead of waiting for Ctrl+C")
+    args = parser.parse_args(argv)
+
+    serial = import_serial()
+    try:
+        serial_port = serial.Serial(args.port, args.baud, timeout=0.05)
+    except serial.SerialException as e:
+        sys.stderr.write('could not open port {}: {}\n'.format(repr(args.port), e))
+        sys.exit(1)
+    log_name = args.log or port_tag(args.port) + '.log'
+    log_file = open(log_name, 'ab')
+    capture = Capture(serial_port, log_file, args.buffer * 1024, timestamps=args.timestamps, show_lines=args.show)
+    sys.stderr.write('--- Capturing {} at {} baud to {}, Ctrl+C to stop ---\n'.format(args.port, args.baud, log_name))
+    capture.start()
+    peak = 0.0
+    last = (capture.start_time, 0)
+    try:
+        while args.duration is None or time.monotonic() - capture.start_time < args.duration:
+            time.sleep(args.interval if args.duration is None
+                else max(0, min(args.interval, capture.start_time + args.duration - time.monotonic())))
+            now = time.monotonic()
+            rate = (capture.received - last[1]) / max(now - last[0], 1e-6)
+            peak = max(peak, rate)
+            last = (now, capture.received)
+            skipped, lines = capture.show()
+            if skipped:
+                sys.stdout.write('--- {} lines not shown ---\n'.format(skipped))
+            for line in lines:
+                sys.stdout.write(line + '\n')
+            sys.stdout.flush()
+            sys.stderr.write('--- {} bytes, {:.0f} bytes/s{} ---\n'.format(capture.received, rate,
+                ', {} bytes lost'.format(capture.ring.lost) if capture.ring.lost else ''))
+    except KeyboardInterrupt:
+        pass
+    capture.stop()
+    log_file.close()
+
+    elapsed = time.monotonic() - capture.start_time
+    sys.stderr.write('--- Captured {} bytes in {:.1f}s, {:.0f} bytes/s on average, {:.0f} at most ({:.0f}% of line rate) ---\n'
+        .format(capture.received, elapsed, capture.received / elapsed, peak, 100.0 * peak / line_rate(serial_port)))
+    for kept, lost in capture.ring.gaps[:10]:
+        sys.stderr.write('--- Lost {} bytes after byte {}, the log couldn\'t keep up ---\n'.format(lost, kept))
+    if len(capture.ring.gaps) > 10:
+        sys.stderr.write('--- ... {} gaps, {} bytes lost in all ---\n'.format(len(capture.ring.gaps), capture.ring.lost))
+    overruns = capture.overruns()
+    if overruns:
+        sys.stderr.write('--- The serial driver counted {} overruns, some data never reached piterm ---\n'.format(overruns))
+    elif overruns is None:
+        sys.stderr.write('--- This port can\'t report overruns ---\n')
+    serial_port.close()
+    sys.exit(1 if capture.ring.lost or overruns else 0)
+
+def add_upload_arguments(parser):
+    parser.add_argument("--protocol", choices=["ihex", "binary"], default="ihex",
+        help="send an Intel HEX file as text or a raw image with the framed binary protocol, default: %(default)s")
+    parser.add_argument("--high-water", type=int, default=HIGH_WATER, metavar="BYTES",
+        help="pause sending when this many bytes are queued, default: %(default)s")
+    parser.add_argument("--low-water", type=int, default=LOW_WATER, metavar="BYTES",
+        help="resume sending when the queue drains to this many bytes, default: %(default)s")
+    parser.add_argument("--max-baud", type=int, default=BASE_BAUD, metavar="BAUD",
+        help="negotiate a baud rate up to this fast with the bootloader for uploads, default: %(default)s")
+    parser.add_argument("--delta", action="store_true",
+        help="only send the parts of the file that changed since the last upload to this board. "
+            "Resetting the board zeroes its memory, after that only the parts that aren't zeros are sent")
+    parser.add_argument("--verify", action="store_true",
+        help="check the bootloader's checksums after an ihex upload and resend what didn't arrive intact")
+    parser.add_argument("--compress", action="store_true",
+        help="with --protocol binary, send the image compressed if that makes it noticeably smaller")
+
+def check_upload_arguments(parser, args):
+    if args.low_water >= args.high_water:
+        parser.error('--low-water must be less than --high-water')
+    if args.compress and args.protocol != 'binary':
+        parser.error('--compress only works with --protocol binary')
+    if args.file is None:
+        args.file = 'bin/kernel7.img'
+
+def upload_options(args):
+    """ Flasher keyword arguments for the parsed upload arguments. """
+    return dict(protocol=args.protocol, max_baud=args.max_baud, high_water=args.high_water,
+        low_water=args.low_water, verify=args.verify, compress=args.compress)
+
+def flash_main(argv):
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="piterm flash", description="Upload to several boards at once.")
+    parser.add_argument("--ports", nargs="+", required=True, metavar="PORT[=FILE]",
+        help="serial ports to upload to, wildcards are allowed and PORT=FILE sends a different file to that port")
+    parser.add_argument("--file", default=None,
+        help="file to upload (.img, .elf or .hex), default: bin/kernel7.img")
+    add_upload_arguments(parser)
+    parser.add_argument("--boot", action="store_true",
+        help="send 'g' to start each program once it's uploaded")
+    parser.add_argument("--console", action="store_true",
+        help="watch every board's output once they're all done")
+    parser.add_argument("--log-dir", default=None,
+        help="with --console, also save each board's output to DIR/<port>.log")
+    args = parser.parse_args(argv)
+    check_upload_arguments(parser, args)
+
+    boards = expand_ports(args.ports, args.file)
+    if not boards:
+        parser.error('no ports matched')
+    from concurrent.futures import ThreadPoolExecutor
+
+    options = upload_options(args)
+    options['delta'] = args.delta
+    status = FlashStatus([port for port, filename in boards])
+    failed = 0
+    # One writer per port, so N boards take about as long as one
+    with ThreadPoolExecutor(max_workers=len(boards)) as pool:
+        futures = [(port, filename, pool.submit(flash_board, port, filename, options, status, args.boot))
+            for port, filename in boards]
+        for port, filename, future in futures:
+            try:
+                status.message(port, 'sent {}: {}'.format(filename, future.result()))
+            except (IOError, UploadError, ValueError) as e:
+                status.message(port, 'FAILED sending {}: {}'.format(filename, e))
+                failed += 1
+
+    if args.console:
+        multiplex([port for port, filename in boards], args.log_dir)
+    sys.exit(1 if failed else 0)
+
+def run_main(argv):
+    import argparse
+    import asyncio
+
+    parser = argparse.ArgumentParser(prog="piterm run",
+        description="Upload a program to one or more boards, start it and check what it prints.",
+        epilog="Exit status: {} if every board passed, {} if a board failed, {} if one timed out "
+            "and {} if one couldn't be tested.".format(RUN_PASSED, RUN_FAILED, RUN_TIMED_OUT, RUN_ERROR))
+    parser.add_argument("file", nargs="?", default=None,
+        help="file to upload (.img, .elf or .hex), default: bin/kernel7.img")
+    parser.add_argument("--ports", nargs="+", required=True, metavar="PORT[=FILE]",
+        help="serial ports of the boards, wildcards are allowed and PORT=FILE sends a different file to that port")
+    parser.add_argument("--expect", action="append", required=True, metavar="REGEX",
+        help="the program passes once its output has matched every --expect, in order")
+    parser.add_argument("--fail", action="append", default=[], metavar="REGEX",
+        help="the program fails as soon as its output matches any --fail")
+    parser.add_argument("--timeout", type=float, default=10.0, metavar="SECONDS",
+        help="how long the program has to pass once it's started, default: %(default)s")
+    parser.add_argument("--wait-timeout", type=float, default=10.0, metavar="SECONDS",
+        help="how long to wait for the bootloader to start, default: %(default)s")
+    parser.add_argument("--reset", default=None, metavar="COMMAND",
+        help="shell command that resets a board, {port} is replaced by its port")
+    parser.add_argument("--ready", action="store_true",
+        help="the bootloader is already waiting, don't wait for it to start")
+    add_upload_arguments(parser)
+    parser.add_argument("--log-dir", default=None,
+        help="save each board's output to DIR/<port>.log")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON when they're all in")
+    args = parser.parse_args(argv)
+    check_upload_arguments(parser, args)
+
+    boards = expand_ports(args.ports, args.file)
+    if not boards:
+        parser.error('no ports matched')
+    options = upload_options(args)
+    options['delta'] = args.delta
+
+    def report(result):
+        sys.stderr.write('--- {}: {} ---\n'.format(port_tag(result.port), result))
+        if result.status in ('failed', 'timed out'):
+            for line in bytes(result.output).splitlines()[-10:]:
+                sys.stderr.write('    ' + line.decode('utf-8', 'replace') + '\n')
+        if args.log_dir:
+            if not os.path.isdir(args.log_dir):
+                os.makedirs(args.log_dir)
+            with open(os.path.join(args.log_dir, port_tag(result.port) + '.log'), 'wb') as f:
+                f.write(result.output)
+
+    results = asyncio.run(run_boards(boards, report, expect=args.expect, fail=args.fail, timeout=args.timeout,
+        wait_timeout=args.wait_timeout, reset=args.reset, ready=args.ready, upload_options=options))
+    if args.json:
+        print(json.dumps([result.as_dict() for result in results], indent=2))
+    sys.exit(max(result.exit_code for result in results))
+
+def console_main(argv):
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="piterm console", description="Watch the output of several boards at once.")
+    parser.add_argument("--ports", nargs="+", required=True, metavar="PORT",
+        help="serial ports to watch, wildcards are allowed")
+    parser.add_argument("--log-dir", default=None,
+        help="also save each board's output to DIR/<port>.log")
+    args = parser.parse_args(argv)
+    multiplex([port for port, filename in expand_ports(args.ports, None)], args.log_dir)
 
 def main(argv):
     import argparse
 
-    parser = argparse.ArgumentParser(description="Piterm - A simple terminal program for the serial port.")
+    if argv and argv[0] == 'flash':
+        return flash_main(argv[1:])
+    if argv and argv[0] == 'console':
+        return console_main(argv[1:])
+    if argv and argv[0] == 'capture':
+        return capture_main(argv[1:])
+    if argv and argv[0] == 'run':
+        return run_main(argv[1:])
+
+    parser = argparse.ArgumentParser(description="Piterm - A simple terminal program for the serial port.",
+        epilog="Use 'piterm flash' or 'piterm console' to work with several boards at once, "
+            "'piterm capture' to log a board's output and 'piterm run' to test a program.")
     parser.add_argument("port", help="serial port name")
-    parser.add_argument("file", nargs="?", help="hex file to upload, default: %(default)s", default="bin/kernel7.hex")
+    parser.add_argument("file", nargs="?", default=None,
+        help="file to upload (.img, .elf or .hex), default: bin/kernel7.img")
+    add_upload_arguments(parser)
     args = parser.parse_args(argv)
+    check_upload_arguments(parser, args)
 
+    serial = import_serial()
+    from serial.tools.miniterm import key_description
     try:
         # Create the serial instance, it automatically opens the port
-        serial_instance = serial.Serial(args.port, 115200, 8, serial.PARITY_NONE, serial.STOPBITS_ONE)
+        serial_instance = serial.Serial(args.port, BASE_BAUD, 8, serial.PARITY_NONE, serial.STOPBITS_ONE)
     except serial.SerialException as e:
         sys.stderr.write('could not open port {}: {}\n'.format(repr(args.port), e))
         sys.exit(1)
 
     # All these fields have to be set before Miniterm will work
-    miniterm = MyMiniterm(serial_instance)
+    miniterm = miniterm_class()(serial_instance)
     miniterm.exit_character = chr(0x1d)
     miniterm.menu_character = chr(0x14)
     miniterm.raw = False
@@ -85,6 +1770,9 @@ def main(argv):
     miniterm.set_tx_encoding('UTF-8')
     # This is something we added to customize it
     miniterm.set_upload_file(args.file)
+    miniterm.set_upload_options(**upload_options(args))
+    if args.delta:
+        miniterm.set_delta_cache(DeltaCache(args.port))
 
     # Print out helpful info to the user
     sys.stderr.write('--- Piterm on {p.name}  {p.baudrate},{p.bytesize},{p.parity},{p.stopbits} ---\n'.format(
@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2017 Binder News
+# This software is licensed under the MIT License. See LICENSE for details.
+#
+# Finds ARM cross compilers for genmake.py and genninja.py.
+# Searching a whole home directory (or drive) is slow, so the search is done breadth
+# first with a depth limit, lists directories from several threads at once, skips
+# directories that never hold a compiler, and looks in PATH and the usual install
+# locations first. The result is remembered in a small index file so the next run
+# (and every `regen`) can skip the search entirely.
+#
+# Several roots can be searched at once, extra ones can also be given in the
+# TOOLCHAIN_PATH environment variable. When more than one compiler turns up,
+# arm-*-eabi-gcc is preferred over versioned drivers and the gcc-ar/gcc-nm wrappers.
+#
+# resolve() goes one step further for the generators. It works out everything they need
+# to know about the compiler (tool prefix, .exe suffix, target, version and the CPUs it
+# can tune for) and saves it in .toolchain.json in the project directory. While that
+# compiler hasn't changed, later runs and every `regen` read the file instead of
+# searching and running the compiler again.
+#
+
+from __future__ import print_function
+
+import fnmatch
+import glob
+import json
+import os
+import os.path
+import re
+import sys
+
+GCC_PATTERN = 'arm-*-gcc*'
+PREFERRED_PATTERN = 'arm-*-eabi-gcc'
+# Extra search roots, separated like PATH
+TOOLCHAIN_PATH_VAR = 'TOOLCHAIN_PATH'
+# Directory listings done at once, most of the time is spent waiting on the file system
+WORKERS = 16
+# How many directories below the search root a compiler can be
+MAX_DEPTH = 6
+# Directory names which are big and never contain a toolchain
+SKIP_NAMES = frozenset(['.git', '.hg', '.svn', 'node_modules', '__pycache__', '.cache', '.npm', '.cargo',
+    '.rustup', '.m2', '.gradle', '.venv', 'venv', 'site-packages', '$Recycle.Bin'])
+# Absolute paths which are never worth looking at
+SKIP_PATHS = frozenset(['/proc', '/sys', '/dev', '/run'])
+# Places toolchains usually end up, checked before the full search
+WELL_KNOWN = ['/usr/bin', '/usr/local/bin', '/opt/*/bin', '~/opt/*/bin', '~/*/bin',
+    'C:/Program Files*/GNU*/*/bin', 'C:/yagarto*/bin']
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'baremetal-pi-tools')
+INDEX_FILE = os.path.join(CACHE_DIR, 'toolchains.json')
+# Settings for the compiler a project uses, shared by genmake.py and genninja.py
+CONFIG_FILE = '.toolchain.json'
+# Bump when the settings saved in CONFIG_FILE change, older files are then ignored
+CONFIG_VERSION = 1
+# Seconds to wait for the compiler to answer a question about itself
+PROBE_TIMEOUT = 10
+
+def save_cache(path, text):
+    """ Writes text to path, making its directory first if need be. Returns False if it couldn't.
+    Everything saved this way can be worked out again, so failing only makes a later run slower.
+    """
+    try:
+        if os.path.dirname(path) and not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as fd:
+            fd.write(text)
+    except (IOError, OSError):
+        return False
+    return True
+
+def rank(gcc_path):
+    """ Sort key for compilers, the best choice sorts first.
+    A plain arm-none-eabi-gcc beats other arm-*-gcc drivers, which beat versioned drivers
+    like arm-none-eabi-gcc-7.2.1, which beat the gcc-ar/gcc-nm/gcc-ranlib wrappers.
+    Ties go to the shallowest path and then to the alphabetically first one.
+    """
+    name = os.path.basename(gcc_path).lower()
+    if name.endswith('.exe'):
+        name = name[:-4]
+    if fnmatch.fnmatch(name, PREFERRED_PATTERN):
+        kind = 0
+    elif name.endswith('-gcc'):
+        kind = 1
+    elif re.search(r'-gcc-[0-9.]+$', name):
+        kind = 2
+    else:
+        kind = 3
+    return (kind, gcc_path.count(os.sep), gcc_path)
+
+def is_preferred(gcc_path):
+    return rank(gcc_path)[0] == 0
+
+def _scan(directory):
+    """ Returns (compilers, subdirectories) directly inside directory. """
+    compilers = []
+    subdirs = []
+    try:
+        entries = list(os.scandir(directory))
+    except OSError:
+        return compilers, subdirs
+    for entry in entries:
+        try:
+            # Following links could send us around in circles
+            if entry.is_dir(follow_symlinks=False):
+                if entry.name not in SKIP_NAMES and entry.path not in SKIP_PATHS:
+                    subdirs.append(entry.path)
+            elif fnmatch.fnmatch(entry.name, GCC_PATTERN) and entry.is_file():
+                compilers.append(os.path.abspath(entry.path))
+        except OSError:
+            continue
+    return compilers, subdirs
+
+def _is_inside(path, root):
+    path = os.path.normcase(os.path.abspath(path))
+    root = os.path.normcase(os.path.abspath(root))
+    return path == root or path.startswith(root.rstrip(os.sep) + os.sep)
+
+def _likely_dirs(roots):
+    """ Returns directories from PATH and WELL_KNOWN which are inside one of roots. """
+    candidates = os.environ.get('PATH', '').split(os.pathsep)
+    for pattern in WELL_KNOWN:
+        candidates.extend(sorted(glob.glob(os.path.expanduser(pattern))))
+    result = []
+    for directory in candidates:
+        if directory and directory not in result and os.path.isdir(directory) \
+                and any(_is_inside(directory, root) for root in roots):
+            result.append(directory)
+    return result
+
+def search_roots(paths):
+    """ Returns the absolute search roots for paths (a string or a list of them) plus
+    everything in the TOOLCHAIN_PATH environment variable, without duplicates.
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+    paths = list(paths or []) + os.environ.get(TOOLCHAIN_PATH_VAR, '').split(os.pathsep)
+    roots = []
+    for path in paths:
+        if not path:
+            continue
+        root = os.path.abspath(os.path.expanduser(path))
+        if root not in roots and os.path.isdir(root):
+            roots.append(root)
+    return roots
+
+def find_compilers(roots, max_depth=MAX_DEPTH, workers=WORKERS, stop_early=False):
+    """ Returns the compilers under roots, best first.
+    The directories are listed breadth first, one level at a time, by a pool of threads so a slow
+    (network) file system is kept busy. With stop_early the search ends after the first level that
+    holds a preferred compiler, or straight away if PATH or a usual install location has one.
+    Finishing the level keeps the answer the same no matter which thread is fastest.
+    """
+    # Only needed when nothing is saved yet, so a `regen` doesn't pay for importing it
+    from concurrent.futures import ThreadPoolExecutor
+
+    if isinstance(roots, str):
+        roots = [roots]
+    found = set()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for compilers, _ in pool.map(_scan, _likely_dirs(roots)):
+            found.update(compilers)
+        if stop_early and any(is_preferred(path) for path in found):
+            return sorted(found, key=rank)
+
+        level = list(roots)
+        visited = set()
+        for depth in range(max_depth + 1):
+            level = [d for d in level if d not in visited]
+            if not level:
+                break
+            visited.update(level)
+            next_level = []
+            for compilers, subdirs in pool.map(_scan, level):
+                found.update(compilers)
+                next_level.extend(subdirs)
+            if stop_early and any(is_preferred(path) for path in found):
+                break
+            level = next_level
+    return sorted(found, key=rank)
+
+class ToolchainIndex(object):
+    """ Remembers which compiler was found for each search root.
+    An entry is only trusted while the compiler's modification time hasn't changed.
+    """
+    def __init__(self, path=INDEX_FILE):
+        self.path = path
+        try:
+            with open(path, 'r') as fd:
+                self.entries = json.load(fd)
+        except (IOError, OSError, ValueError):
+            self.entries = {}
+
+    def get(self, root):
+        entry = self.entries.get(root)
+        if not entry:
+            return None
+        try:
+            if os.path.getmtime(entry['gcc']) != entry['mtime']:
+                return None
+        except OSError:
+            return None
+        return entry['gcc']
+
+    def put(self, root, gcc_path):
+        self.entries[root] = {'gcc': gcc_path, 'mtime': os.path.getmtime(gcc_path)}
+        save_cache(self.path, json.dumps(self.entries, indent=1, sort_keys=True))
+
+def locate(guess_paths, use_index=True):
+    """ Returns the path of the best compiler under guess_paths, or None if there isn't one. """
+    roots = search_roots(guess_paths)
+    key = os.pathsep.join(roots)
+    index = ToolchainIndex()
+    if use_index:
+        gcc_path = index.get(key)
+        if gcc_path:
+            return gcc_path
+    compilers = find_compilers(roots, stop_early=True)
+    if not compilers:
+        return None
+    index.put(key, compilers[0])
+    return compilers[0]
+
+def print_compilers(guess_paths, chosen):
+    """ Print every compiler under guess_paths, best first, marking the chosen one. """
+    roots = search_roots(guess_paths)
+    compilers = find_compilers(roots)
+    for gcc_path in compilers:
+        print(('* ' if gcc_path == chosen else '  ') + gcc_path)
+    if not compilers:
+        print('No compilers found under ' + ', '.join(roots))
+
+def tool_prefix(gcc_file):
+    """ Returns what comes before 'gcc' in the names of the compiler's tools, without the dash.
+    arm-none-eabi-gcc.exe gives arm-none-eabi, so does arm-none-eabi-gcc-7.2.1, and
+    arm-linux-gnueabihf-gcc gives arm-linux-gnueabihf.
+    """
+    match = re.match(r'^(.*)-gcc(-[0-9.]+)?(\.exe)?$', gcc_file, re.I)
+    if match:
+        return match.group(1)
+    # A gcc-ar style wrapper, the other tools still go by the same prefix
+    return gcc_file[:gcc_file.rfind('-gcc')]
+
+def _ask(gcc_path, *args):
+    """ Returns what the compiler prints for args, or raises an Exception if it won't run. """
+    import subprocess
+
+    try:
+        result = subprocess.run([gcc_path] + list(args), stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            stdin=subprocess.DEVNULL, universal_newlines=True, timeout=PROBE_TIMEOUT)
+    except (OSError, subprocess.SubprocessError) as e:
+        raise Exception('Unable to run {}: {}'.format(gcc_path, e))
+    if result.returncode != 0:
+        output = result.stdout.strip()
+        raise Exception('{} {} failed with exit code {}{}'.format(gcc_path, ' '.join(args), result.returncode,
+            ': ' + output if output else ''))
+    return result.stdout
+
+def known_cpus(help_text):
+    """ Returns the CPUs listed in the output of gcc -Q --help=target, which can be given to
+    -mcpu and -mtune. An empty list means the compiler didn't say.
+    """
+    cpus = []
+    lines = iter(help_text.splitlines())
+    for line in lines:
+        if 'Known ARM CPUs' in line:
+            for line in lines:
+                if not line.strip():
+                    break
+                cpus.extend(line.split())
+            break
+    return cpus
+
+class Toolchain(object):
+    """ Everything the generators need to know about a compiler.
+    The fields in SAVED are kept in CONFIG_FILE, the rest depend on how this run was started
+    and are worked out again each time.
+    """
+    SAVED = ['gcc_path', 'mtime', 'size', 'prefix', 'machine', 'version', 'cpus']
+
+    def __init__(self, gcc_path, **saved):
+        self.gcc_path = gcc_path
+        self.bin_dir, gcc_file = os.path.split(gcc_path)
+        self.compiler_dir = os.path.dirname(self.bin_dir)
+        self.name = os.path.basename(self.compiler_dir)
+        self.has_exe = gcc_file.lower().endswith('.exe')
+        self.is_cygwin = os.path.exists('/cygdrive/')
+        # Whether build commands run in a Unix shell. Cygwin's Python says 'cygwin' and WSL's
+        # says 'linux' even when the compiler is a Windows .exe.
+        self.is_unix = sys.platform != 'win32' or self.is_cygwin
+        self.prefix = saved.get('prefix') or tool_prefix(gcc_file)
+        self.mtime = saved.get('mtime')
+        self.size = saved.get('size')
+        self.machine = saved.get('machine')
+        self.version = saved.get('version')
+        self.cpus = saved.get('cpus') or []
+
+    def probe(self):
+        """ Asks the compiler what it is. Raises an Exception if it won't run or isn't for ARM. """
+        stat = os.stat(self.gcc_path)
+        self.mtime = stat.st_mtime
+        self.size = stat.st_size
+        self.machine = _ask(self.gcc_path, '-dumpmachine').strip()
+        if not self.machine.startswith('arm'):
+            raise Exception('{} builds for {}, not ARM'.format(self.gcc_path, self.machine))
+        # Newer compilers only give the major version for -dumpversion, older ones don't know -dumpfullversion
+        self.version = _ask(self.gcc_path, '-dumpfullversion', '-dumpversion').strip()
+        self.cpus = known_cpus(_ask(self.gcc_path, '-Q', '--help=target'))
+
+    def is_current(self, roots):
+        """ True if the compiler is still the one that was probed and is inside one of roots. """
+        try:
+            stat = os.stat(self.gcc_path)
+        except OSError:
+            return False
+        return stat.st_mtime == self.mtime and stat.st_size == self.size \
+            and any(_is_inside(self.gcc_path, root) for root in roots)
+
+    def supports_cpu(self, cpu):
+        """ True if the compiler can tune for cpu, or if it didn't say which CPUs it knows. """
+        return not self.cpus or cpu in self.cpus
+
+    def save(self, path=CONFIG_FILE):
+        """ Saves the settings in path, returns False if it couldn't. """
+        config = dict((key, getattr(self, key)) for key in self.SAVED)
+        config['config_version'] = CONFIG_VERSION
+        return save_cache(path, json.dumps(config, indent=1, sort_keys=True))
+
+    @classmethod
+    def load(cls, path=CONFIG_FILE):
+        """ Returns the Toolchain saved in path, or None if there isn't a usable one. """
+        try:
+            with open(path, 'r') as fd:
+                config = json.load(fd)
+        except (IOError, OSError, ValueError):
+            return None
+        if not isinstance(config, dict) or config.get('config_version') != CONFIG_VERSION or not config.get('gcc_path'):
+            return None
+        return cls(config['gcc_path'], **dict((key, config.get(key)) for key in cls.SAVED[1:]))
+
+def _saved(guess_paths, config_file):
+    """ Returns the Toolchain in config_file if it's still current for guess_paths, or None. """
+    saved = Toolchain.load(config_file)
+    return saved if saved and saved.is_current(search_roots(guess_paths)) else None
+
+def chosen_compiler(guess_paths, use_saved=True, config_file=CONFIG_FILE):
+    """ Returns the path of the compiler resolve() would use, without running it, or None. """
+    saved = _saved(guess_paths, config_file) if use_saved else None
+    return saved.gcc_path if saved else locate(guess_paths, use_saved)
+
+def resolve(guess_paths, use_saved=True, config_file=CONFIG_FILE):
+    """ Returns the Toolchain to use for the compiler under guess_paths, or None if there isn't one.
+    With use_saved the one in config_file is used as long as the compiler hasn't changed and is
+    still under guess_paths, otherwise the compiler is located, probed and saved in config_file.
+    """
+    saved = _saved(guess_paths, config_file) if use_saved else None
+    if saved:
+        return saved
+    gcc_path = locate(guess_paths, use_saved)
+    if not gcc_path:
+        return None
+    found = Toolchain(gcc_path)
+    found.probe()
+    found.save(config_file)
+    return found